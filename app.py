@@ -2,12 +2,14 @@ import os
 import warnings
 warnings.filterwarnings("ignore")
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import gradio as gr
-from autodub import preload_models, load_stt, load_translator
-from autodub.utils import sep_noise_speech, enhance_audio, prepare_clips, merge_clips_to_video, extract_audio_from_video, add_background_noise
-from autodub.tts import prepare_prompts, generate_translated_speech
-from autodub.script import load_script_from_json
+from autodub import preload_models, load_stt, load_translator, load_separator
+from autodub.utils import sep_noise_speech, enhance_audio, prepare_clips, merge_clips_to_video, changed_segments, extract_audio_from_video, add_background_noise
+from autodub.pipeline import dub_script
+from autodub.script import MultilingualScript, load_script_from_json
+from autodub.cache import StageCache
 
 lang2id = {
     'English': 'en',
@@ -16,26 +18,45 @@ lang2id = {
     'Chinese': 'zh',
 }
 
+cache = StageCache()
+
 title_md = '''## **Autodub** - Tobig's 20th Conference
 <a href="https://github.com/WiFiHan/autodub">[Github]</a> <a href="http://www.datamarket.kr/xe/">[Tobig's]</a>
 '''
 
-def process(input_video, title, stt_type, translator_type, source_language, target_language, progress=gr.Progress(track_tqdm=True)):
+def process(input_video, title, stt_type, translator_type, source_language, target_language, speaker_prompts=False, progress=gr.Progress(track_tqdm=True)):
     source_langid = lang2id[source_language]
     target_langid = lang2id[target_language]
     
     os.makedirs(f"./results/{title}/", exist_ok=True)
     os.makedirs(f"./results/{title}/audio/", exist_ok=True)
+    audio_dir = f"./results/{title}/audio/"
     script_path = f"./results/{title}/script.json"
     without_noise_output_path = f"./results/{title}/[{target_langid}]_{title}.mp4"
     with_noise_output_path = f"./results/{title}/[{target_langid}]_{title}_with_noise.mp4"
     
+    # Every stage below is skipped when its inputs, parameters and model are unchanged.
+    video_key = cache.key('video', cache.file_digest(input_video))
+
     #Extract audio from video first
-    extract_audio_from_video(input_video, f"./results/{title}/audio/init_source.wav")
+    extract_key = cache.key('extract', video_key)
+    cache.run('extract', extract_key,
+              {'init_source.wav': audio_dir + "init_source.wav"},
+              lambda: extract_audio_from_video(input_video, audio_dir + "init_source.wav"))
     #Enhance audio
-    enhance_audio(f"./results/{title}/audio/init_source.wav", f"./results/{title}/audio/source.wav")
+    enhance_key = cache.key('enhance', extract_key, version='DeepFilterNet')
+    cache.run('enhance', enhance_key,
+              {'source.wav': audio_dir + "source.wav"},
+              lambda: enhance_audio(audio_dir + "init_source.wav", audio_dir + "source.wav"))
     #Separate speech and noise for gaining noise
-    sep_noise_speech(title)
+    separator = load_separator()
+    separate_key = cache.key('separate', extract_key,
+                             version=os.path.basename(separator.pretrained_model),
+                             tta=separator.tta, postprocess=separator.postprocess)
+    cache.run('separate', separate_key,
+              {'init_source_Vocals.wav': audio_dir + "init_source_Vocals.wav",
+               'init_source_Instruments.wav': audio_dir + "init_source_Instruments.wav"},
+              lambda: sep_noise_speech(title, separator))
 
 
     print(f'input_video is {input_video}. app.py line 41')
@@ -43,30 +64,60 @@ def process(input_video, title, stt_type, translator_type, source_language, targ
     if stt_type == 'None':
         script = load_script_from_json(script_path)
     else:
-        stt = load_stt(stt_type)
-        script = stt.make_script_from_video(
-            video_path=input_video, 
-            language=source_langid, 
-            title=title)
+        stt_key = cache.key('stt', enhance_key, stt=stt_type, language=source_langid)
+        records = cache.load('stt', stt_key)
+        if records is None:
+            stt = load_stt(stt_type)
+            script = stt.make_script_from_video(
+                video_path=input_video,
+                language=source_langid,
+                title=title)
+            cache.store('stt', stt_key, {}, value=script.data.to_dict('records'))
+        else:
+            script = MultilingualScript(title=title,
+                                        video_path=input_video,
+                                        audio_path=audio_dir + "source.wav",
+                                        source_language=source_langid,
+                                        data=pd.DataFrame(records))
         script.to_json(script_path)
+    source_key = cache.data_digest(script.data, ['start', 'end', 'source'])
     
-    # Translation
+    # Translation, unless it is cached. Otherwise lines are translated inside the dubbing pipeline.
+    translator = None
     if translator_type != 'None':
-        translator = load_translator(translator_type)
-        script = translator.translate_script(script, target_langid)
-        script.to_json(script_path)
-    
-    # Extract clips
-    prepare_clips(script)
+        translate_key = cache.key('translate', source_key, translator=translator_type,
+                                  source_language=script.source_language, target_language=target_langid)
+        translations = cache.load('translate', translate_key)
+        if translations is None:
+            translator = load_translator(translator_type)
+        else:
+            script.data[target_langid] = translations
+            script.to_json(script_path)
     
-    # Make prompts for VALL-E
-    prepare_prompts(script)
-    
-    # Generate speech with target language
-    generate_translated_speech(script, target_language=target_langid)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Extract clips while lines are translated, prompted and synthesized
+        clips_key = cache.key('clips', video_key, enhance_key, separate_key, source_key)
+        clips = executor.submit(cache.run, 'clips', clips_key,
+                                {'video': script.output_dir + "video/source",
+                                 'audio': script.output_dir + "audio/source",
+                                 'instrument': script.output_dir + "audio/instrument"},
+                                lambda: prepare_clips(script))
+
+        # Make prompts, generate speech and render video parts line by line,
+        # only for lines changed since the last render. Switching the speaker prompts changes the prompt
+        # of every line, so every line is revisited then.
+        prompts_key = cache.key('speaker_prompts', video_key, title=title, language=target_langid)
+        switched = bool(cache.load('speaker_prompts', prompts_key)) != speaker_prompts
+        changed = None if translator is not None or switched else changed_segments(script, target_langid)
+        script = dub_script(script, target_langid, indices=changed, translator=translator, cache=cache, clips=clips,
+                            speaker_prompts=speaker_prompts)
+        cache.store('speaker_prompts', prompts_key, {}, value=speaker_prompts)
+    if translator is not None:
+        cache.store('translate', translate_key, {}, value=script.data[target_langid].tolist())
+        script.to_json(script_path)
     
-    # Merge clips
-    merge_clips_to_video(script, language=target_langid)
+    # Merge clips; on a re-render every video part is up to date, so they are only concatenated
+    merge_clips_to_video(script, language=target_langid, incremental=True)
     return without_noise_output_path
 
     # Merge noise and video
@@ -106,6 +157,10 @@ with demo:
                 choices=["English", "Korean", "Japanese", "Chinese"],
                 info="Korean - not available yet."
                 )
+            speaker_prompts_checkbox = gr.Checkbox(
+                label="Speaker prompts",
+                info="Experimental - dub every line of a speaker with one voice, from lines grouped by speaker."
+                )
             run_button = gr.Button(label="Run")
         with gr.Column():
             output_video = gr.Video(label="Result", interactive=False)
@@ -121,6 +176,7 @@ with demo:
                          Translator_dropdown,
                          source_lang_dropdown,
                          target_lang_dropdown,
+                         speaker_prompts_checkbox,
                          ],
                      outputs=[output_video]
                      )
@@ -129,7 +185,14 @@ with demo:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Tobigs-19 Vision Conference")
     parser.add_argument('--public',action='store_true')
+    parser.add_argument('--precision', choices=['fp32', 'bf16', 'int8'], default='fp32',
+                        help="Experimental for 'bf16' and 'int8': check them against fp32 with "
+                             "autodub.VALL_E_X.utils.precision_check on your checkpoint first.")
+    parser.add_argument('--attention-backend', choices=['math', 'sdpa'], default='math',
+                        help="Experimental for 'sdpa': torch's scaled_dot_product_attention, "
+                             "checked against 'math' on CPU only (tests/test_attention.py).")
     args = parser.parse_args()
     
-    preload_models()
+    preload_models(precision=args.precision, attention_backend=args.attention_backend)
+    load_separator()
     demo.queue().launch(share=args.public)
\ No newline at end of file
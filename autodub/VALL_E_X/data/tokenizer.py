@@ -17,6 +17,7 @@ import re
 from dataclasses import asdict, dataclass
 from typing import Any, Dict, List, Optional, Pattern, Union
 
+import julius
 import numpy as np
 import torch
 import torchaudio
@@ -92,6 +93,68 @@ class AudioTokenizer:
     def encode(self, wav: torch.Tensor) -> torch.Tensor:
         return self.codec.encode(wav.to(self.device))
 
+    @torch.no_grad()
+    def encode_batch(
+        self,
+        wavs: List[torch.Tensor],
+        sample_rates: Union[int, List[int]],
+        max_batch_seconds: float = 120.0,
+    ) -> List[torch.Tensor]:
+        """Encode variable-length waveforms in a few padded codec passes.
+
+        Waveforms are grouped by length into batches of up to `max_batch_seconds`
+        of (padded) audio. Within a batch, waveforms sharing a sample rate are
+        resampled together, then the whole batch goes through the codec at once.
+
+        Args:
+          wavs: Waveforms of shape (channels, n_samples).
+          sample_rates: Sample rate of every waveform, or one for all of them.
+          max_batch_seconds: Audio per codec pass, padding included.
+
+        Returns:
+          Codes of shape (n_q, n_frames) per waveform, trimmed to its own length.
+        """
+        if isinstance(sample_rates, int):
+            sample_rates = [sample_rates] * len(wavs)
+        lengths = [
+            wav.size(-1) * self.sample_rate // sr for wav, sr in zip(wavs, sample_rates)
+        ]
+        hop_length = int(self.codec.encoder.hop_length)
+        max_batch_samples = int(max_batch_seconds * self.sample_rate)
+
+        codes = [None] * len(wavs)
+        order = sorted(range(len(wavs)), key=lambda i: lengths[i])
+        while order:
+            batch = [order.pop(0)]
+            while order and lengths[order[0]] * (len(batch) + 1) <= max_batch_samples:
+                batch.append(order.pop(0))
+            length = lengths[batch[-1]]
+
+            # Channel conversion and resampling, one padded call per source rate
+            padded = torch.zeros(len(batch), self.channels, length, device=self.device)
+            for sr in set(sample_rates[i] for i in batch):
+                rows = [row for row, i in enumerate(batch) if sample_rates[i] == sr]
+                sr_length = max(wavs[batch[row]].size(-1) for row in rows)
+                group = torch.stack([
+                    convert_audio(
+                        torch.nn.functional.pad(
+                            wavs[batch[row]], (0, sr_length - wavs[batch[row]].size(-1))
+                        ),
+                        sr, sr, self.channels,
+                    )
+                    for row in rows
+                ]).to(self.device)
+                group = julius.resample_frac(group, sr, self.sample_rate)
+                for k, row in enumerate(rows):
+                    n_samples = lengths[batch[row]]
+                    padded[row, :, :n_samples] = group[k, :, :n_samples]
+
+            batch_codes = self.encode(padded)[0][0]
+            for row, i in enumerate(batch):
+                n_frames = -(-lengths[i] // hop_length)
+                codes[i] = batch_codes[row, :, :n_frames]
+        return codes
+
     def decode(self, frames: torch.Tensor) -> torch.Tensor:
         return self.codec.decode(frames)
 
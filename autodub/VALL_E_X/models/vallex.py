@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
 import random
 from typing import Dict, Iterator, List, Tuple, Union
 
@@ -470,6 +471,13 @@ class VALLE(VALLF):
         return_worst: bool = False,
         best_of: int = 1,
         top_k: int = -100,
+        duration_slack: float = 2.0,
+        stop_on_runaway: bool = True,
+        runaway_check_interval: int = 8,
+        target_frames: int = None,
+        max_frames: int = None,
+        eos_bias: float = 8.0,
+        termination_check_interval: int = 8,
     ) -> torch.Tensor:
         """
         Args:
@@ -484,6 +492,29 @@ class VALLE(VALLF):
             The number of highest probability tokens to keep for top-k-filtering. Default to -100.
           temperature: (`optional`) float
             The value used to module the next token probabilities. Must be strictly positive. Default to 1.0.
+          best_of: (`optional`) int
+            Number of sampled beams, the one with the best length-normalized
+            logprob is returned. The prefill runs once at batch 1 and is shared
+            by all beams. It cannot be reused across calls for the same prompt:
+            with the input layout ``[text prompt, text, BOS + audio prompt]``,
+            text attends bidirectionally to the whole text span, so the
+            keys/values of the prompt positions change with the line's text.
+          duration_slack: (`optional`) float
+            Generate at most this many times the length expected from the
+            prompt's speaking rate, see `frame_budget`.
+          stop_on_runaway: (`optional`) bool
+            End beams stuck in silence or in a loop, see `detect_runaway`,
+            checked every `runaway_check_interval` frames.
+          target_frames: (`optional`) int
+            Length to steer the output to, by biasing the EOS logit as it
+            gets close (see `eos_steering_bias`).
+          max_frames: (`optional`) int
+            Hard limit on the number of generated frames. The NAR decoders
+            only run on the frames kept.
+          termination_check_interval: (`optional`) int
+            Every this many frames, the host checks which beams reached EOS
+            and drops them from the batch and the KV cache. In between, the
+            loop does not wait for the device.
         Returns:
           Return the predicted audio code matrix.
         """
@@ -513,90 +544,129 @@ class VALLE(VALLF):
         prefix_len = y.shape[1]
 
         # AR Decoder
-        # TODO: Managing decoder steps avoid repetitive computation
         y = prompts[..., 0]
         if self.ar_audio_prepend_bos:
             y = F.pad(y, (1, 0), value=NUM_AUDIO_TOKENS + 1)
 
-        x_len = x_lens.max()
-        x_attn_mask = torch.zeros((x_len, x_len), dtype=torch.bool)
+        x_len = int(x_lens.max())
+        y_len = y.shape[1]
+        enrolled_len = int(enroll_x_lens)
+        # The loop stops once more than `budget` frames have been generated,
+        # so every buffer below is sized once for prompt + that budget.
+        budget = frame_budget(x_len - enrolled_len, enrolled_len, prefix_len, duration_slack)
+        if max_frames is not None:
+            budget = min(budget, max_frames)
+        max_y_len = y_len + budget + 1
+        max_len = x_len + max_y_len
+
+        # Text attends to text only, audio attends to text and causally to audio.
+        # Built once and sliced per step in `multi_head_attention_forward`.
+        xy_attn_mask = torch.triu(
+            torch.ones(max_len, max_len, dtype=torch.bool, device=y.device),
+            diagonal=1,
+        )
+        xy_attn_mask[:x_len, :x_len] = False
+
+        # Logprob of every generated frame, so that frames discarded later do not count in the ranking.
+        logprob_buffer = torch.zeros((best_of, max_y_len), device=y.device)
+        # Original index of every beam still in the batch, and whether it
+        # already emitted EOS (it is fed EOS until the next check drops it).
+        beams = torch.arange(best_of, device=y.device)
+        finished = torch.zeros(best_of, dtype=torch.bool, device=y.device)
+        if target_frames is not None:
+            target_frames = torch.tensor(float(target_frames), device=y.device)
+            steering_end = torch.tensor(float(budget), device=y.device)
+
+        kv_cache = self.ar_decoder.allocate_kv_cache(
+            best_of, max_len, device=x.device, dtype=x.dtype
+        )
+        y_buffer = torch.full(
+            (best_of, max_y_len), NUM_AUDIO_TOKENS, dtype=y.dtype, device=y.device
+        )
+        y_buffer[:, :y_len] = y
 
-        kv_cache = None
-        use_kv_caching = True
+        # Prefill with text + audio prompt, then feed one frame per step.
+        # The prefill is the same for every beam: it runs once, and the
+        # cache copies its keys/values to all beams.
+        y_emb = self.ar_audio_embedding(y)
+        y_emb = self.ar_audio_prenet(y_emb)
+        y_pos = self.ar_audio_position(y_emb)
+        xy_pos = torch.concat([x, y_pos], dim=1)
 
-        sum_logprobs = torch.zeros(best_of, device=y.device)  # implement batch decoding here
-        x = x.repeat(best_of, 1, 1)
-        y = y.repeat(best_of, 1)
+        n_generated = 0
         while True:
-            y_emb = self.ar_audio_embedding(y)
-            y_emb = self.ar_audio_prenet(y_emb)
-            y_pos = self.ar_audio_position(y_emb)
-            xy_pos = torch.concat([x, y_pos], dim=1)
-
-            y_len = y.shape[1]
-            x_attn_mask_pad = F.pad(
-                x_attn_mask,
-                (0, y_len),
-                value=True,
-            )
-            y_attn_mask = F.pad(
-                torch.triu(
-                    torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1
-                ),
-                (x_len, 0),
-                value=False,
-            )
-            xy_attn_mask = torch.concat(
-                [x_attn_mask_pad, y_attn_mask], dim=0
-            ).to(y.device)
-
-
-            if use_kv_caching and kv_cache is not None:
-                xy_pos = xy_pos[:, [-1]]
-            else:
-                pass
-
             xy_dec, kv_cache = self.ar_decoder.infer(
                 xy_pos,
                 mask=xy_attn_mask,
-                past_kv=kv_cache,
-                use_cache=use_kv_caching,
+                kv_cache=kv_cache,
             )
-            # xy_dec, _ = self.ar_decoder(
-            #     (xy_pos, None),
-            #     mask=xy_attn_mask,
-            # )
 
-            logits = self.ar_predict_layer(xy_dec[:, -1])
+            # Sample in fp32 also under low-precision autocast
+            logits = self.ar_predict_layer(xy_dec[:, -1]).float()
+            if logits.shape[0] != beams.shape[0]:
+                logits = logits.repeat(beams.shape[0], 1)
+            if target_frames is not None:
+                logits[:, NUM_AUDIO_TOKENS] += eos_steering_bias(
+                    n_generated, target_frames, steering_end, eos_bias
+                )
             samples, current_logprobs = topk_sampling(
                 logits, top_k=top_k, top_p=1, temperature=temperature
             )
-            sum_logprobs += current_logprobs * (y[:, -1] != NUM_AUDIO_TOKENS)
-            samples[y[:, -1] == NUM_AUDIO_TOKENS] = NUM_AUDIO_TOKENS
-            completed = (samples[:, -1] == NUM_AUDIO_TOKENS).all()
-            if (
-                completed
-                or (y.shape[1] - prompts.shape[1]) > x_lens.max() * 16
-            ):
-                if prompts.shape[1] == y.shape[1]:
-                    raise SyntaxError(
-                        "well trained model shouldn't reach here."
-                    )
-                lengths = torch.sum(y != NUM_AUDIO_TOKENS, dim=1)
-                avg_logprobs = sum_logprobs / lengths ** length_penalty
-                # choose the best beam according to sum_logprobs
-                best_beam = y[torch.argmax(avg_logprobs), :]
-                worst_beam = y[torch.argmin(avg_logprobs), :]
-                # strip all eos tokens
-                best_beam = best_beam[best_beam != NUM_AUDIO_TOKENS]
-                worst_beam = worst_beam[worst_beam != NUM_AUDIO_TOKENS]
-                if return_worst:
-                    y = worst_beam.unsqueeze(0)
-                else:
-                    y = best_beam.unsqueeze(0)
-                break
-
-            y = torch.concat([y, samples], dim=1)
+            logprob_buffer[beams, y_len] = current_logprobs * ~finished
+            samples = samples.masked_fill(finished.unsqueeze(-1), NUM_AUDIO_TOKENS)
+            finished = finished | (samples[:, 0] == NUM_AUDIO_TOKENS)
+
+            # The only host syncs of the loop: every few frames, and at the end of the budget.
+            out_of_budget = (y_len - prompts.shape[1]) > budget
+            if out_of_budget or n_generated % termination_check_interval == 0:
+                keep = torch.nonzero(~finished).squeeze(1)
+                if out_of_budget or keep.numel() == 0:
+                    if prompts.shape[1] == y_len:
+                        raise SyntaxError(
+                            "well trained model shouldn't reach here."
+                        )
+                    y = y_buffer[:, :y_len]
+                    lengths = torch.sum(y != NUM_AUDIO_TOKENS, dim=1)
+                    sum_logprobs = logprob_buffer.sum(dim=1)
+                    avg_logprobs = sum_logprobs / lengths ** length_penalty
+                    # choose the best beam according to sum_logprobs
+                    best_beam = y[torch.argmax(avg_logprobs), :]
+                    worst_beam = y[torch.argmin(avg_logprobs), :]
+                    # strip all eos tokens
+                    best_beam = best_beam[best_beam != NUM_AUDIO_TOKENS]
+                    worst_beam = worst_beam[worst_beam != NUM_AUDIO_TOKENS]
+                    if return_worst:
+                        y = worst_beam.unsqueeze(0)
+                    else:
+                        y = best_beam.unsqueeze(0)
+                    break
+                if keep.numel() < beams.shape[0]:
+                    # Finished beams are complete in `y_buffer`: stop decoding them.
+                    beams = beams[keep]
+                    finished = finished[keep]
+                    samples = samples[keep]
+                    kv_cache.select_rows(keep)
+
+            y_buffer[beams, y_len] = samples[:, 0]
+            y_len += 1
+            n_generated += 1
+            if stop_on_runaway and n_generated % runaway_check_interval == 0:
+                # Discard the repetitions and end the beam.
+                window = y_buffer[beams, y_len - n_generated : y_len]
+                runaway, drop = detect_runaway(window)
+                runaway &= ~finished
+                columns = torch.arange(n_generated, device=y.device)
+                discarded = runaway.unsqueeze(-1) & (columns >= n_generated - drop.unsqueeze(-1))
+                y_buffer[beams, y_len - n_generated : y_len] = window.masked_fill(
+                    discarded, NUM_AUDIO_TOKENS
+                )
+                logprob_buffer[beams, y_len - n_generated : y_len] = logprob_buffer[
+                    beams, y_len - n_generated : y_len
+                ].masked_fill(discarded, 0.0)
+                finished = finished | runaway
+            y_emb = self.ar_audio_embedding(samples)
+            y_emb = self.ar_audio_prenet(y_emb)
+            xy_pos = self.ar_audio_position(y_emb, offset=y_len - 1)
 
         codes = [y[:, prefix_len + int(self.ar_audio_prepend_bos) :]]
         if self.num_quantizers == 1:
@@ -686,6 +756,286 @@ class VALLE(VALLF):
         assert len(codes) == self.num_quantizers
         return torch.stack(codes, dim=-1)
 
+    def _embed_text(
+        self,
+        text: torch.Tensor,
+        enroll_x_lens: int,
+        prompt_language: str,
+        text_language: Union[str, List[str]],
+        nar: bool = False,
+    ) -> torch.Tensor:
+        if nar:
+            text_embedding, language_embedding = self.nar_text_embedding, self.nar_language_embedding
+            text_prenet, text_position = self.nar_text_prenet, self.nar_text_position
+        else:
+            text_embedding, language_embedding = self.ar_text_embedding, self.ar_language_embedding
+            text_prenet, text_position = self.ar_text_prenet, self.ar_text_position
+
+        x = text_embedding(text)
+        # Add language embedding
+        prompt_language_id = torch.LongTensor(np.array([self.language_ID[prompt_language]])).to(x.device)
+        if isinstance(text_language, str):
+            text_language_id = torch.LongTensor(np.array([self.language_ID[text_language]])).to(x.device)
+        elif isinstance(text_language, List):
+            text_language_id = torch.LongTensor(np.array([self.language_ID[tl] for tl in text_language])).to(x.device)
+        x[:, :enroll_x_lens, :] += language_embedding(prompt_language_id)
+        x[:, enroll_x_lens:, :] += language_embedding(text_language_id)
+        x = text_prenet(x)
+        x = text_position(x)
+        return x
+
+    def batch_inference(
+        self,
+        x: List[torch.Tensor],
+        y: List[torch.Tensor],
+        enroll_x_lens: List[int],
+        prompt_language: List[str],
+        text_language: List[Union[str, List[str]]],
+        temperature: float = 1.0,
+        top_k: int = -100,
+        duration_slack: float = 2.0,
+        stop_on_runaway: bool = True,
+        runaway_check_interval: int = 8,
+        target_frames: List[int] = None,
+        max_frames: List[int] = None,
+        eos_bias: float = 8.0,
+        termination_check_interval: int = 8,
+    ) -> List[torch.Tensor]:
+        """
+        Batched counterpart of `inference`. Every item has its own prompt; the
+        AR and NAR decoders run over the whole batch together.
+
+        Args:
+          x:
+            A list of N 1-D tensors (text prompt tokens + text tokens).
+          y:
+            A list of N 2-D tensors of shape (T_i, 8), the audio prompts.
+          enroll_x_lens:
+            The number of text prompt tokens at the head of each `x`.
+          prompt_language, text_language:
+            Per-item languages, as in `inference`.
+          duration_slack, stop_on_runaway, runaway_check_interval, eos_bias,
+          termination_check_interval:
+            As in `inference`.
+          target_frames, max_frames:
+            Per-item lengths, as in `inference`. `None` items are not steered
+            or limited.
+        Returns:
+          A list of N predicted audio code matrices of shape (1, T_i, 8).
+        """
+        assert len(x) == len(y) == len(enroll_x_lens)
+        assert all(t.ndim == 1 and t.shape[0] > 0 for t in x)
+        assert all(p.ndim == 2 for p in y)
+        if self.prefix_mode not in [0, 1]:
+            raise NotImplementedError(
+                f"batch_inference does not support prefix_mode {self.prefix_mode}"
+            )
+
+        device = y[0].device
+        batch_size = len(x)
+        bos = int(self.ar_audio_prepend_bos)
+        x_lens = torch.tensor([t.shape[0] for t in x], device=device)
+        prefix_lens = torch.tensor([p.shape[0] for p in y], device=device)
+        x_len = int(x_lens.max())
+        prefix_len = int(prefix_lens.max())
+
+        # Text is right-padded; audio prompts are left-padded so that all rows
+        # emit their next frame at the same column. Padded keys are masked.
+        ar_x = nn.utils.rnn.pad_sequence(
+            [
+                self._embed_text(t.unsqueeze(0), e, pl, tl)[0]
+                for t, e, pl, tl in zip(x, enroll_x_lens, prompt_language, text_language)
+            ],
+            batch_first=True,
+        )
+        ar_y = []
+        for prompts in y:
+            tokens = prompts[:, 0].unsqueeze(0)
+            if self.ar_audio_prepend_bos:
+                tokens = F.pad(tokens, (1, 0), value=NUM_AUDIO_TOKENS + 1)
+            y_emb = self.ar_audio_embedding(tokens)
+            y_emb = self.ar_audio_prenet(y_emb)
+            y_pos = self.ar_audio_position(y_emb)[0]
+            ar_y.append(F.pad(y_pos, (0, 0, prefix_len - prompts.shape[0], 0)))
+        xy_pos = torch.concat([ar_x, torch.stack(ar_y)], dim=1)
+
+        # Per-row budget, as in `inference`.
+        budgets = [
+            frame_budget(t.shape[0] - e, e, p.shape[0], duration_slack)
+            for t, e, p in zip(x, enroll_x_lens, y)
+        ]
+        if max_frames is not None:
+            budgets = [b if m is None else min(b, m) for b, m in zip(budgets, max_frames)]
+        steered = None
+        if target_frames is not None and any(t is not None for t in target_frames):
+            steered = torch.tensor([t is not None for t in target_frames], device=device)
+            targets = torch.tensor(
+                [float(t) if t is not None else 0. for t in target_frames], device=device
+            )
+            steering_ends = torch.tensor(budgets, dtype=torch.float, device=device)
+        max_budget = max(budgets)
+        budgets = torch.tensor(budgets, device=device)
+        y_len = prefix_len + bos
+        max_y_len = y_len + max_budget + 1
+        max_len = x_len + max_y_len
+        self.ar_audio_position.extend_pe(
+            torch.tensor(0.0, device=device), max_y_len
+        )
+
+        xy_attn_mask = torch.triu(
+            torch.ones(max_len, max_len, dtype=torch.bool, device=device),
+            diagonal=1,
+        )
+        xy_attn_mask[:x_len, :x_len] = False
+        columns = torch.arange(max_len, device=device)
+        key_padding_mask = (
+            (columns >= x_lens.unsqueeze(-1)) & (columns < x_len)
+        ) | (
+            (columns >= x_len) & (columns < x_len + prefix_len - prefix_lens.unsqueeze(-1))
+        )
+
+        kv_cache = self.ar_decoder.allocate_kv_cache(
+            batch_size, max_len, device=device, dtype=xy_pos.dtype
+        )
+        y_buffer = torch.full(
+            (batch_size, max_y_len), NUM_AUDIO_TOKENS, dtype=torch.long, device=device
+        )
+        # Audio position of the next frame for every row.
+        positions = prefix_lens + bos
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        gen_lens = torch.zeros(batch_size, dtype=torch.long, device=device)
+        n_generated = 0
+        while True:
+            xy_dec, kv_cache = self.ar_decoder.infer(
+                xy_pos,
+                mask=xy_attn_mask,
+                src_key_padding_mask=key_padding_mask,
+                kv_cache=kv_cache,
+            )
+            logits = self.ar_predict_layer(xy_dec[:, -1]).float()
+            if steered is not None:
+                logits[:, NUM_AUDIO_TOKENS] += steered * eos_steering_bias(
+                    n_generated, targets, steering_ends, eos_bias
+                )
+            samples, _ = topk_sampling(
+                logits, top_k=top_k, top_p=1, temperature=temperature
+            )
+            finished |= (samples[:, 0] == NUM_AUDIO_TOKENS) | (n_generated >= budgets)
+            # Finished rows are fed EOS; the host only checks for the end every few frames.
+            if (
+                n_generated % termination_check_interval == 0
+                or n_generated >= max_budget
+            ) and finished.all():
+                break
+            samples = samples.masked_fill(finished.unsqueeze(-1), NUM_AUDIO_TOKENS)
+            gen_lens += (~finished).long()
+
+            y_buffer[:, y_len] = samples[:, 0]
+            y_len += 1
+            n_generated += 1
+            if stop_on_runaway and n_generated % runaway_check_interval == 0:
+                # Discard the repetitions and end the row.
+                runaway, drop = detect_runaway(
+                    y_buffer[:, y_len - n_generated : y_len]
+                )
+                runaway &= ~finished
+                columns = torch.arange(y_len, device=device)
+                y_buffer[:, :y_len].masked_fill_(
+                    runaway.unsqueeze(-1)
+                    & (columns >= y_len - drop.unsqueeze(-1)),
+                    NUM_AUDIO_TOKENS,
+                )
+                gen_lens -= drop * runaway
+                finished |= runaway
+            y_emb = self.ar_audio_embedding(samples)
+            y_emb = self.ar_audio_prenet(y_emb)
+            xy_pos = self.ar_audio_position(y_emb, offset=positions)
+            positions = positions + 1
+
+        if not torch.all(gen_lens > 0):
+            raise SyntaxError("well trained model shouldn't reach here.")
+
+        gen_lens = gen_lens.tolist()
+        generated = [
+            y_buffer[i, prefix_len + bos : prefix_len + bos + gen_lens[i]]
+            for i in range(batch_size)
+        ]
+        if self.num_quantizers == 1:
+            return [g.view(1, -1, 1) for g in generated]
+
+        # Non-AR Decoders
+        # Prompt + generated frames, right-padded; prompt codes are known for
+        # every quantizer, generated codes are filled in stage by stage.
+        prefix_lens = prefix_lens.tolist()
+        total_lens = [p + g for p, g in zip(prefix_lens, gen_lens)]
+        y_max = max(total_lens)
+        codes = torch.zeros(
+            (batch_size, y_max, self.num_quantizers), dtype=torch.long, device=device
+        )
+        prompt_mask = torch.zeros((batch_size, y_max), dtype=torch.bool, device=device)
+        gen_mask = torch.zeros((batch_size, y_max), dtype=torch.bool, device=device)
+        for i, (prompts, g) in enumerate(zip(y, generated)):
+            p = prefix_lens[i]
+            codes[i, :p] = prompts
+            codes[i, p : p + gen_lens[i], 0] = g
+            prompt_mask[i, :p] = True
+            gen_mask[i, p : p + gen_lens[i]] = True
+
+        nar_x = nn.utils.rnn.pad_sequence(
+            [
+                self._embed_text(t.unsqueeze(0), e, pl, tl, nar=True)[0]
+                for t, e, pl, tl in zip(x, enroll_x_lens, prompt_language, text_language)
+            ],
+            batch_first=True,
+        )
+        nar_key_padding_mask = torch.concat(
+            [
+                torch.arange(x_len, device=device) >= x_lens.unsqueeze(-1),
+                ~(prompt_mask | gen_mask),
+            ],
+            dim=1,
+        )
+
+        y_emb = self.nar_audio_embeddings[0](codes[..., 0])
+        if self.prefix_mode != 0:
+            for j in range(1, self.num_quantizers):
+                y_emb += self.nar_audio_embeddings[j](
+                    codes[..., j]
+                ) * prompt_mask.unsqueeze(-1).to(y_emb.dtype)
+
+        for i, (predict_layer, embedding_layer) in enumerate(
+            zip(
+                self.nar_predict_layers,
+                self.nar_audio_embeddings[1:],
+            )
+        ):
+            y_pos = self.nar_audio_prenet(y_emb)
+            y_pos = self.nar_audio_position(y_pos)
+            xy_pos = torch.concat([nar_x, y_pos], dim=1)
+
+            xy_dec, _ = self.nar_decoder(
+                (xy_pos, self.nar_stage_embeddings[i].weight),
+                src_key_padding_mask=nar_key_padding_mask,
+            )
+            logits = predict_layer(xy_dec[:, x_len:])
+
+            samples = torch.argmax(logits, dim=-1)
+            codes[..., i + 1] = torch.where(gen_mask, samples, codes[..., i + 1])
+
+            if i < self.num_quantizers - 2:
+                if self.prefix_mode == 0:
+                    update_mask = prompt_mask | gen_mask
+                else:
+                    update_mask = gen_mask
+                y_emb += embedding_layer(
+                    codes[..., i + 1]
+                ) * update_mask.unsqueeze(-1).to(y_emb.dtype)
+
+        return [
+            codes[i : i + 1, prefix_lens[i] : total_lens[i]]
+            for i in range(batch_size)
+        ]
+
     def continual(
         self,
         x: torch.Tensor,
@@ -788,6 +1138,92 @@ class VALLE(VALLF):
         return torch.stack(codes, dim=-1)
 
 
+# Fallback speaking rate, in codec frames per text token, when there is no prompt to calibrate it.
+DEFAULT_FRAMES_PER_TOKEN = 8.0
+# Frames allowed beyond the estimate, for very short texts.
+MIN_EXTRA_FRAMES = 75
+
+
+def frame_budget(
+    text_len: int, enroll_x_len: int, prompt_frames: int, duration_slack: float = 2.0
+) -> int:
+    """Maximum number of frames to generate for `text_len` text tokens.
+
+    The speaking rate (frames per text token) is calibrated on the prompt,
+    so it follows the speaker and the language of the prompt. The budget is
+    `duration_slack` times the expected length, and never more than the
+    former cap of 16 frames per text token (prompt included).
+    """
+    if enroll_x_len > 0 and prompt_frames > 0:
+        frames_per_token = prompt_frames / enroll_x_len
+    else:
+        frames_per_token = DEFAULT_FRAMES_PER_TOKEN
+    budget = int(math.ceil(frames_per_token * text_len * duration_slack)) + MIN_EXTRA_FRAMES
+    return min(budget, (enroll_x_len + text_len) * 16)
+
+
+def eos_steering_bias(
+    n_generated: int,
+    target_frames: torch.Tensor,
+    max_frames: torch.Tensor,
+    eos_bias: float,
+) -> torch.Tensor:
+    """EOS logit bias steering the AR decoder towards `target_frames`.
+
+    No bias until 90% of the target (or of `max_frames` if lower), then
+    rising linearly to `eos_bias` halfway to `max_frames`, so that the
+    speech has frames left to end before generation is cut mid-word.
+    """
+    start = 0.9 * torch.minimum(target_frames, max_frames.to(target_frames.dtype))
+    end = torch.maximum(start + 0.5 * (max_frames - start), start + 1)
+    return eos_bias * ((n_generated - start) / (end - start)).clamp(0, 1)
+
+
+def detect_runaway(
+    tokens: torch.Tensor,
+    max_repeat: int = 60,
+    max_period: int = 25,
+    min_repeats: int = 4,
+    min_span: int = 40,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Find generations stuck in silence or in a loop.
+
+    A row runs away when its last `max_repeat` tokens are identical (e.g. a
+    silence code), or when its last frames repeat a pattern of 2 to
+    `max_period` frames `min_repeats` times, over at least `min_span` frames.
+    Constant tails are left to the `max_repeat` rule, so that a pause is not
+    mistaken for a loop. Everything is computed on the device of `tokens`.
+
+    Args:
+      tokens:
+        A 2-D tensor of shape (B, T), the first-codebook tokens generated so far.
+    Returns:
+      A (B,) bool tensor of runaway rows, and the (B,) number of trailing
+      frames to discard from each (the repetitions after the first one).
+    """
+    B, T = tokens.shape
+    runaway = torch.zeros(B, dtype=torch.bool, device=tokens.device)
+    drop = torch.zeros(B, dtype=torch.long, device=tokens.device)
+    if T >= max_repeat:
+        tail = tokens[:, -max_repeat:]
+        hit = (tail == tail[:, -1:]).all(dim=-1)
+        drop = torch.where(hit, max_repeat - 1, drop)
+        runaway |= hit
+    for period in range(2, max_period + 1):
+        span = max(period * min_repeats, min_span)
+        if T < span:
+            break
+        tail = tokens[:, -span:]
+        hit = (
+            (tail[:, period:] == tail[:, :-period]).all(dim=-1)
+            & (tail != tail[:, -1:]).any(dim=-1)
+            & ~runaway
+        )
+        drop = torch.where(hit, span - period, drop)
+        runaway |= hit
+    return runaway, drop
+
+
 # https://github.com/microsoft/unilm/blob/master/xtune/src/transformers/modeling_utils.py
 def top_k_top_p_filtering(
     logits, top_k=0, top_p=1.0, filter_value=-float("Inf"), min_tokens_to_keep=1
@@ -807,7 +1243,7 @@ def top_k_top_p_filtering(
         )  # Safety check
         # Remove all tokens with a probability less than the last token of the top-k
         indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
+        logits = logits.masked_fill(indices_to_remove, filter_value)
 
     if top_p < 1.0:
         sorted_logits, sorted_indices = torch.sort(logits, descending=True)
@@ -830,7 +1266,7 @@ def top_k_top_p_filtering(
         indices_to_remove = sorted_indices_to_remove.scatter(
             1, sorted_indices, sorted_indices_to_remove
         )
-        logits[indices_to_remove] = filter_value
+        logits = logits.masked_fill(indices_to_remove, filter_value)
     return logits
 
 
@@ -850,5 +1286,5 @@ def topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0):
     # Sample
     token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
     logprobs = F.log_softmax(logits.float(), dim=-1)
-    current_logprobs = logprobs[torch.arange(logprobs.shape[0]), token.squeeze(1)]
+    current_logprobs = logprobs.gather(-1, token).squeeze(1)
     return token, current_logprobs
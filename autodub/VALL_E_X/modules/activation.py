@@ -8,6 +8,7 @@ from torch.nn import functional as F
 from torch.nn.init import constant_, xavier_normal_, xavier_uniform_
 from torch.nn.modules.linear import NonDynamicallyQuantizableLinear
 from torch.nn.parameter import Parameter
+import torch.ao.nn.quantized.dynamic as nnqd
 
 def _in_projection_packed(
     q: Tensor,
@@ -111,6 +112,126 @@ def _scaled_dot_product_attention(
     output = torch.bmm(attn, v)
     return output, attn
 
+class StaticKVCache:
+    r"""Preallocated key/value buffers for incremental decoding.
+
+    One buffer per layer is sized for the whole decode (prompt + maximum number
+    of generated frames). Each step writes its keys/values in place at the
+    current step index instead of growing the cache with ``torch.cat``.
+
+    Args:
+        num_layers: number of attention layers sharing this cache.
+        batch_size: number of sequences decoded together.
+        num_heads: number of attention heads per layer.
+        head_dim: dimension of each attention head.
+        max_len: maximum number of positions the cache can hold.
+
+    Shape:
+        - keys, values: :math:`(L, B, H, T_{max}, E)`
+    """
+
+    def __init__(
+            self,
+            num_layers,
+            batch_size,
+            num_heads,
+            head_dim,
+            max_len,
+            device=None,
+            dtype=None,
+    ) -> None:
+        factory_kwargs = {"device": device, "dtype": dtype}
+        self.max_len = max_len
+        self.keys = torch.zeros(
+            (num_layers, batch_size, num_heads, max_len, head_dim), **factory_kwargs
+        )
+        self.values = torch.zeros(
+            (num_layers, batch_size, num_heads, max_len, head_dim), **factory_kwargs
+        )
+        # Number of positions already written for every layer.
+        self.length = 0
+
+    def update(self, layer_idx, k, v):
+        r"""Write ``k``/``v`` of shape :math:`(B, H, T, E)` at the current step
+        index of layer ``layer_idx`` and return views over all valid positions.
+
+        With :math:`B = 1` and a larger cache, ``k``/``v`` are written to every
+        row, so that a prefill shared by all rows runs once; the returned views
+        then hold the first row only."""
+        start, end = self.length, self.length + k.size(-2)
+        if end > self.max_len:
+            raise RuntimeError(
+                f"StaticKVCache overflow: {end} positions requested, {self.max_len} allocated"
+            )
+        self.keys[layer_idx, :, :, start:end] = k
+        self.values[layer_idx, :, :, start:end] = v
+        rows = k.size(0)
+        return self.keys[layer_idx, :rows, :, :end], self.values[layer_idx, :rows, :, :end]
+
+    def advance(self, num_positions):
+        self.length += num_positions
+
+    def select_rows(self, rows):
+        r"""Keep only the rows ``rows`` (a 1-D index tensor), in that order, e.g.
+        to drop finished sequences from the batch. Only written positions are
+        copied."""
+        for name in ("keys", "values"):
+            buffer = getattr(self, name)
+            selected = buffer.new_zeros(
+                (buffer.size(0), rows.size(0)) + buffer.shape[2:]
+            )
+            selected[:, :, :, : self.length] = buffer[
+                :, :, :, : self.length
+            ].index_select(1, rows)
+            setattr(self, name, selected)
+
+
+# Attention kernel of 'multi_head_attention_forward':
+#   "sdpa": torch.nn.functional.scaled_dot_product_attention, which picks a fused
+#           kernel and does not materialize the attention matrix when it can.
+#   "math": explicit softmax(q @ k^T) @ v, and torch's own attention in 'forward'.
+# "math" stays the default until SDPA is checked against it on every device, see tests/test_attention.py.
+_attention_backend = "math"
+
+
+def set_attention_backend(backend):
+    r"""Select the attention kernel used at inference, ``"sdpa"`` or ``"math"``."""
+    global _attention_backend
+    if backend not in ("sdpa", "math"):
+        raise ValueError(f"Unknown attention backend '{backend}', expected 'sdpa' or 'math'.")
+    _attention_backend = backend
+
+
+def get_attention_backend():
+    return _attention_backend
+
+
+def autocast_dtype(device_type):
+    r"""Dtype of autocast on ``device_type`` (``"cuda"`` or ``"cpu"``), or None
+    if autocast is disabled there."""
+    if device_type == "cuda" and torch.is_autocast_enabled():
+        return torch.get_autocast_gpu_dtype()
+    if device_type == "cpu" and torch.is_autocast_cpu_enabled():
+        return torch.get_autocast_cpu_dtype()
+    return None
+
+
+def dynamic_int8_linear(linear, from_float=True):
+    r"""Dynamically quantized int8 counterpart of the ``Linear`` ``linear``.
+
+    With ``from_float=False`` only the shape is taken from ``linear``, and the
+    weights are left to be loaded from a quantized state dict."""
+    if from_float:
+        linear.qconfig = torch.ao.quantization.default_dynamic_qconfig
+        return nnqd.Linear.from_float(linear)
+    return nnqd.Linear(
+        linear.in_features,
+        linear.out_features,
+        bias_=linear.bias is not None,
+        dtype=torch.qint8,
+    )
+
+
 def multi_head_attention_forward(
         x,
         ipw,
@@ -121,6 +242,11 @@ def multi_head_attention_forward(
         attn_mask,
         past_kv=None,
         use_cache=False,
+        kv_cache=None,
+        layer_idx=0,
+        key_padding_mask=None,
+        qkv=None,
+        out_proj=None,
 ):
     # x = x.transpose(1, 0)
     # tgt_len, bsz, embed_dim = x.shape
@@ -141,11 +267,16 @@ def multi_head_attention_forward(
 
     B, T, C = x.size()
 
-    q, k, v = torch._C._nn.linear(x, ipw, ipb).chunk(3, dim=-1)
+    if qkv is None:
+        qkv = torch._C._nn.linear(x, ipw, ipb)
+    q, k, v = qkv.chunk(3, dim=-1)
     k = k.view(B, T, n_head, C // n_head).transpose(1, 2)  # (B, nh, T, hs)
     q = q.view(B, T, n_head, C // n_head).transpose(1, 2)  # (B, nh, T, hs)
     v = v.view(B, T, n_head, C // n_head).transpose(1, 2)  # (B, nh, T, hs)
-    if past_kv is not None:
+    if kv_cache is not None:
+        # Static cache: written in place, the caller advances the step index.
+        k, v = kv_cache.update(layer_idx, k, v)
+    elif past_kv is not None:
         past_key = past_kv[0]
         past_value = past_kv[1]
         k = torch.cat((past_key, k), dim=-2)
@@ -153,17 +284,34 @@ def multi_head_attention_forward(
 
     FULL_T = k.shape[-2]
 
-    if use_cache is True:
+    if use_cache is True and kv_cache is None:
         present = (k, v)
     else:
         present = None
 
-    att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-    att = att.masked_fill(attn_mask[FULL_T - T:FULL_T, :FULL_T], float('-inf'))
-    att = F.softmax(att, dim=-1)
-    y = att @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+    if attn_mask is not None:
+        attn_mask = attn_mask[..., FULL_T - T:FULL_T, :FULL_T]
+    if key_padding_mask is not None:
+        # (B, S) -> (B, 1, 1, S), broadcast over heads and query positions
+        key_padding_mask = key_padding_mask[:, None, None, :FULL_T]
+        attn_mask = key_padding_mask if attn_mask is None else attn_mask | key_padding_mask
+
+    if _attention_backend == "sdpa":
+        # True marks masked positions here, but positions to attend to in SDPA.
+        y = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=None if attn_mask is None else ~attn_mask
+        )
+    else:
+        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+        if attn_mask is not None:
+            att = att.masked_fill(attn_mask, float('-inf'))
+        att = F.softmax(att, dim=-1)
+        y = att @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
     y = y.transpose(1, 2).contiguous().view(B, T, C)  # re-assemble all head outputs side by side
-    y = torch._C._nn.linear(y, opw, opb)
+    if out_proj is not None:
+        y = out_proj(y)
+    else:
+        y = torch._C._nn.linear(y, opw, opb)
     return (y, present)
 
 
@@ -329,6 +477,9 @@ class MultiheadAttention(Module):
                 xavier_normal_(self.bias_v)
 
         self.add_zero_attn = add_zero_attn
+        # Set by 'quantize_dynamic_': the projections are int8 modules
+        # and 'in_proj_weight' is gone.
+        self.quantized = False
 
     def _reset_parameters(self):
         if self._qkv_same_embed_dim:
@@ -421,6 +572,37 @@ class MultiheadAttention(Module):
                 raise AssertionError(
                     "only bool and floating types of key_padding_mask are supported"
                 )
+        if (
+                (_attention_backend == "sdpa" or self.quantized)
+                and not self.training
+                and not need_weights
+                and is_batched
+                and self.batch_first
+                and query is key
+                and key is value
+                and self._qkv_same_embed_dim
+                and self.bias_k is None
+                and self.bias_v is None
+                and not self.add_zero_attn
+                and (attn_mask is None or attn_mask.dtype == torch.bool)
+                and (key_padding_mask is None or key_padding_mask.dtype == torch.bool)
+        ):
+            # Self-attention at inference (the NAR decoder) goes through the
+            # same kernel as 'infer', see 'set_attention_backend'.
+            attn_output, _ = self.infer(
+                query,
+                key_padding_mask=key_padding_mask,
+                need_weights=False,
+                attn_mask=attn_mask,
+            )
+            return attn_output, None
+        if self.quantized:
+            # 'in_proj_weight' is gone, only 'infer' knows the int8 projections.
+            raise ValueError(
+                "a dynamically quantized MultiheadAttention only supports batched, batch-first "
+                "self-attention at inference, without attention weights and with boolean masks"
+            )
+
         why_not_fast_path = ""
         if not is_batched:
             why_not_fast_path = f"input not batched; expected query.dim() of 3 but got {query.dim()}"
@@ -537,6 +719,15 @@ class MultiheadAttention(Module):
                     x.transpose(1, 0) for x in (query, key, value)
                 ]
 
+        # torch turns the masks into float masks of the query dtype, which must
+        # match the dtype the attention is computed in under autocast.
+        dtype = autocast_dtype(query.device.type)
+        if dtype is not None and (key_padding_mask is not None or attn_mask is not None):
+            same_qk, same_kv = query is key, key is value
+            query = query.to(dtype)
+            key = query if same_qk else key.to(dtype)
+            value = key if same_kv else value.to(dtype)
+
         if not self._qkv_same_embed_dim:
             attn_output, attn_output_weights = F.multi_head_attention_forward(
                 query,
@@ -595,18 +786,63 @@ class MultiheadAttention(Module):
               attn_mask: Optional[Tensor] = None,
               average_attn_weights: bool = True,
               past_kv = None,
-              use_cache = False
+              use_cache = False,
+              kv_cache = None,
+              layer_idx = 0,
               ):
         # x = x.transpose(1, 0)
+        qkv = self.in_projection(x)
         y, kv = multi_head_attention_forward(
                 x=x,
                 ipw=self.in_proj_weight,
                 ipb=self.in_proj_bias,
-                opw=self.out_proj.weight,
-                opb=self.out_proj.bias,
+                opw=None if self.quantized else self.out_proj.weight,
+                opb=None if self.quantized else self.out_proj.bias,
                 n_head=self.num_heads,
                 attn_mask=attn_mask,
                 past_kv=past_kv,
                 use_cache=use_cache,
+                kv_cache=kv_cache,
+                layer_idx=layer_idx,
+                key_padding_mask=key_padding_mask,
+                qkv=qkv,
+                out_proj=self.out_proj if self.quantized else None,
         )
         return (y, kv)
+
+    def in_projection(self, x: Tensor) -> Tensor:
+        r"""Packed query/key/value projection of ``x``, as used by :meth:`infer`."""
+        if self.quantized:
+            return self.in_proj_linear(x)
+        return torch._C._nn.linear(x, self.in_proj_weight, self.in_proj_bias)
+
+    def quantize_dynamic_(self, from_float: bool = True) -> None:
+        r"""Replace the input and output projections by dynamically quantized
+        int8 ``Linear`` modules, in place. Only :meth:`infer` and inference-mode
+        self-attention are supported afterwards.
+
+        With ``from_float=False`` the int8 weights are left uninitialized, to
+        load a state dict saved after quantization."""
+        if self.quantized:
+            return
+        if not self._qkv_same_embed_dim:
+            raise ValueError(
+                "dynamic int8 quantization requires a packed in_proj (kdim == vdim == embed_dim)"
+            )
+        in_proj = Linear(self.embed_dim, 3 * self.embed_dim, bias=self.in_proj_bias is not None)
+        out_proj = Linear(self.embed_dim, self.embed_dim, bias=self.out_proj.bias is not None)
+        if from_float:
+            with torch.no_grad():
+                in_proj.weight.copy_(self.in_proj_weight)
+                out_proj.weight.copy_(self.out_proj.weight)
+                if self.in_proj_bias is not None:
+                    in_proj.bias.copy_(self.in_proj_bias)
+                if self.out_proj.bias is not None:
+                    out_proj.bias.copy_(self.out_proj.bias)
+        # 'in_proj_weight' is a raw Parameter applied with 'linear' directly,
+        # so dynamic quantization cannot swap it: it moves to a Linear first.
+        self.in_proj_linear = dynamic_int8_linear(in_proj, from_float)
+        self.out_proj = dynamic_int8_linear(out_proj, from_float)
+        self.in_proj_weight = None
+        self.in_proj_bias = None
+        self.quantized = True
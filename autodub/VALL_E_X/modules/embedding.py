@@ -63,23 +63,27 @@ class SinePositionalEmbedding(nn.Module):
 
         self.reverse = False
         self.pe = None
-        self.extend_pe(torch.tensor(0.0).expand(1, 4000))
+        self.extend_pe(torch.tensor(0.0), 4000)
 
-    def extend_pe(self, x):
-        """Reset the positional encodings."""
+    def extend_pe(self, x, length=None):
+        """Reset the positional encodings.
+        The table covers `length` positions (`x.size(1)` by default), in the
+        dtype and on the device of `x`."""
+        if length is None:
+            length = x.size(1)
         if self.pe is not None:
-            if self.pe.size(1) >= x.size(1):
+            if self.pe.size(1) >= length:
                 if self.pe.dtype != x.dtype or self.pe.device != x.device:
                     self.pe = self.pe.to(dtype=x.dtype, device=x.device)
                 return
-        pe = torch.zeros(x.size(1), self.dim_model)
+        pe = torch.zeros(length, self.dim_model)
         if self.reverse:
             position = torch.arange(
-                x.size(1) - 1, -1, -1.0, dtype=torch.float32
+                length - 1, -1, -1.0, dtype=torch.float32
             ).unsqueeze(1)
         else:
             position = torch.arange(
-                0, x.size(1), dtype=torch.float32
+                0, length, dtype=torch.float32
             ).unsqueeze(1)
         div_term = torch.exp(
             torch.arange(0, self.dim_model, 2, dtype=torch.float32)
@@ -90,8 +94,21 @@ class SinePositionalEmbedding(nn.Module):
         pe = pe.unsqueeze(0)
         self.pe = pe.to(device=x.device, dtype=x.dtype).detach()
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        self.extend_pe(x)
+    def forward(self, x: torch.Tensor, offset: int = 0) -> torch.Tensor:
+        """`offset` is the position of x[:, 0], used for incremental decoding.
+        A 1-D tensor gives one offset per batch row; the table must already
+        cover the largest position (see `extend_pe`)."""
+        if isinstance(offset, torch.Tensor):
+            self.extend_pe(x)
+            positions = offset.unsqueeze(-1) + torch.arange(
+                x.size(1), device=offset.device
+            )
+            output = x.unsqueeze(-1) if x.ndim == 2 else x
+            output = output * self.x_scale + self.alpha * self.pe[0, positions]
+            return self.dropout(output)
+        self.extend_pe(x, offset + x.size(1))
         output = x.unsqueeze(-1) if x.ndim == 2 else x
-        output = output * self.x_scale + self.alpha * self.pe[:, : x.size(1)]
+        output = output * self.x_scale + self.alpha * self.pe[
+            :, offset : offset + x.size(1)
+        ]
         return self.dropout(output)
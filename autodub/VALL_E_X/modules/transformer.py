@@ -6,8 +6,9 @@ from typing import Any, Callable, List, Optional, Tuple, Union
 import torch
 from torch import Tensor, nn
 from torch.nn import functional as F
+import torch.ao.nn.quantized.dynamic as nnqd
 
-from .activation import MultiheadAttention
+from .activation import MultiheadAttention, StaticKVCache, autocast_dtype, dynamic_int8_linear
 from .scaling import ActivationBalancer, BalancedDoubleSwish
 from .scaling import BasicNorm as _BasicNorm
 
@@ -318,6 +319,8 @@ class TransformerEncoderLayer(nn.Module):
         src_key_padding_mask: Optional[Tensor] = None,
         past_kv: Optional[Tensor] = None,
         use_cache: bool = False,
+        kv_cache: Optional[StaticKVCache] = None,
+        layer_idx: int = 0,
     ):
         x, stage_embedding = src, None
         is_src_tuple = False
@@ -342,6 +345,8 @@ class TransformerEncoderLayer(nn.Module):
                 need_weights=False,
                 past_kv=past_kv,
                 use_cache=use_cache,
+                kv_cache=kv_cache,
+                layer_idx=layer_idx,
             )
             x = x + x_attn_out
             x = x + self._ff_block(self.norm2(x, stage_embedding))
@@ -350,6 +355,16 @@ class TransformerEncoderLayer(nn.Module):
             return (x, stage_embedding)
         return (x, kv)
 
+    def quantize_dynamic_(self, from_float: bool = True) -> None:
+        r"""Dynamically quantize the self-attention projections and the
+        feedforward ``linear1``/``linear2`` to int8, in place, for CPU inference.
+        See :meth:`MultiheadAttention.quantize_dynamic_` for ``from_float``."""
+        self.self_attn.quantize_dynamic_(from_float)
+        if not isinstance(self.linear1, nnqd.Linear):
+            self.linear1 = dynamic_int8_linear(self.linear1, from_float)
+        if not isinstance(self.linear2, nnqd.Linear):
+            self.linear2 = dynamic_int8_linear(self.linear2, from_float)
+
     # self-attention block
     def _sa_block(
         self,
@@ -452,7 +467,23 @@ class TransformerEncoder(nn.Module):
         return_layer_states: bool = False,
         past_kv: Optional[Tensor] = None,
         use_cache: bool = False,
+        kv_cache: Optional[StaticKVCache] = None,
     ):
+        if kv_cache is not None:
+            # Preallocated cache: every layer writes at the same step index.
+            output = src
+            for layer_idx, mod in enumerate(self.layers):
+                output, _ = mod.infer(
+                    output, src_mask=mask, src_key_padding_mask=src_key_padding_mask,
+                    kv_cache=kv_cache, layer_idx=layer_idx,
+                )
+            kv_cache.advance(src.size(1))
+
+            if self.norm is not None:
+                output = self.norm(output)
+
+            return output, kv_cache
+
         if past_kv is None:
             past_length = 0
             past_kv = tuple([None] * self.num_layers)
@@ -472,6 +503,27 @@ class TransformerEncoder(nn.Module):
 
         return output, new_kv
 
+    def allocate_kv_cache(
+        self, batch_size: int, max_len: int, device=None, dtype=None
+    ) -> StaticKVCache:
+        r"""Allocate a :class:`StaticKVCache` able to hold ``max_len`` positions
+        for every layer of this encoder.
+
+        Under autocast the cache takes the autocast dtype, which the keys and
+        values are computed in."""
+        device_type = torch.device(device).type if device is not None else "cpu"
+        dtype = autocast_dtype(device_type) or dtype
+        self_attn = self.layers[0].self_attn
+        return StaticKVCache(
+            self.num_layers,
+            batch_size,
+            self_attn.num_heads,
+            self_attn.head_dim,
+            max_len,
+            device=device,
+            dtype=dtype,
+        )
+
 
 class TransformerDecoderLayer(nn.Module):
     __constants__ = ["batch_first", "norm_first"]
@@ -1,5 +1,7 @@
 # coding: utf-8
 import os
+from collections import OrderedDict
+from contextlib import nullcontext
 import torch
 from vocos import Vocos
 import logging
@@ -22,6 +24,8 @@ from ..data.tokenizer import (
 )
 from ..data.collation import get_text_token_collater
 from ..models.vallex import VALLE
+from ..modules.activation import set_attention_backend
+from ..modules.transformer import TransformerEncoderLayer
 from ..utils.g2p import PhonemeBpeTokenizer
 from ..utils.sentence_cutter import split_text_into_sentences
 
@@ -38,6 +42,12 @@ checkpoints_dir = "./checkpoints/"
 
 model = None
 
+# Name of the checkpoint loaded in 'model', with its precision unless fp32. Part of the cache key of generated speech.
+model_version = None
+
+# Inference precision of 'model': "fp32", "bf16" (autocast) or "int8" (dynamic quantization, CPU).
+model_precision = "fp32"
+
 codec = None
 
 vocos = None
@@ -45,7 +55,36 @@ vocos = None
 text_tokenizer = PhonemeBpeTokenizer(tokenizer_path="./assets/bpe_69.json")
 text_collater = get_text_token_collater()
 
-def preload_models(VALLE_checkpoint:str="vallex-korean-checkpoint.pt") -> None:
+# Loaded prompts, keyed by file identity. Lines sharing a speaker prompt link the same file.
+prompt_memo = OrderedDict()
+prompt_memo_size = 64
+
+def quantize_model(model:VALLE, from_float:bool=True) -> VALLE:
+    '''
+    Dynamically quantize the attention projections and feedforward layers of every transformer layer to int8, in place.
+    With 'from_float=False' the int8 weights are left uninitialized, to load a quantized checkpoint.
+    '''
+    for module in list(model.modules()):
+        if isinstance(module, TransformerEncoderLayer):
+            module.quantize_dynamic_(from_float)
+    return model
+
+def quantized_checkpoint_path(VALLE_checkpoint:str) -> str:
+    '''
+    Path of the int8 checkpoint saved from 'VALLE_checkpoint'.
+    '''
+    return os.path.join(checkpoints_dir, os.path.splitext(VALLE_checkpoint)[0] + ".int8.pt")
+
+def autocast():
+    '''
+    Autocast context of the model calls, for the "bf16" precision.
+    '''
+    if model_precision == "bf16":
+        return torch.autocast(device.type, dtype=torch.bfloat16)
+    return nullcontext()
+
+def preload_models(VALLE_checkpoint:str="vallex-korean-checkpoint.pt", precision:str="fp32",
+                   attention_backend:str="math") -> None:
     '''
     Preload model, codec, vocos. Assign them as global variables instead of return.
     
@@ -53,15 +92,36 @@ def preload_models(VALLE_checkpoint:str="vallex-korean-checkpoint.pt") -> None:
         VALLE_checkpoint ('str'):
             Target checkpoint. 
             If it's unavailable & default, will download from hugginface.
+
+        precision ('str'):
+            "fp32", "bf16" to run VALL-E under bfloat16 autocast,
+            or "int8" to dynamically quantize its transformer layers (CPU only).
+            The int8 model is saved next to the checkpoint, and loaded from there afterwards.
+
+        attention_backend ('str'):
+            "math", or "sdpa" to run attention through 'torch.nn.functional.scaled_dot_product_attention'.
+            See 'modules.activation.set_attention_backend'.
     
     Assign global variables:
         model ('VALLE')
         codec ('AudioTokenizer')
         vocos ('Vocos')
+        model_version ('str')
+        model_precision ('str')
     '''
-    global model, codec, vocos
+    global model, codec, vocos, model_version, model_precision
+    if precision not in ("fp32", "bf16", "int8"):
+        raise ValueError(f"Unknown precision '{precision}', expected 'fp32', 'bf16' or 'int8'.")
+    if precision == "int8" and device.type != "cpu":
+        raise ValueError("int8 inference is only supported on CPU.")
+    if precision == "bf16" and device.type not in ("cpu", "cuda"):
+        raise ValueError(f"bf16 autocast is not supported on {device.type}.")
+    set_attention_backend(attention_backend)
+    model_precision = precision
     if not os.path.exists(checkpoints_dir): os.mkdir(checkpoints_dir)
-    if (not os.path.exists(os.path.join(checkpoints_dir, VALLE_checkpoint))):
+    quantized_path = quantized_checkpoint_path(VALLE_checkpoint)
+    load_quantized = precision == "int8" and os.path.exists(quantized_path)
+    if not load_quantized and not os.path.exists(os.path.join(checkpoints_dir, VALLE_checkpoint)):
         import wget
         try:
             logging.info(
@@ -88,12 +148,21 @@ def preload_models(VALLE_checkpoint:str="vallex-korean-checkpoint.pt") -> None:
         prepend_bos=True,
         num_quantizers=NUM_QUANTIZERS,
     ).to(device)
-    checkpoint = torch.load(os.path.join(checkpoints_dir, VALLE_checkpoint), map_location='cpu')
+    if load_quantized:
+        print(f"Loading int8 VALL-E from '{quantized_path}'..")
+        quantize_model(model, from_float=False)
+        checkpoint = torch.load(quantized_path, map_location='cpu')
+    else:
+        checkpoint = torch.load(os.path.join(checkpoints_dir, VALLE_checkpoint), map_location='cpu')
     missing_keys, unexpected_keys = model.load_state_dict(
         checkpoint, strict=True
     )
     assert not missing_keys
     model.eval()
+    if precision == "int8" and not load_quantized:
+        quantize_model(model)
+        torch.save(model.state_dict(), quantized_path)
+    model_version = VALLE_checkpoint if precision == "fp32" else f"{VALLE_checkpoint}:{precision}"
     
     # Encodec
     codec = AudioTokenizer(device)
@@ -101,9 +170,54 @@ def preload_models(VALLE_checkpoint:str="vallex-korean-checkpoint.pt") -> None:
     vocos = Vocos.from_pretrained('charactr/vocos-encodec-24khz').to(device)
 
     print("Loading Complete.")
-@torch.no_grad()
-def generate_audio(text, prompt_path, language='auto', accent='no-accent'):
-    global model, codec, vocos, text_tokenizer, text_collater
+def load_prompt(prompt_path):
+    '''
+    Load a prompt file as (audio_prompts on 'device', text_prompts, prompt language).
+    Memoized per file (inode, size, mtime), so that every line of a speaker shares one copy.
+    '''
+    stat = os.stat(prompt_path)
+    memo_key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if memo_key in prompt_memo:
+        prompt_memo.move_to_end(memo_key)
+        return prompt_memo[memo_key]
+    prompt_data = np.load(prompt_path)
+    audio_prompts = torch.tensor(prompt_data['audio_tokens']).type(torch.int32).to(device)
+    text_prompts = torch.tensor(prompt_data['text_tokens']).type(torch.int32)
+    lang_pr = code2lang[int(prompt_data['lang_code'])]
+    prompt_memo[memo_key] = (audio_prompts, text_prompts, lang_pr)
+    if len(prompt_memo) > prompt_memo_size:
+        prompt_memo.popitem(last=False)
+    return prompt_memo[memo_key]
+
+def to_frames(duration):
+    '''
+    Number of codec frames in 'duration' seconds, or 'None'.
+    '''
+    if duration is None:
+        return None
+    return max(int(duration * codec.codec.frame_rate), 1)
+
+def fade_out_if_cut(samples, n_frames, max_frames, text, fade_duration=0.05):
+    '''
+    If the speech of 'text' was cut at 'max_frames' before the model ended it, log it and
+    fade out its last 'fade_duration' seconds instead of stopping mid-word.
+    '''
+    if max_frames is None or n_frames < max_frames:
+        return samples
+    logging.warning(f"Speech cut at {max_frames / codec.codec.frame_rate:.2f}s, consider shortening the line: {text}")
+    n = min(int(fade_duration * SAMPLE_RATE), len(samples))
+    samples = samples.copy()
+    samples[len(samples) - n:] *= np.linspace(1, 0, n, dtype=samples.dtype)
+    return samples
+
+def prepare_inputs(text, prompt_path, language='auto', accent='no-accent'):
+    '''
+    Tokenize 'text' and load the prompt at 'prompt_path' ('None' for no prompt), as inputs of 'VALLE.inference'.
+
+    Returns:
+        'tuple': (text tokens of shape (1, S) with the text prompt first, number of text prompt tokens,
+            audio prompts on 'device', prompt language, text language(s)).
+    '''
     text = text.replace("\n", "").strip(" ")
     # detect language
     if language == "auto":
@@ -114,47 +228,107 @@ def generate_audio(text, prompt_path, language='auto', accent='no-accent'):
 
     # load prompt
     if prompt_path is not None:
-        prompt_data = np.load(prompt_path)
-        audio_prompts = prompt_data['audio_tokens']
-        text_prompts = prompt_data['text_tokens']
-        lang_pr = prompt_data['lang_code']
-        lang_pr = code2lang[int(lang_pr)]
-
-        # numpy to tensor
-        audio_prompts = torch.tensor(audio_prompts).type(torch.int32).to(device)
-        text_prompts = torch.tensor(text_prompts).type(torch.int32)
+        audio_prompts, text_prompts, lang_pr = load_prompt(prompt_path)
     else:
         audio_prompts = torch.zeros([1, 0, NUM_QUANTIZERS]).type(torch.int32).to(device)
         text_prompts = torch.zeros([1, 0]).type(torch.int32)
         lang_pr = lang if lang != 'mix' else 'en'
 
-    enroll_x_lens = text_prompts.shape[-1]
     logging.info(f"synthesize text: {text}")
     phone_tokens, langs = text_tokenizer.tokenize(text=f"_{text}".strip())
-    text_tokens, text_tokens_lens = text_collater(
+    text_tokens, _ = text_collater(
         [
             phone_tokens
         ]
     )
     text_tokens = torch.cat([text_prompts, text_tokens], dim=-1)
-    text_tokens_lens += enroll_x_lens
     # accent control
-    lang = lang if accent == "no-accent" else token2lang[langdropdown2token[accent]]
-    encoded_frames = model.inference(
-        text_tokens.to(device),
-        text_tokens_lens.to(device),
-        audio_prompts,
-        enroll_x_lens=enroll_x_lens,
-        temperature=1,
-        prompt_language=lang_pr,
-        text_language=langs if accent == "no-accent" else lang,
-    )
+    text_language = langs if accent == "no-accent" else token2lang[langdropdown2token[accent]]
+    return text_tokens, text_prompts.shape[-1], audio_prompts, lang_pr, text_language
+
+@torch.no_grad()
+def generate_audio(text, prompt_path, language='auto', accent='no-accent', return_codes=False,
+                   target_duration=None, max_duration=None):
+    '''
+    Synthesize 'text' in the voice of the prompt file at 'prompt_path'.
+    With 'return_codes', also return the generated codec tokens, of shape (1, T, 8).
+
+    'target_duration' (sec) steers the speech towards that length, and 'max_duration' (sec) cuts it,
+    e.g. the timestamps of the line to dub, so that it fits without changing the video speed.
+    A cut speech is faded out and logged, see 'fade_out_if_cut'.
+    '''
+    global model, codec, vocos
+    text_tokens, enroll_x_lens, audio_prompts, lang_pr, text_language = prepare_inputs(
+        text, prompt_path, language, accent)
+    max_frames = to_frames(max_duration)
+    with autocast():
+        encoded_frames = model.inference(
+            text_tokens.to(device),
+            torch.tensor([text_tokens.shape[-1]], device=device),
+            audio_prompts,
+            enroll_x_lens=enroll_x_lens,
+            temperature=1,
+            prompt_language=lang_pr,
+            text_language=text_language,
+            target_frames=to_frames(target_duration),
+            max_frames=max_frames,
+        )
     # Decode with Vocos
     frames = encoded_frames.permute(2,0,1)
     features = vocos.codes_to_features(frames)
     samples = vocos.decode(features, bandwidth_id=torch.tensor([2], device=device))
+    samples = fade_out_if_cut(samples.squeeze().cpu().numpy(), encoded_frames.shape[1], max_frames, text)
 
-    return samples.squeeze().cpu().numpy()
+    if return_codes:
+        return samples, encoded_frames.cpu()
+    return samples
+
+@torch.no_grad()
+def generate_audio_batch(texts, prompt_paths, language='auto', accent='no-accent',
+                         target_durations=None, max_durations=None):
+    """
+    Batched counterpart of 'generate_audio'.
+    Every text is synthesized with its own prompt, and the whole batch goes through the AR and NAR decoders together.
+    'target_durations' and 'max_durations' give the durations of 'generate_audio' per text ('None' for none).
+    Returns a list of waveforms in the order of 'texts'.
+    """
+    global model, codec, vocos, text_tokenizer, text_collater
+    assert len(texts) == len(prompt_paths)
+    if target_durations is None:
+        target_durations = [None] * len(texts)
+    if max_durations is None:
+        max_durations = [None] * len(texts)
+    x, y, enroll_x_lens, prompt_languages, text_languages = [], [], [], [], []
+    for text, prompt_path in zip(texts, prompt_paths):
+        text_tokens, enroll_x_len, audio_prompts, lang_pr, text_language = prepare_inputs(
+            text, prompt_path, language, accent)
+        x.append(text_tokens[0].to(device))
+        y.append(audio_prompts[0])
+        enroll_x_lens.append(enroll_x_len)
+        prompt_languages.append(lang_pr)
+        text_languages.append(text_language)
+
+    max_frames = [to_frames(d) for d in max_durations]
+    with autocast():
+        encoded_frames = model.batch_inference(
+            x,
+            y,
+            enroll_x_lens,
+            prompt_language=prompt_languages,
+            text_language=text_languages,
+            temperature=1,
+            target_frames=[to_frames(d) for d in target_durations],
+            max_frames=max_frames,
+        )
+    # Decode with Vocos
+    samples = []
+    for text, frames, limit in zip(texts, encoded_frames, max_frames):
+        n_frames = frames.shape[1]
+        frames = frames.permute(2,0,1)
+        features = vocos.codes_to_features(frames)
+        audio = vocos.decode(features, bandwidth_id=torch.tensor([2], device=device))
+        samples.append(fade_out_if_cut(audio.squeeze().cpu().numpy(), n_frames, limit, text))
+    return samples
 
 @torch.no_grad()
 def generate_audio_from_long_text(text, prompt=None, language='auto', accent='no-accent', mode='sliding-window'):
@@ -208,16 +382,17 @@ def generate_audio_from_long_text(text, prompt=None, language='auto', accent='no
             text_tokens_lens += enroll_x_lens
             # accent control
             lang = lang if accent == "no-accent" else token2lang[langdropdown2token[accent]]
-            encoded_frames = model.inference(
-                text_tokens.to(device),
-                text_tokens_lens.to(device),
-                audio_prompts,
-                enroll_x_lens=enroll_x_lens,
-                top_k=-100,
-                temperature=1,
-                prompt_language=lang_pr,
-                text_language=langs if accent == "no-accent" else lang,
-            )
+            with autocast():
+                encoded_frames = model.inference(
+                    text_tokens.to(device),
+                    text_tokens_lens.to(device),
+                    audio_prompts,
+                    enroll_x_lens=enroll_x_lens,
+                    top_k=-100,
+                    temperature=1,
+                    prompt_language=lang_pr,
+                    text_language=langs if accent == "no-accent" else lang,
+                )
             complete_tokens = torch.cat([complete_tokens, encoded_frames.transpose(2, 1)], dim=-1)
         # Decode with Vocos
         frames = complete_tokens.permute(1,0,2)
@@ -248,16 +423,17 @@ def generate_audio_from_long_text(text, prompt=None, language='auto', accent='no
             text_tokens_lens += enroll_x_lens
             # accent control
             lang = lang if accent == "no-accent" else token2lang[langdropdown2token[accent]]
-            encoded_frames = model.inference(
-                text_tokens.to(device),
-                text_tokens_lens.to(device),
-                audio_prompts,
-                enroll_x_lens=enroll_x_lens,
-                top_k=-100,
-                temperature=1,
-                prompt_language=lang_pr,
-                text_language=langs if accent == "no-accent" else lang,
-            )
+            with autocast():
+                encoded_frames = model.inference(
+                    text_tokens.to(device),
+                    text_tokens_lens.to(device),
+                    audio_prompts,
+                    enroll_x_lens=enroll_x_lens,
+                    top_k=-100,
+                    temperature=1,
+                    prompt_language=lang_pr,
+                    text_language=langs if accent == "no-accent" else lang,
+                )
             complete_tokens = torch.cat([complete_tokens, encoded_frames.transpose(2, 1)], dim=-1)
             if torch.rand(1) < 0.5:
                 audio_prompts = encoded_frames[:, :, -NUM_QUANTIZERS:]
@@ -0,0 +1,182 @@
+"""
+Quality regression of low-precision VALL-E inference against fp32.
+
+Sampled generations diverge at the first differing token, after which they mostly differ by sampling noise.
+So every text is compared on the same inputs, without sampling:
+    - the AR logits in the given precision, teacher-forced on the fp32 greedy output,
+      against the fp32 logits (greedy token agreement, KL divergence, max logit difference);
+    - the greedy outputs of both precisions (first divergence, token match, log-spectral distance).
+
+    python -m autodub.VALL_E_X.utils.precision_check --precision int8 --prompt prompt.npz --text "..." "..."
+"""
+import sys
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from . import generation
+from ..models.macros import NUM_AUDIO_TOKENS
+
+
+def compare_codes(reference:torch.Tensor, candidate:torch.Tensor) -> dict:
+    '''
+    Compare two code matrices of shape (1, T, 8).
+
+    Returns:
+        'dict': Number of frames of both, the first frame whose first-codebook token differs
+            ('None' if they are identical), and the rate of identical tokens over the common frames.
+    '''
+    n = min(reference.shape[1], candidate.shape[1])
+    same = reference[0, :n] == candidate[0, :n]
+    diverged = torch.nonzero(~same[:, 0])
+    if len(diverged):
+        first_divergence = int(diverged[0])
+    elif reference.shape[1] != candidate.shape[1]:
+        first_divergence = n
+    else:
+        first_divergence = None
+    return {
+        'frames': reference.shape[1],
+        'candidate_frames': candidate.shape[1],
+        'first_divergence': first_divergence,
+        'token_match': same.float().mean().item() if n else 0.,
+    }
+
+def compare_logits(reference:torch.Tensor, candidate:torch.Tensor) -> dict:
+    '''
+    Compare two sets of AR logits of shape (T, V), computed on the same inputs.
+
+    Returns:
+        'dict': Rate of positions where both pick the same greedy token, mean KL divergence
+            of the candidate from the reference distribution, and the largest logit difference.
+    '''
+    reference, candidate = reference.float(), candidate.float()
+    kl = F.kl_div(F.log_softmax(candidate, -1), F.log_softmax(reference, -1), log_target=True, reduction='none')
+    return {
+        'argmax_match': (reference.argmax(-1) == candidate.argmax(-1)).float().mean().item(),
+        'kl': kl.sum(-1).mean().item(),
+        'max_logit_diff': (reference - candidate).abs().max().item(),
+    }
+
+def compare_waveforms(reference:np.ndarray, candidate:np.ndarray, n_fft:int=1024, hop_length:int=256) -> dict:
+    '''
+    Compare two waveforms.
+
+    Returns:
+        'dict': Duration ratio (candidate / reference) and the log-spectral distance in dB over the common length.
+    '''
+    n = min(len(reference), len(candidate))
+    window = torch.hann_window(n_fft)
+    def log_spectrum(wav):
+        spec = torch.stft(torch.from_numpy(wav[:n]).float(), n_fft, hop_length, window=window, return_complex=True)
+        return 20 * torch.log10(spec.abs().clamp(min=1e-5))
+    lsd = (log_spectrum(reference) - log_spectrum(candidate)).pow(2).mean(0).sqrt().mean().item()
+    return {
+        'duration_ratio': len(candidate) / len(reference),
+        'log_spectral_distance': lsd,
+    }
+
+@torch.no_grad()
+def teacher_forced_logits(model, text_tokens:torch.Tensor, enroll_x_len:int, audio_prompts:torch.Tensor,
+                          prompt_language:str, text_language, codes:torch.Tensor) -> torch.Tensor:
+    '''
+    AR logits predicting every frame of 'codes' (shape (1, T, 8)) and the EOS after it, in one pass
+    over the prompt and 'codes', as 'VALLE.inference' computes them step by step.
+
+    Returns:
+        'torch.Tensor': Logits of shape (T + 1, NUM_AUDIO_TOKENS + 1).
+    '''
+    device = audio_prompts.device
+    x = model._embed_text(text_tokens.to(device), enroll_x_len, prompt_language, text_language)
+    y = torch.cat([audio_prompts[..., 0], codes[..., 0].to(device)], dim=1)
+    if model.ar_audio_prepend_bos:
+        y = F.pad(y, (1, 0), value=NUM_AUDIO_TOKENS + 1)
+    y_pos = model.ar_audio_position(model.ar_audio_prenet(model.ar_audio_embedding(y)))
+    xy_pos = torch.cat([x, y_pos], dim=1)
+
+    x_len, max_len = x.shape[1], xy_pos.shape[1]
+    mask = torch.triu(torch.ones(max_len, max_len, dtype=torch.bool, device=device), diagonal=1)
+    mask[:x_len, :x_len] = False
+    kv_cache = model.ar_decoder.allocate_kv_cache(1, max_len, device=device, dtype=xy_pos.dtype)
+    xy_dec, _ = model.ar_decoder.infer(xy_pos, mask=mask, kv_cache=kv_cache)
+    # The position of the last prompt frame predicts the first generated frame.
+    return model.ar_predict_layer(xy_dec[0, max_len - codes.shape[1] - 1:]).float()
+
+@torch.no_grad()
+def greedy_codes(text_tokens:torch.Tensor, enroll_x_len:int, audio_prompts:torch.Tensor,
+                 prompt_language:str, text_language) -> torch.Tensor:
+    '''
+    Deterministic ('top_k=1') counterpart of 'generation.generate_audio', on prepared inputs.
+    '''
+    return generation.model.inference(
+        text_tokens.to(generation.device),
+        torch.tensor([text_tokens.shape[-1]], device=generation.device),
+        audio_prompts,
+        enroll_x_lens=enroll_x_len,
+        top_k=1,
+        prompt_language=prompt_language,
+        text_language=text_language,
+    )
+
+@torch.no_grad()
+def decode(codes:torch.Tensor) -> np.ndarray:
+    features = generation.vocos.codes_to_features(codes.permute(2, 0, 1))
+    samples = generation.vocos.decode(features, bandwidth_id=torch.tensor([2], device=generation.device))
+    return samples.squeeze().cpu().numpy()
+
+def run(precision:str, prompt_path:str, texts:list,
+        VALLE_checkpoint:str="vallex-korean-checkpoint.pt", language:str='auto') -> list:
+    '''
+    Compare VALL-E in fp32 and in 'precision' on every text.
+
+    Returns:
+        'list': A dict per text with the results of 'compare_logits', 'compare_codes' and 'compare_waveforms'.
+    '''
+    generation.preload_models(VALLE_checkpoint, precision="fp32")
+    inputs = [generation.prepare_inputs(text, prompt_path, language) for text in texts]
+    references = []
+    for args in inputs:
+        codes = greedy_codes(*args)
+        references.append((codes, teacher_forced_logits(generation.model, *args, codes), decode(codes)))
+
+    generation.preload_models(VALLE_checkpoint, precision=precision)
+    results = []
+    for text, args, (reference_codes, reference_logits, reference_wav) in zip(texts, inputs, references):
+        with generation.autocast():
+            candidate_codes = greedy_codes(*args)
+            candidate_logits = teacher_forced_logits(generation.model, *args, reference_codes)
+            candidate_wav = decode(candidate_codes)
+        results.append({
+            'text': text,
+            **compare_logits(reference_logits, candidate_logits),
+            **compare_codes(reference_codes, candidate_codes),
+            **compare_waveforms(reference_wav, candidate_wav),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare low-precision VALL-E inference against fp32.")
+    parser.add_argument("--precision", choices=["bf16", "int8"], required=True)
+    parser.add_argument("--prompt", required=True, help="Prompt file (.npz).")
+    parser.add_argument("--text", nargs="+", required=True)
+    parser.add_argument("--checkpoint", default="vallex-korean-checkpoint.pt")
+    parser.add_argument("--language", default="auto")
+    parser.add_argument("--min-argmax-match", type=float, default=None,
+                        help="Fail if the mean teacher-forced greedy token agreement is lower.")
+    parser.add_argument("--max-lsd", type=float, default=None,
+                        help="Fail if the mean log-spectral distance (dB) of the greedy outputs is higher.")
+    args = parser.parse_args()
+
+    results = run(args.precision, args.prompt, args.text, args.checkpoint, args.language)
+    for r in results:
+        print(f"argmax_match={r['argmax_match']:.3f} kl={r['kl']:.2e} max_logit_diff={r['max_logit_diff']:.3f} "
+              f"frames={r['frames']}/{r['candidate_frames']} first_divergence={r['first_divergence']} "
+              f"token_match={r['token_match']:.3f} lsd={r['log_spectral_distance']:.2f}dB  {r['text']}")
+    argmax_match = np.mean([r['argmax_match'] for r in results])
+    lsd = np.mean([r['log_spectral_distance'] for r in results])
+    print(f"mean argmax_match={argmax_match:.3f} mean lsd={lsd:.2f}dB")
+
+    failed = (args.min_argmax_match is not None and argmax_match < args.min_argmax_match) \
+        or (args.max_lsd is not None and lsd > args.max_lsd)
+    sys.exit(1 if failed else 0)
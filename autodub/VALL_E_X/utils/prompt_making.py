@@ -13,6 +13,7 @@ from ..data.tokenizer import (
 )
 from ..data.collation import get_text_token_collater
 from .g2p import PhonemeBpeTokenizer
+from ...registry import use_whisper
 
 from ..macros import *
 
@@ -24,10 +25,18 @@ if torch.cuda.is_available():
     device = torch.device("cuda", 0)
 if torch.backends.mps.is_available():
     device = torch.device("mps")
-codec = AudioTokenizer(device)
+codec = None
+
+def load_codec() -> AudioTokenizer:
+    '''
+    Return the EnCodec tokenizer of the prompts, building it on first use.
+    '''
+    global codec
+    if codec is None:
+        codec = AudioTokenizer(device)
+    return codec
 
 if not os.path.exists("./whisper/"): os.mkdir("./whisper/")
-whisper_model = None
 
 @torch.no_grad()
 def transcribe_one(model, audio_path):
@@ -43,7 +52,7 @@ def transcribe_one(model, audio_path):
     print(f"Detected language: {max(probs, key=probs.get)}")
     lang = max(probs, key=probs.get)
     # decode the audio
-    options = whisper.DecodingOptions(temperature=1.0, best_of=5, fp16=False if device == torch.device("cpu") else True, sample_len=150)
+    options = whisper.DecodingOptions(temperature=1.0, best_of=5, fp16=model.device.type == "cuda", sample_len=150)
     result = whisper.decode(model, mel, options)
 
     # print the recognized text
@@ -55,7 +64,8 @@ def transcribe_one(model, audio_path):
     return lang, text_pr
 
 def make_prompt(name, audio_path, transcript=None) -> dict:
-    global model, text_collater, text_tokenizer, codec
+    global model, text_collater, text_tokenizer
+    codec = load_codec()
     wav_pr, sr = torchaudio.load(audio_path)
     # check length
     if wav_pr.size(-1) / sr > 15:
@@ -88,6 +98,88 @@ def make_prompt(name, audio_path, transcript=None) -> dict:
     return prompt
 
 
+@torch.no_grad()
+def make_prompts(name, wav, sr, segments, transcripts, max_batch_seconds=120.) -> list:
+    '''
+    Make the prompts of many segments of one decoded waveform.
+
+    Segments are sliced from 'wav' in memory, and encoded with 'AudioTokenizer.encode_batch'
+    in padded batches of up to 'max_batch_seconds' of audio instead of one call per segment.
+
+    Parameters:
+        wav ('torch.Tensor'): Source waveform of shape (channels, n_samples).
+
+        sr ('int'): Sample rate of 'wav'.
+
+        segments ('list'): (start, end) of each prompt in seconds.
+
+        transcripts ('list'): Transcript of each prompt. Missing ones are transcribed with Whisper.
+
+    Returns:
+        'list': A prompt dict per segment, as returned by 'make_prompt'.
+    '''
+    global text_collater, text_tokenizer
+    codec = load_codec()
+    if wav.size(0) == 2:
+        wav = wav.mean(0, keepdim=True)
+    clips = []
+    for start, end in segments:
+        if end - start > 15:
+            raise ValueError(f"Prompt too long, expect length below 15 seconds, got {end - start} seconds.")
+        clips.append(wav[:, round(start * sr):round(end * sr)])
+
+    codes = codec.encode_batch(clips, sr, max_batch_seconds=max_batch_seconds)
+    audio_tokens = [code[None].transpose(2, 1).cpu().numpy() for code in codes]
+
+    prompts = []
+    for clip, transcript, tokens in zip(clips, transcripts, audio_tokens):
+        text_pr, lang_pr = make_transcript(name, clip.clone(), sr, transcript)
+        phonemes, langs = text_tokenizer.tokenize(text=f"{text_pr}".strip())
+        text_tokens, enroll_x_lens = text_collater(
+            [
+                phonemes
+            ]
+        )
+        prompts.append({
+            'audio_tokens': tokens,
+            'text_tokens': text_tokens,
+            'lang_code': lang2code[lang_pr]
+        })
+    return prompts
+
+@torch.no_grad()
+def embed_segments(wav, sr, segments, max_seconds=15., max_batch_seconds=120.) -> np.ndarray:
+    '''
+    Embed segments of one decoded waveform for speaker clustering.
+
+    Each segment is encoded to EnCodec codes, the codes are mapped back to the quantized latent,
+    and the latent frames are pooled to their mean and standard deviation.
+
+    Parameters:
+        wav ('torch.Tensor'): Source waveform of shape (channels, n_samples).
+
+        sr ('int'): Sample rate of 'wav'.
+
+        segments ('list'): (start, end) of each segment in seconds.
+
+        max_seconds ('float'): Longer segments are embedded from their first 'max_seconds'.
+
+    Returns:
+        'np.ndarray': Embeddings of shape (len(segments), 2 * latent_dim).
+    '''
+    codec = load_codec()
+    if wav.size(0) == 2:
+        wav = wav.mean(0, keepdim=True)
+    clips = [wav[:, round(start * sr):round(min(end, start + max_seconds) * sr)] for start, end in segments]
+    codes = codec.encode_batch(clips, sr, max_batch_seconds=max_batch_seconds)
+
+    embeddings = []
+    for code in codes:
+        latent = codec.codec.quantizer.decode(code[:, None])[0]
+        embeddings.append(torch.cat([latent.mean(-1), latent.std(-1, unbiased=False)]).cpu().numpy())
+    return np.stack(embeddings)
+
+
 def make_transcript(name, wav, sr, transcript=None):
 
     if not isinstance(wav, torch.FloatTensor):
@@ -101,16 +193,12 @@ def make_transcript(name, wav, sr, transcript=None):
     assert wav.ndim and wav.size(0) == 1
     if transcript is None or transcript == "":
         logging.info("Transcript not given, using Whisper...")
-        global whisper_model
-        if whisper_model is None:
-            whisper_model = whisper.load_model("medium", download_root=os.path.join(os.getcwd(), "whisper"))
-        whisper_model.to(device)
         torchaudio.save(f"./prompts/{name}.wav", wav, sr)
-        lang, text = transcribe_one(whisper_model, f"./prompts/{name}.wav")
+        with use_whisper("medium") as whisper_model:
+            lang, text = transcribe_one(whisper_model, f"./prompts/{name}.wav")
         lang_token = lang2token[lang]
         text = lang_token + text + lang_token
         os.remove(f"./prompts/{name}.wav")
-        whisper_model.cpu()
     else:
         text = transcript
         lang, _ = langid.classify(text)
@@ -1,3 +1,4 @@
 from .VALL_E_X.utils.generation import preload_models
 from .stt import load_stt
-from .translator import load_translator
\ No newline at end of file
+from .translator import load_translator
+from .separator import load_separator
\ No newline at end of file
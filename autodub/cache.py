@@ -0,0 +1,137 @@
+import os
+import json
+import shutil
+import hashlib
+import pandas as pd
+
+
+def _remove(path:str) -> None:
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def _link(src:str, dst:str) -> None:
+    '''
+    Hard-link 'src' to 'dst' (recursively for directories), or copy when linking is not possible.
+    '''
+    if os.path.isdir(src):
+        os.makedirs(dst, exist_ok=True)
+        for name in os.listdir(src):
+            _link(os.path.join(src, name), os.path.join(dst, name))
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class StageCache:
+    def __init__(self, root:str="./results/.cache/"):
+        '''
+        Content-addressed cache of the outputs of pipeline stages.
+
+        Every stage has a key: a hash of its input bytes (or the keys of the stages it depends on),
+        its parameters and the version of its model. Outputs are stored under that key, and restored
+        instead of rerunning the stage when the key matches, whatever the title of the job.
+
+        Outputs are hard-linked between the cache and 'results'. Stages must therefore write fresh
+        files instead of overwriting in place, which 'run' ensures by removing outputs beforehand.
+        '''
+        self.root = root
+        self._digests = {}
+
+    def file_digest(self, path:str) -> str:
+        '''
+        SHA-256 of the file contents, memoized per (path, size, mtime).
+        '''
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._digests:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            self._digests[memo_key] = h.hexdigest()
+        return self._digests[memo_key]
+
+    @staticmethod
+    def data_digest(data:pd.DataFrame, columns:list) -> str:
+        '''
+        SHA-256 of the given columns of a script's data.
+        '''
+        records = data[columns].to_dict('records')
+        payload = json.dumps(records, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @staticmethod
+    def key(stage:str, *upstream:str, **params) -> str:
+        '''
+        Key of a stage from the digests/keys it depends on and its parameters (including model version).
+        '''
+        payload = json.dumps({'stage': stage, 'upstream': upstream, 'params': params},
+                             ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _entry(self, stage:str, key:str) -> str:
+        return os.path.join(self.root, stage, key)
+
+    def has(self, stage:str, key:str) -> bool:
+        return os.path.exists(os.path.join(self._entry(stage, key), "manifest.json"))
+
+    def restore(self, stage:str, key:str, outputs:dict) -> bool:
+        '''
+        Put the cached outputs of the stage in place. Returns False if the key is not cached.
+
+        Parameters:
+            outputs ('dict'): Name of each output in the cache -> path (file or directory) to restore it to.
+        '''
+        if not self.has(stage, key):
+            return False
+        entry = self._entry(stage, key)
+        for name, path in outputs.items():
+            _remove(path)
+            _link(os.path.join(entry, name), path)
+        return True
+
+    def store(self, stage:str, key:str, outputs:dict, value=None) -> None:
+        '''
+        Save the outputs of the stage, and an optional JSON-serializable 'value', under the key.
+        '''
+        entry = self._entry(stage, key)
+        tmp_entry = entry + ".tmp"
+        _remove(tmp_entry)
+        os.makedirs(tmp_entry)
+        for name, path in outputs.items():
+            _link(path, os.path.join(tmp_entry, name))
+        if value is not None:
+            with open(os.path.join(tmp_entry, "value.json"), 'w') as f:
+                json.dump(value, f, ensure_ascii=False)
+        with open(os.path.join(tmp_entry, "manifest.json"), 'w') as f:
+            json.dump({'stage': stage, 'outputs': list(outputs.keys())}, f)
+        _remove(entry)
+        os.replace(tmp_entry, entry)
+
+    def load(self, stage:str, key:str):
+        '''
+        Return the JSON value stored with the key, or None if it is not cached.
+        '''
+        if not self.has(stage, key):
+            return None
+        with open(os.path.join(self._entry(stage, key), "value.json")) as f:
+            return json.load(f)
+
+    def run(self, stage:str, key:str, outputs:dict, fn) -> bool:
+        '''
+        Restore the outputs if the key is cached, otherwise call 'fn()' to produce them and store them.
+        Returns True on a cache hit.
+        '''
+        if self.restore(stage, key, outputs):
+            print(f"[{stage}] Reusing cached outputs.")
+            return True
+        for path in outputs.values():
+            _remove(path)
+        fn()
+        self.store(stage, key, outputs)
+        return False
@@ -0,0 +1,292 @@
+import queue
+import threading
+from concurrent.futures import Future
+import torchaudio
+from tqdm import tqdm
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+from .VALL_E_X.utils.generation import generate_audio_batch
+from .script import MultilingualScript
+from .translator import Translator
+from .cache import StageCache
+from .tts import prepare_prompts, prepare_speaker_prompts, line_durations, speech_key, write_speech
+from .utils import segment_timing, render_segment, has_rendered
+
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name:str, fn, workers:int=1, batch_size:int|None=None):
+        '''
+        One step of 'run_pipeline'.
+
+        Parameters:
+            name ('str'): Name of the stage, shown when it fails.
+
+            fn: Called as 'fn(item) -> item', or as 'fn(items) -> items' when 'batch_size' is given.
+
+            workers ('int'): Number of threads running 'fn'. Use 1 for stages sharing a model.
+
+            batch_size ('int'): If given, 'fn' receives up to 'batch_size' items which are ready at once.
+        '''
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+
+
+def run_pipeline(items:list, stages:list, maxsize:int=8, desc:str|None=None) -> list:
+    '''
+    Stream 'items' through 'stages'.
+
+    Every stage runs in its own threads and hands its outputs to the next stage through a bounded queue,
+    so that an item moves on as soon as it is ready: ffmpeg processes, model inference and network requests
+    of different items overlap, and a slow stage holds back its producers instead of piling up outputs.
+
+    Parameters:
+        items ('list'): Inputs of the first stage.
+
+        stages ('list'): 'Stage's, in order.
+
+        maxsize ('int'): Capacity of each queue between stages.
+
+        desc ('str'): If given, show a progress bar of finished items.
+
+    Returns:
+        'list': Outputs of the last stage, in the order of 'items'.
+    '''
+    # Every item already exists, so the first queue holds them all and the first stage can fill its batches.
+    queues = [queue.Queue()] + [queue.Queue(maxsize) for _ in range(len(stages))]
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def feed():
+        for pos, item in enumerate(items):
+            put(queues[0], (pos, item))
+        put(queues[0], _DONE)
+
+    def work(stage, in_q, out_q, remaining):
+        try:
+            while True:
+                first = get(in_q)
+                if first is _DONE:
+                    break
+                batch = [first]
+                while stage.batch_size is not None and len(batch) < stage.batch_size:
+                    try:
+                        item = in_q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _DONE:
+                        put(in_q, item)
+                        break
+                    batch.append(item)
+
+                if stage.batch_size is None:
+                    outputs = [stage.fn(batch[0][1])]
+                else:
+                    outputs = stage.fn([item for _, item in batch])
+                for (pos, _), output in zip(batch, outputs):
+                    put(out_q, (pos, output))
+        except Exception as e:
+            errors.append(RuntimeError(f"Stage '{stage.name}' failed: {e!r}"))
+            errors[-1].__cause__ = e
+            stop.set()
+        finally:
+            # Let sibling workers see the end too; the last one to finish passes it downstream.
+            put(in_q, _DONE)
+            with remaining['lock']:
+                remaining['count'] -= 1
+                if remaining['count'] == 0:
+                    put(out_q, _DONE)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for stage, in_q, out_q in zip(stages, queues[:-1], queues[1:]):
+        remaining = {'count': stage.workers, 'lock': threading.Lock()}
+        for _ in range(stage.workers):
+            threads.append(threading.Thread(target=work, args=(stage, in_q, out_q, remaining), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    results = [None] * len(items)
+    with tqdm(total=len(items), desc=desc, disable=desc is None) as pbar:
+        while True:
+            item = get(queues[-1])
+            if item is _DONE:
+                break
+            pos, output = item
+            results[pos] = output
+            pbar.update(1)
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def dub_script(script:MultilingualScript,
+               target_language:str,
+               indices:list|None=None,
+               translator:Translator|None=None,
+               cache:StageCache|None=None,
+               clips:Future|None=None,
+               speaker_prompts:bool=False,
+               fit_duration:bool=True,
+               render_parts:bool|None=None,
+               batch_size:int=8,
+               maxsize:int=16,
+               num_translate_workers:int=4,
+               num_render_workers:int=2) -> MultilingualScript:
+    '''
+    Translate, prompt, synthesize and render the video part of each line, as one streaming pipeline.
+    Afterwards 'merge_clips_to_video(script, target_language, incremental=True)' only has to concatenate,
+    or merges every line in one pass on a first render.
+
+    Parameters:
+        script ('autodub.script.MultilingualScript'): Script with extracted clips.
+
+        target_language ('str'): Language to dub into.
+
+        indices ('list'): Lines to process, e.g. 'autodub.utils.changed_segments'. Defaults to every line.
+
+        translator ('autodub.translator.Translator'): If given, the lines are translated first.
+            Otherwise the script must already contain 'target_language'.
+
+        cache ('autodub.cache.StageCache'): Reuse prompts and speech whose inputs did not change.
+
+        clips ('concurrent.futures.Future'): Pending clip extraction. Lines are translated, prompted and
+            synthesized meanwhile, and video parts wait for it.
+
+        speaker_prompts ('bool'): Synthesize every line with the prompt of its speaker
+            ('autodub.tts.prepare_speaker_prompts') instead of a prompt made from the line itself.
+            Off by default: the clustering threshold is not tuned yet, and a wrong merge dubs one speaker
+            in the voice of another.
+
+        fit_duration ('bool'): Generate speech which fits the timestamps of its line
+            ('autodub.tts.line_durations'), so that the video keeps its speed.
+
+        render_parts ('bool'): Encode the video part of each line once its speech is ready. Defaults to
+            whether the script was rendered before ('autodub.utils.has_rendered'), like
+            'merge_clips_to_video(incremental=True)'.
+
+        batch_size ('int'): Maximum number of lines synthesized together.
+
+        maxsize ('int'): Capacity of each queue between stages.
+
+    Returns:
+        'autodub.script.MultilingualScript': The given script, with 'target_language' translations.
+    '''
+    if indices is None:
+        indices = list(script.data.index)
+    if render_parts is None:
+        render_parts = has_rendered(script, target_language)
+    if translator is None:
+        assert script.is_available(target_language)
+        # Feed lines by length so that ready lines form batches of similar lengths.
+        indices = sorted(indices, key=lambda idx: len(script.data.loc[idx, target_language]))
+    translations = {}
+    video_infos = ffmpeg_parse_infos(script.video_path)
+    video_duration, fps = video_infos['duration'], video_infos['video_fps']
+
+    def text_of(idx):
+        return translations[idx] if translator is not None else script.data.loc[idx, target_language]
+
+    def translate(batch):
+        # One call per batch, so that it is packed into the translator's batched requests.
+        lines = translator.translate_lines([script.data.loc[idx, 'source'] for idx in batch],
+                                           script.source_language,
+                                           target_language)
+        translations.update(zip(batch, lines))
+        return batch
+
+    source = []
+    def prompt(batch):
+        # The source waveform is decoded once, by the first batch which needs it.
+        if not source:
+            source.append(torchaudio.load(script.audio_path))
+        prepare_prompts(script, batch, cache, source=source[0])
+        return batch
+
+    def prompt_path(idx):
+        return script.output_dir + f"/prompt/prompt_{str(idx).zfill(6)}.npz"
+
+    def durations_of(idx):
+        return line_durations(script, idx, video_duration) if fit_duration else None
+
+    def synthesize(batch):
+        # Lines found in the cache skip the model, the others are generated together.
+        outputs = {}
+        todo = []
+        for idx in batch:
+            key = None
+            if cache is not None:
+                key = speech_key(cache, prompt_path(idx), text_of(idx), target_language, durations_of(idx))
+                output_path = script.output_dir + f"/audio/{target_language}/segment_{str(idx).zfill(6)}.wav"
+                if cache.restore('tts', key, {'segment.wav': output_path}):
+                    outputs[idx] = (idx, None, key)
+                    continue
+            todo.append((idx, key))
+        if todo:
+            durations = [durations_of(idx) or (None, None) for idx, _ in todo]
+            audio_arrays = generate_audio_batch([text_of(idx) for idx, _ in todo],
+                                                [prompt_path(idx) for idx, _ in todo],
+                                                language=target_language,
+                                                target_durations=[target for target, _ in durations],
+                                                max_durations=[limit for _, limit in durations])
+            for (idx, key), audio_array in zip(todo, audio_arrays):
+                outputs[idx] = (idx, audio_array, key)
+        return [outputs[idx] for idx in batch]
+
+    def write(item):
+        idx, audio_array, key = item
+        if audio_array is not None:
+            write_speech(script, target_language, idx, audio_array, cache, key)
+        return idx
+
+    def render(idx):
+        if clips is not None:
+            clips.result()
+        speed, slot = segment_timing(script, target_language, idx, video_duration)
+        render_segment(script, target_language, idx, speed, slot, fps)
+        return idx
+
+    stages = []
+    if translator is not None:
+        stages.append(Stage("translate", translate, workers=num_translate_workers,
+                            batch_size=translator.max_batch_size))
+    if speaker_prompts:
+        # Speakers are clustered over every line, so their prompts are made before streaming.
+        prepare_speaker_prompts(script, cache)
+    else:
+        stages.append(Stage("prompt", prompt, batch_size=batch_size))
+    stages += [
+        Stage("tts", synthesize, batch_size=batch_size),
+        Stage("write", write),
+    ]
+    if render_parts:
+        stages.append(Stage("render", render, workers=num_render_workers))
+    run_pipeline(indices, stages, maxsize=maxsize, desc="Dubbing lines..")
+
+    if translator is not None:
+        if not script.is_available(target_language):
+            script.data[target_language] = None
+        for idx, translation in translations.items():
+            script.data.loc[idx, target_language] = translation
+    return script
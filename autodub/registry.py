@@ -0,0 +1,114 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+import torch
+import whisper
+
+
+class ModelRegistry:
+    def __init__(self, idle_timeout:float=600., check_interval:float=30.):
+        '''
+        Models loaded once per process and shared by every caller.
+
+        A model is loaded on its first use, and unloaded once nobody has used it for 'idle_timeout' seconds.
+
+        Parameters:
+            idle_timeout ('float'): Seconds of idleness after which a model is unloaded. 'None' keeps models loaded.
+
+            check_interval ('float'): Seconds between checks for idle models.
+        '''
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    @contextmanager
+    def use(self, key, loader):
+        '''
+        Yield the model registered under 'key', calling 'loader()' to load it if needed.
+        The model is not unloaded while it is in use.
+        '''
+        with self._lock:
+            entry = self._entries.setdefault(key, {'model': None, 'users': 0, 'last_used': 0., 'lock': threading.Lock()})
+            entry['users'] += 1
+        try:
+            with entry['lock']:
+                if entry['model'] is None:
+                    entry['model'] = loader()
+            yield entry['model']
+        finally:
+            with self._lock:
+                entry['users'] -= 1
+                entry['last_used'] = time.monotonic()
+            self._start_watcher()
+
+    def evict_idle(self) -> None:
+        '''
+        Unload the models which are unused for longer than 'idle_timeout'.
+        '''
+        if self.idle_timeout is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for key in list(self._entries):
+                entry = self._entries[key]
+                if entry['users'] == 0 and now - entry['last_used'] > self.idle_timeout:
+                    del self._entries[key]
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def clear(self) -> None:
+        '''
+        Unload every model which is not in use.
+        '''
+        with self._lock:
+            for key in list(self._entries):
+                if self._entries[key]['users'] == 0:
+                    del self._entries[key]
+
+    def _start_watcher(self) -> None:
+        if self._watcher is not None or self.idle_timeout is None:
+            return
+        def watch():
+            while True:
+                time.sleep(self.check_interval)
+                self.evict_idle()
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=watch, daemon=True)
+                self._watcher.start()
+
+
+model_registry = ModelRegistry()
+
+
+def _load_whisper(name:str, device:str, int8:bool):
+    model = whisper.load_model(name, device="cpu" if int8 else device,
+                               download_root=os.path.join(os.getcwd(), "whisper"))
+    if int8:
+        # Whisper subclasses 'nn.Linear' only to cast weights to the input dtype, which is a no-op in fp32.
+        # Turn them back into plain 'nn.Linear' so that dynamic quantization recognizes them.
+        for module in model.modules():
+            if isinstance(module, torch.nn.Linear):
+                module.__class__ = torch.nn.Linear
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model.eval()
+
+def use_whisper(name:str="medium", device:str|None=None, int8:bool=False):
+    '''
+    Context manager yielding the shared Whisper model.
+
+    Parameters:
+        name ('str'): Whisper model size, e.g. "medium".
+
+        device ('str'): Device of the model. Defaults to CUDA if available, CPU otherwise.
+
+        int8 ('bool'): Use a copy with int8 dynamically quantized linear layers, on CPU.
+    '''
+    if int8:
+        device = "cpu"
+    elif device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return model_registry.use(("whisper", name, device, int8), lambda: _load_whisper(name, device, int8))
@@ -0,0 +1,299 @@
+import os
+import subprocess
+import numpy as np
+import librosa
+import soundfile as sf
+import torch
+from moviepy.config import get_setting
+from .vocal_remover.inference import Separator as MaskSeparator
+from .vocal_remover.lib import dataset
+from .vocal_remover.lib import nets
+from .vocal_remover.lib import spec_utils
+
+
+class _OverlapAdd:
+    '''
+    Incremental inverse STFT, equivalent to 'librosa.istft(center=True)' over all pushed frames.
+    '''
+    def __init__(self, n_fft:int, hop_length:int, channels:int):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.window = librosa.filters.get_window('hann', n_fft, fftbins=True)
+        # Samples still waiting for the next frames to overlap them.
+        self._carry = np.zeros((channels, n_fft - hop_length), dtype=np.float32)
+        self._carry_envelope = np.zeros(n_fft - hop_length, dtype=np.float32)
+        # Centering pads n_fft // 2 samples at the start, which are dropped.
+        self._to_trim = n_fft // 2
+        self._n_frames = 0
+        self._n_emitted = 0
+
+    def _normalize(self, y, envelope):
+        tiny = np.finfo(envelope.dtype).tiny
+        return y / np.where(envelope > tiny, envelope, 1.)
+
+    def _trim(self, y):
+        n = min(self._to_trim, y.shape[-1])
+        self._to_trim -= n
+        y = y[:, n:]
+        self._n_emitted += y.shape[-1]
+        return y
+
+    def push(self, spec:np.ndarray) -> np.ndarray:
+        '''
+        Add STFT frames of shape (channels, 1 + n_fft // 2, n_frames), and return the samples that no
+        later frame can overlap anymore.
+        '''
+        n = spec.shape[-1]
+        frames = np.fft.irfft(spec, n=self.n_fft, axis=1).astype(np.float32) * self.window[:, None]
+        y = np.zeros((frames.shape[0], n * self.hop_length + self._carry.shape[-1]), dtype=np.float32)
+        envelope = np.zeros(y.shape[-1], dtype=np.float32)
+        y[:, :self._carry.shape[-1]] += self._carry
+        envelope[:self._carry.shape[-1]] += self._carry_envelope
+        for k in range(n):
+            start = k * self.hop_length
+            y[:, start:start + self.n_fft] += frames[..., k]
+            envelope[start:start + self.n_fft] += self.window ** 2
+        self._n_frames += n
+
+        done = n * self.hop_length
+        self._carry, self._carry_envelope = y[:, done:], envelope[done:]
+        return self._trim(self._normalize(y[:, :done], envelope[:done]))
+
+    def flush(self) -> np.ndarray:
+        # 'librosa.istft' returns hop_length * (n_frames - 1) samples.
+        length = self.hop_length * (self._n_frames - 1)
+        y = self._trim(self._normalize(self._carry, self._carry_envelope))
+        return y[:, :max(0, y.shape[-1] - (self._n_emitted - length))]
+
+
+class Separator:
+    def __init__(self,
+                 pretrained_model:str="autodub/vocal_remover/models/baseline.pth",
+                 device:str|torch.device|None=None,
+                 sr:int=44100,
+                 n_fft:int=2048,
+                 hop_length:int=1024,
+                 batchsize:int=4,
+                 cropsize:int=256,
+                 tta:bool=False,
+                 postprocess:bool=False):
+        '''
+        Resident vocal/instrument separation service.
+        'nets.CascadedNet' is built and its weights are loaded once, then every call runs in-process.
+
+        Parameters:
+            pretrained_model ('str'): Path to vocal-remover weights.
+            device ('str' | 'torch.device'): Inference device. Use CUDA/MPS if available when not given.
+            sr, n_fft, hop_length, batchsize, cropsize, tta, postprocess:
+                Same as the options of 'vocal_remover/inference.py'.
+        '''
+        if device is None:
+            device = torch.device("cpu")
+            if torch.cuda.is_available():
+                device = torch.device("cuda", 0)
+            elif torch.backends.mps.is_available() and torch.backends.mps.is_built():
+                device = torch.device("mps")
+        self.device = torch.device(device)
+        self.pretrained_model = pretrained_model
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.tta = tta
+        self.postprocess = postprocess
+
+        model = nets.CascadedNet(n_fft, hop_length, 32, 128)
+        model.load_state_dict(torch.load(pretrained_model, map_location='cpu'))
+        model.to(self.device)
+        model.eval()
+        self._separator = MaskSeparator(
+            model=model,
+            device=self.device,
+            batchsize=batchsize,
+            cropsize=cropsize,
+            postprocess=postprocess
+        )
+
+    def load_wave(self, audio:str|os.PathLike|tuple|np.ndarray) -> np.ndarray:
+        '''
+        Return a stereo waveform of shape (2, n_samples) at 'self.sr'.
+
+        Parameters:
+            audio: Path to an audio file, '(wave, sr)' tuple, or a wave already sampled at 'self.sr'.
+        '''
+        if isinstance(audio, (str, os.PathLike)):
+            X, _ = librosa.load(
+                audio, sr=self.sr, mono=False, dtype=np.float32, res_type='kaiser_fast'
+            )
+        elif isinstance(audio, tuple):
+            X, sr = audio
+            X = np.asarray(X, dtype=np.float32)
+            if sr != self.sr:
+                X = librosa.resample(X, orig_sr=sr, target_sr=self.sr, res_type='kaiser_fast')
+        else:
+            X = np.asarray(audio, dtype=np.float32)
+
+        if X.ndim == 1:
+            # mono to stereo
+            X = np.asarray([X, X])
+        return X
+
+    def separate(self, audio:str|os.PathLike|tuple|np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Separate the audio into vocals and instruments.
+
+        Parameters:
+            audio: See 'load_wave'.
+
+        Returns:
+            'tuple[np.ndarray, np.ndarray]': (vocals, instruments), each of shape (2, n_samples) at 'self.sr'.
+        '''
+        X = self.load_wave(audio)
+        X_spec = spec_utils.wave_to_spectrogram(X, self.hop_length, self.n_fft)
+
+        if self.tta:
+            y_spec, v_spec = self._separator.separate_tta(X_spec)
+        else:
+            y_spec, v_spec = self._separator.separate(X_spec)
+
+        instruments = spec_utils.spectrogram_to_wave(y_spec, hop_length=self.hop_length)
+        vocals = spec_utils.spectrogram_to_wave(v_spec, hop_length=self.hop_length)
+        return vocals, instruments
+
+    def _stream_wave(self, audio_path:str|os.PathLike, block_size:int):
+        '''
+        Decode the audio with ffmpeg and yield stereo blocks of shape (2, block_size) at 'self.sr'.
+        '''
+        command = [get_setting("FFMPEG_BINARY"), "-hide_banner", "-loglevel", "error",
+                   "-i", str(audio_path), "-f", "f32le", "-ac", "2", "-ar", str(self.sr), "-"]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            while True:
+                data = process.stdout.read(block_size * 2 * 4)
+                if not data:
+                    break
+                yield np.frombuffer(data, dtype=np.float32).reshape(-1, 2).T
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    def _stream_spectrogram(self, audio_path:str|os.PathLike, block_frames:int):
+        '''
+        Yield STFT blocks of shape (2, 1 + n_fft // 2, n_frames), equal to
+        'spec_utils.wave_to_spectrogram' over the whole file when concatenated.
+        '''
+        window = librosa.filters.get_window('hann', self.n_fft, fftbins=True)
+        # Centered frames: n_fft // 2 zeros on both ends, as 'librosa.stft' pads.
+        pad = np.zeros((2, self.n_fft // 2), dtype=np.float32)
+        buffer = pad
+        for block in self._stream_wave(audio_path, block_frames * self.hop_length):
+            buffer = np.concatenate([buffer, block], axis=1)
+            if buffer.shape[-1] < self.n_fft:
+                continue
+            n = (buffer.shape[-1] - self.n_fft) // self.hop_length + 1
+            yield self._stft_frames(buffer, n, window)
+            buffer = buffer[:, n * self.hop_length:]
+        buffer = np.concatenate([buffer, pad], axis=1)
+        if buffer.shape[-1] >= self.n_fft:
+            n = (buffer.shape[-1] - self.n_fft) // self.hop_length + 1
+            yield self._stft_frames(buffer, n, window)
+
+    def _stft_frames(self, buffer, n, window):
+        frames = np.lib.stride_tricks.sliding_window_view(buffer, self.n_fft, axis=-1)
+        frames = frames[:, :n * self.hop_length:self.hop_length] * window
+        # (2, n, F) -> (2, F, n)
+        return np.fft.rfft(frames, axis=-1).astype(np.complex64).transpose(0, 2, 1)
+
+    def _predict_mask(self, X_window:np.ndarray, n_crops:int, roi_size:int, scale:float) -> np.ndarray:
+        '''
+        Run 'predict_mask' over the first 'n_crops' crops of the window, 'roi_size' frames apart.
+        Returns the mask of shape (2, F, n_crops * roi_size).
+        '''
+        cropsize, batchsize = self._separator.cropsize, self._separator.batchsize
+        X_mag = torch.from_numpy(np.abs(X_window[:, :, :(n_crops - 1) * roi_size + cropsize]) / scale)
+        # Strided views, as in 'Separator._separate'.
+        X_crops = X_mag.unfold(2, cropsize, roi_size).permute(2, 0, 1, 3)
+        mask = None
+        with torch.no_grad():
+            for i in range(0, n_crops, batchsize):
+                X_batch = X_crops[i:i + batchsize].to(self.device)
+                mask_batch = self._separator.model.predict_mask(X_batch)
+                mask_batch = mask_batch.permute(1, 2, 0, 3).flatten(2).cpu().numpy()
+                if mask is None:
+                    mask = np.empty(mask_batch.shape[:2] + (n_crops * roi_size,), dtype=mask_batch.dtype)
+                mask[:, :, i * roi_size:i * roi_size + mask_batch.shape[2]] = mask_batch
+        return mask
+
+    def separate_stream(self,
+                        audio_path:str|os.PathLike,
+                        vocals_path:str|os.PathLike,
+                        instruments_path:str|os.PathLike,
+                        chunk_seconds:float=30.) -> None:
+        '''
+        Separate an audio file into vocals and instruments, with memory bounded by 'chunk_seconds'
+        rather than by the length of the file.
+        The audio is decoded and transformed chunk by chunk, masks are predicted over a sliding window of
+        crops, and the output waves are written through an incremental overlap-add.
+        Returns the same waves as 'separate', except 'tta' and 'postprocess', which need the whole file.
+        Audio at another sample rate is resampled by ffmpeg here, but by librosa in 'separate', so the
+        waves then differ slightly.
+
+        Parameters:
+            audio_path ('str'): Path to the source audio.
+            vocals_path, instruments_path ('str'): Output wav paths.
+            chunk_seconds ('float'): Length of the audio decoded at once.
+        '''
+        if self.tta or self.postprocess:
+            raise ValueError("'tta' and 'postprocess' need the whole spectrogram. Use 'separate' instead.")
+        offset = self._separator.offset
+        block_frames = max(1, int(chunk_seconds * self.sr / self.hop_length))
+        _, _, roi_size = dataset.make_padding(0, self._separator.cropsize, offset)
+        self._separator.model.eval()
+
+        # 1st pass: the input is normalized by the peak magnitude of the whole spectrogram.
+        scale = max(np.abs(X_spec).max() for X_spec in self._stream_spectrogram(audio_path, block_frames))
+
+        # 2nd pass: crops start every 'roi_size' frames from the left padding, as in 'Separator._separate'.
+        n_bins = self.n_fft // 2 + 1
+        X_window = np.zeros((2, n_bins, offset), dtype=np.complex64)
+        instruments_ola = _OverlapAdd(self.n_fft, self.hop_length, 2)
+        vocals_ola = _OverlapAdd(self.n_fft, self.hop_length, 2)
+        with sf.SoundFile(instruments_path, 'w', samplerate=self.sr, channels=2) as instruments_file, \
+             sf.SoundFile(vocals_path, 'w', samplerate=self.sr, channels=2) as vocals_file:
+            def emit(X_window, n_crops, n_frames=None):
+                mask = self._predict_mask(X_window, n_crops, roi_size, scale)
+                X_spec = X_window[:, :, offset:offset + n_crops * roi_size]
+                if n_frames is not None:
+                    mask, X_spec = mask[:, :, :n_frames], X_spec[:, :, :n_frames]
+                y_spec, v_spec = self._separator._postprocess(X_spec, mask)
+                instruments_file.write(instruments_ola.push(y_spec).T)
+                vocals_file.write(vocals_ola.push(v_spec).T)
+
+            for X_spec in self._stream_spectrogram(audio_path, block_frames):
+                X_window = np.concatenate([X_window, X_spec], axis=2)
+                n_crops = (X_window.shape[2] - 2 * offset) // roi_size
+                if n_crops > 0:
+                    emit(X_window, n_crops)
+                    X_window = X_window[:, :, n_crops * roi_size:]
+
+            # Right padding for the remaining frames
+            n_frames = X_window.shape[2] - offset
+            if n_frames > 0:
+                n_crops = -(-n_frames // roi_size)
+                pad_r = n_crops * roi_size + 2 * offset - X_window.shape[2]
+                X_window = np.pad(X_window, ((0, 0), (0, 0), (0, pad_r)), mode='constant')
+                emit(X_window, n_crops, n_frames)
+            instruments_file.write(instruments_ola.flush().T)
+            vocals_file.write(vocals_ola.flush().T)
+
+
+_separator = None
+
+def load_separator(**kwargs) -> Separator:
+    '''
+    Return the process-wide 'Separator', loading it on the first call.
+    'kwargs' are passed to 'Separator' and only used on that first call.
+    '''
+    global _separator
+    if _separator is None:
+        _separator = Separator(**kwargs)
+    return _separator
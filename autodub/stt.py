@@ -1,12 +1,19 @@
 import os
+import time
+import uuid
+import tempfile
 from abc import  abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import requests
 import json
+import numpy as np
 import pandas as pd
 from moviepy.editor import VideoFileClip
 import whisper_timestamped as whisper
-from .utils import env, extract_audio_from_video
+from .utils import env, extract_audio_from_video, _run_ffmpeg
 from .script import MultilingualScript
+from .registry import use_whisper
 
 class STT:
     @abstractmethod
@@ -27,7 +34,16 @@ class STT:
     
 
 class ClovaSTT(STT):
-    def __init__(self):
+    # Responses worth retrying: rate limits and transient server errors.
+    _retry_status = {429, 500, 502, 503, 504}
+
+    def __init__(self,
+                 invoke_url:str|None=None,
+                 timeout:float=60.,
+                 max_retries:int=3,
+                 backoff:float=2.,
+                 poll_interval:float=5.,
+                 job_timeout:float=3600.):
         '''
         You must get below two parameters by your own CLOVA account
         Follow 'https://guide.ncloud-docs.com/docs/clovaspeech-spec'
@@ -35,11 +51,33 @@ class ClovaSTT(STT):
         
         CLOVA API Reference:
             https://api.ncloud-docs.com/docs/ai-application-service-clovaspeech-longsentence
+
+        Only the audio is uploaded, compressed and streamed in chunks. Recognition runs asynchronously
+        and its result is polled.
+
+        Parameters:
+            invoke_url ('str'): Overrides the invoke URL of env.yaml, e.g. with a local fake endpoint.
+
+            timeout ('float'): Timeout (sec) of each request.
+
+            max_retries ('int'): Retries of a request which failed transiently.
+
+            backoff ('float'): Base delay (sec) between retries, doubled every retry.
+
+            poll_interval ('float'): Delay (sec) between checks of the recognition job.
+
+            job_timeout ('float'): Give up on a recognition job after this many seconds.
         '''
         # Clova Speech invoke URL
-        self._invoke_url = env['CLOVA']['INVOKE_URL']
+        self._invoke_url = invoke_url if invoke_url is not None else env['CLOVA']['INVOKE_URL']
         # Clova Speech secret key
         self._secret = env['CLOVA']['SECRET']
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self._session = requests.Session()
         
         self._get_clova_langid = {
             "ko": "ko-KR",
@@ -48,7 +86,49 @@ class ClovaSTT(STT):
             'zh': 'zh-cn'
         }
 
-    def _call_clova_api(self, video_path:str, language:str):
+    def _request(self, method:str, url:str, make_data=None, **kwargs) -> requests.Response:
+        '''
+        Send a request, retrying on connection errors, rate limits and server errors.
+        'make_data()' is called for every attempt, so that streamed bodies start over.
+        '''
+        for attempt in range(self.max_retries + 1):
+            try:
+                data = make_data() if make_data is not None else None
+                response = self._session.request(method, url, data=data, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if response.status_code not in self._retry_status or attempt == self.max_retries:
+                    response.raise_for_status()
+                    return response
+            time.sleep(self.backoff * 2 ** attempt)
+
+    @staticmethod
+    def _extract_audio(video_path:str, audio_path:str) -> None:
+        '''
+        Extract the audio track as 16 kHz mono AAC, a small fraction of the size of the video.
+        '''
+        _run_ffmpeg(["-i", video_path, "-vn", "-ac", "1", "-ar", "16000", "-c:a", "aac", "-b:a", "64k", audio_path])
+
+    @staticmethod
+    def _multipart(params:dict, media_path:str, boundary:str, chunk_size:int=1 << 20):
+        '''
+        Multipart body streaming the media file in chunks; the file is closed once it is sent.
+        '''
+        yield (f"--{boundary}\r\n"
+               'Content-Disposition: form-data; name="params"\r\n'
+               "Content-Type: application/json\r\n\r\n").encode()
+        yield json.dumps(params, ensure_ascii=False).encode('UTF-8')
+        yield (f"\r\n--{boundary}\r\n"
+               f'Content-Disposition: form-data; name="media"; filename="{os.path.basename(media_path)}"\r\n'
+               "Content-Type: application/octet-stream\r\n\r\n").encode()
+        with open(media_path, 'rb') as f:
+            for block in iter(lambda: f.read(chunk_size), b''):
+                yield block
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    def _call_clova_api(self, video_path:str, language:str) -> dict:
         if not language in self._get_clova_langid.keys():
             raise ValueError(f"Unexpected language: {language}")
         else:
@@ -56,7 +136,7 @@ class ClovaSTT(STT):
 
         request_body = {
             'language': clova_langid,
-            'completion': 'sync',
+            'completion': 'async',
             'callback': None,
             'wordAlignment': True,
             'fullText': False
@@ -65,20 +145,34 @@ class ClovaSTT(STT):
             'Accept': 'application/json;UTF-8',
             'X-CLOVASPEECH-API-KEY': self._secret
         }
-        files = {
-            'media': open(video_path, 'rb'),
-            'params': (None, json.dumps(request_body, ensure_ascii=False).encode('UTF-8'), 'application/json')
-        }
-        response = requests.post(headers=headers, url=self._invoke_url + '/recognizer/upload', files=files)
-        return response
+        boundary = uuid.uuid4().hex
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            audio_path = os.path.join(tmp_dir, "media.m4a")
+            self._extract_audio(video_path, audio_path)
+            response = self._request(
+                'POST', self._invoke_url + '/recognizer/upload',
+                make_data=lambda: self._multipart(request_body, audio_path, boundary),
+                headers={**headers, 'Content-Type': f"multipart/form-data; boundary={boundary}"})
+        token = response.json()['token']
+
+        # Poll the recognition job
+        deadline = time.monotonic() + self.job_timeout
+        while True:
+            result = self._request('GET', self._invoke_url + f'/recognizer/{token}', headers=headers).json()
+            if result.get('result') == 'COMPLETED':
+                return result
+            if result.get('result') == 'FAILED':
+                raise RuntimeError(f"CLOVA recognition failed: {result.get('message')}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"CLOVA recognition did not complete in {self.job_timeout} seconds.")
+            time.sleep(self.poll_interval)
     
     def make_script_from_video(self, 
                                video_path:str, 
                                language:str, 
                                title:str,
                                ) -> MultilingualScript:
-        clova_response = self._call_clova_api(video_path, language)
-        result_dict = json.loads(clova_response.text)
+        result_dict = self._call_clova_api(video_path, language)
         
         audio_output_path = f'./results/{title}/audio/source.wav'
         if not os.path.exists(os.path.dirname(audio_output_path)):
@@ -102,9 +196,102 @@ class ClovaSTT(STT):
                                   data=data)
     
 
+def split_on_silence(audio:np.ndarray,
+                     sr:int=16000,
+                     chunk_seconds:float=60.,
+                     frame_seconds:float=0.03,
+                     min_silence:float=0.3,
+                     threshold_db:float=-40.) -> list:
+    '''
+    Split the audio into chunks of at most 'chunk_seconds', cutting in the middle of silences.
+    Chunks without any voice are dropped.
+
+    A frame is silent when its level is 'threshold_db' below the loudest frame.
+
+    Returns:
+        'list': (start, end) sample indices of the chunks.
+    '''
+    frame = int(sr * frame_seconds)
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return [(0, len(audio))] if len(audio) else []
+    rms = np.sqrt(np.mean(audio[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+    level = 20 * np.log10(rms + 1e-10)
+    silent = level < level.max() + threshold_db
+
+    # Cut candidates: middle of every silence of at least 'min_silence'
+    edges = np.diff(np.concatenate([[0], silent.astype(np.int8), [0]]))
+    run_starts, run_ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    long_runs = (run_ends - run_starts) * frame_seconds >= min_silence
+    cuts = ((run_starts[long_runs] + run_ends[long_runs]) // 2) * frame
+
+    chunk = int(sr * chunk_seconds)
+    chunks = []
+    start = 0
+    while start < len(audio):
+        if len(audio) - start <= chunk:
+            end = len(audio)
+        else:
+            candidates = cuts[(cuts > start) & (cuts <= start + chunk)]
+            end = int(candidates[-1]) if len(candidates) else start + chunk
+        if not silent[start // frame:max(end // frame, start // frame + 1)].all():
+            chunks.append((start, end))
+        start = end
+    return chunks
+
+def _transcribe_chunk(model_name:str, int8:bool, audio:np.ndarray, language:str) -> list:
+    # Runs in pool workers too; each process keeps its own model in the registry.
+    with use_whisper(model_name, int8=int8) as model:
+        return whisper.transcribe(model, audio, language, fp16=model.device.type == "cuda")["segments"]
+
+
 class WhisperSTT(STT):
-    def __init__(self):
-        pass
+    def __init__(self, model_name:str="medium", int8:bool=False,
+                 chunked:bool=False, chunk_seconds:float=60., num_workers:int=1):
+        '''
+        The model is shared through 'autodub.registry', so it is loaded once per process.
+
+        Parameters:
+            model_name ('str'): Whisper model size.
+
+            int8 ('bool'): Use the int8-quantized CPU variant of the model.
+
+            chunked ('bool'): Split long audio at silences and transcribe the chunks independently.
+
+            chunk_seconds ('float'): Maximum length of a chunk.
+
+            num_workers ('int'): Processes transcribing chunks in parallel, each with its own model.
+                Mostly useful on CPU, e.g. with 'int8'; with 1, chunks are transcribed in this process.
+        '''
+        self.model_name = model_name
+        self.int8 = int8
+        self.chunked = chunked
+        self.chunk_seconds = chunk_seconds
+        self.num_workers = num_workers
+
+    def _transcribe_chunked(self, audio:np.ndarray, language:str) -> list:
+        # 'load_audio' resamples to Whisper's 16 kHz
+        sr = 16000
+        chunks = split_on_silence(audio, sr=sr, chunk_seconds=self.chunk_seconds)
+        args = [(self.model_name, self.int8, audio[start:end], language) for start, end in chunks]
+        if self.num_workers > 1:
+            with ProcessPoolExecutor(max_workers=self.num_workers,
+                                     mp_context=multiprocessing.get_context("spawn")) as executor:
+                results = list(executor.map(_transcribe_chunk, *zip(*args)))
+        else:
+            results = [_transcribe_chunk(*arg) for arg in args]
+
+        # Shift the segments of each chunk back to the timeline of the whole audio
+        segments = []
+        for (start, end), chunk_segments in zip(chunks, results):
+            offset, duration = start / sr, (end - start) / sr
+            for segment in chunk_segments:
+                segments.append({
+                    'start': offset + min(float(segment['start']), duration),
+                    'end': offset + min(float(segment['end']), duration),
+                    'text': segment['text'],
+                })
+        return segments
 
     def make_script_from_video(self, video_path: str, language: str, title: str) -> MultilingualScript:
         
@@ -114,11 +301,13 @@ class WhisperSTT(STT):
             os.makedirs(os.path.dirname(audio_output_path))
         audio = whisper.load_audio(audio_output_path)
         
-        model = whisper.load_model("medium", download_root=os.path.join(os.getcwd(), "whisper"))
-        result_dict = whisper.transcribe(model, audio, language)
+        if self.chunked:
+            segments = self._transcribe_chunked(audio, language)
+        else:
+            segments = _transcribe_chunk(self.model_name, self.int8, audio, language)
 
         data = []
-        for segment in result_dict["segments"]:
+        for segment in segments:
 
             data.append({
                 'start': int(float(segment['start']) * 1000),
@@ -1,23 +1,274 @@
 import os
+import re
+import time
+import random
+import asyncio
+import sqlite3
+import threading
+import unicodedata
+import weakref
 from abc import abstractmethod
 import json
-import requests
+import httpx
 import pandas as pd
 from .utils import env
 from .script import MultilingualScript
 
+# Responses worth retrying: rate limits and transient server errors.
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def run_sync(coroutine):
+    '''
+    Run a coroutine from synchronous code and return its result.
+
+    The coroutine runs on a background event loop shared by the process, so this also works
+    from threads whose own event loop is already running (e.g. a Gradio handler).
+    '''
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _loop).result()
+
+
+class TranslationMemory:
+    def __init__(self, path:str="./results/.cache/translation_memory.sqlite3", max_entries:int=200_000):
+        '''
+        Disk-backed memory of past translations, shared by every 'Translator'.
+
+        Entries are keyed by provider, source language, target language and normalized source text.
+        When there are more than 'max_entries', the least recently used ones are evicted.
+
+        Parameters:
+            path ('str'): SQLite database file.
+
+            max_entries ('int'): Maximum number of translations kept.
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS translations ("
+                "provider TEXT, source_language TEXT, target_language TEXT, source_text TEXT, "
+                "translation TEXT, last_used REAL, "
+                "PRIMARY KEY (provider, source_language, target_language, source_text))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS last_used_index ON translations (last_used)")
+
+    @staticmethod
+    def normalize(text:str) -> str:
+        '''
+        Unicode-normalize the text and collapse its whitespace.
+        '''
+        return re.sub(r"\s+", " ", unicodedata.normalize('NFC', text)).strip()
+
+    def get(self, provider:str, source_language:str, target_language:str, source_texts:list) -> list:
+        '''
+        Return the remembered translation of each text, or None where there is none.
+        '''
+        keys = [self.normalize(text) for text in source_texts]
+        with self._lock:
+            found = {}
+            for key in set(keys):
+                row = self._conn.execute(
+                    "SELECT translation FROM translations WHERE provider=? AND source_language=? "
+                    "AND target_language=? AND source_text=?",
+                    (provider, source_language, target_language, key)).fetchone()
+                if row is not None:
+                    found[key] = row[0]
+            with self._conn:
+                self._conn.executemany(
+                    "UPDATE translations SET last_used=? WHERE provider=? AND source_language=? "
+                    "AND target_language=? AND source_text=?",
+                    [(time.time(), provider, source_language, target_language, key) for key in found])
+            translations = [found.get(key) for key in keys]
+            hits = sum(translation is not None for translation in translations)
+            self.hits += hits
+            self.misses += len(translations) - hits
+        return translations
+
+    def put(self, provider:str, source_language:str, target_language:str, source_texts:list, translations:list) -> None:
+        '''
+        Remember the translations, evicting the least recently used ones beyond 'max_entries'.
+        '''
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?, ?)",
+                [(provider, source_language, target_language, self.normalize(text), translation, now)
+                 for text, translation in zip(source_texts, translations)])
+            self._conn.execute(
+                "DELETE FROM translations WHERE rowid IN (SELECT rowid FROM translations "
+                "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
 
 class Translator:
-    @abstractmethod
+    # Name of the provider in the translation memory.
+    name = None
+    # Lines packed into one request, and the size (bytes) of their texts.
+    max_batch_size = 1
+    max_batch_bytes = 5000
+
+    def __init__(self, max_workers:int=4, max_retries:int=5, backoff:float=1., timeout:float=30.,
+                 memory:TranslationMemory|None=None):
+        '''
+        Parameters:
+            max_workers ('int'): Number of requests in flight at once.
+
+            max_retries ('int'): Retries of a request which was rate-limited or failed transiently.
+
+            backoff ('float'): Base delay (sec) between retries, doubled every retry unless the
+                server asks for a delay with 'Retry-After'.
+
+            timeout ('float'): Timeout (sec) of a request.
+
+            memory ('TranslationMemory'): Translation memory to reuse; lines found in it are not requested.
+                Defaults to the shared memory of the process.
+        '''
+        self.memory = memory if memory is not None else load_translation_memory()
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _async_client(self) -> httpx.AsyncClient:
+        '''
+        Async client of the running event loop, with a pool of 'max_workers' connections.
+        '''
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            limits = httpx.Limits(max_connections=self.max_workers, max_keepalive_connections=self.max_workers)
+            client = httpx.AsyncClient(limits=limits, timeout=self.timeout)
+            self._clients[loop] = client
+        return client
+
+    async def _apost(self, url:str, **kwargs) -> httpx.Response:
+        '''
+        POST through the pooled client of the running event loop, backing off on rate limits and transient errors.
+        '''
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._async_client().post(url, **kwargs)
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = None
+            else:
+                if response.status_code not in _RETRY_STATUS or attempt == self.max_retries:
+                    return response
+                retry_after = response.headers.get('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                delay = self.backoff * 2 ** attempt
+            await asyncio.sleep(delay + random.uniform(0, self.backoff))
+
+    async def aclose(self) -> None:
+        '''
+        Close the async client of the running event loop.
+        '''
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
     def translate_text(self, source_text:str, source_language:str, target_language:str) -> str:
         """
-        Translate 'source_text' from 'source_language' to 'target_language'
+        Translate 'source_text' from 'source_language' to 'target_language', through the translation memory.
+        """
+        return self.translate_lines([source_text], source_language, target_language)[0]
+
+    @abstractmethod
+    def translate_texts(self, source_texts:list, source_language:str, target_language:str) -> list:
+        """
+        Request the translation of one batch of texts, packed by 'translate_lines'.
+        The translation memory is not consulted; use 'translate_lines' or 'translate_text' instead.
         """
         pass
+
+    async def atranslate_texts(self, source_texts:list, source_language:str, target_language:str) -> list:
+        """
+        Async counterpart of 'translate_texts'. Translators with an async client override this;
+        by default 'translate_texts' runs in a worker thread.
+        """
+        return await asyncio.to_thread(self.translate_texts, source_texts, source_language, target_language)
+
+    def _pack(self, source_texts:list) -> list:
+        '''
+        Group consecutive texts into batches within 'max_batch_size' and 'max_batch_bytes'.
+        '''
+        batches = []
+        batch, batch_bytes = [], 0
+        for text in source_texts:
+            text_bytes = len(text.encode('utf-8'))
+            if batch and (len(batch) == self.max_batch_size or batch_bytes + text_bytes > self.max_batch_bytes):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(text)
+            batch_bytes += text_bytes
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def atranslate_lines(self, source_texts:list, source_language:str, target_language:str) -> list:
+        """
+        Translate many lines with batched requests, 'max_workers' of them in flight at once.
+        Lines found in the translation memory, and repeated lines, are not requested again.
+        The translations are returned in the order of 'source_texts'.
+        """
+        source_texts = list(source_texts)
+        # SQLite queries block, so they run in a worker thread instead of stalling the event loop.
+        translations = await asyncio.to_thread(self.memory.get, self.name, source_language, target_language,
+                                               source_texts)
+
+        # Request each missing line once
+        missing = {}
+        for text, translation in zip(source_texts, translations):
+            if translation is None:
+                missing.setdefault(self.memory.normalize(text), text)
+        semaphore = asyncio.Semaphore(self.max_workers)
+        async def translate_batch(batch):
+            async with semaphore:
+                return await self.atranslate_texts(batch, source_language, target_language)
+        results = await asyncio.gather(*map(translate_batch, self._pack(list(missing.values()))))
+        requested = [translation for batch_translations in results for translation in batch_translations]
+        await asyncio.to_thread(self.memory.put, self.name, source_language, target_language,
+                                list(missing.values()), requested)
+
+        requested = dict(zip(missing.keys(), requested))
+        return [translation if translation is not None else requested[self.memory.normalize(text)]
+                for text, translation in zip(source_texts, translations)]
+
+    def translate_lines(self, source_texts:list, source_language:str, target_language:str) -> list:
+        """
+        Synchronous adapter of 'atranslate_lines'.
+        """
+        return run_sync(self.atranslate_lines(source_texts, source_language, target_language))
+
+    async def atranslate_text(self, source_text:str, source_language:str, target_language:str) -> str:
+        """
+        Async counterpart of 'translate_text', through the translation memory.
+        """
+        return (await self.atranslate_lines([source_text], source_language, target_language))[0]
         
-    def translate_script(self, 
-                         script:MultilingualScript, 
-                         target_language:str) -> MultilingualScript:
+    async def atranslate_script(self,
+                                script:MultilingualScript,
+                                target_language:str) -> MultilingualScript:
         """
         1. Translate each lines in the script
         2. Add translations to given script instance.
@@ -33,25 +284,28 @@ class Translator:
             'autodub.script.MultilingualScript':
                 Return the given script back, with new 'target_language' added.
         """
-        translations = []
-        
         # 1.Translate each lines in the script
-        for idx, row in script.data.iterrows():
-            # translate each sentence
-            source_text = row['source']
-            translations.append(self.translate_text(
-                source_text, 
-                script.source_language, 
-                target_language
-                ))
+        translations = await self.atranslate_lines(script.data['source'].tolist(),
+                                                   script.source_language,
+                                                   target_language)
 
         # 2.Add translations to given script instance.
         script.data[target_language] = translations
         return script
+
+    def translate_script(self,
+                         script:MultilingualScript,
+                         target_language:str) -> MultilingualScript:
+        """
+        Synchronous adapter of 'atranslate_script'.
+        """
+        return run_sync(self.atranslate_script(script, target_language))
     
 
 class PapagoTranslator(Translator):
-    def __init__(self):
+    name = "PAPAGO"
+
+    def __init__(self, url:str='https://openapi.naver.com/v1/papago/n2mt', **kwargs):
         '''
         You must prepare "ID" & "SECERET" from your own PAPAGO account
         Follow 'https://developers.naver.com/docs/papago/papago-nmt-overview.md'
@@ -59,12 +313,18 @@ class PapagoTranslator(Translator):
         
         PAPAGO API Reference:
             'https://developers.naver.com/docs/papago/papago-nmt-api-reference.md'
+
+        Parameters:
+            url ('str'): Endpoint of the API, e.g. a local mock server.
+
+            **kwargs: Request settings of 'Translator'.
         '''
+        super().__init__(**kwargs)
         # PAPAGO Client ID
         self._id = env['PAPAGO']['ID']
         # PAPAGO Client Secret
         self._secret =  env['PAPAGO']['SECRET']
-        self._url = 'https://openapi.naver.com/v1/papago/n2mt'
+        self._url = url
         self._get_papago_langid = {
             "ko": 'ko',
             'en': 'en',
@@ -72,10 +332,13 @@ class PapagoTranslator(Translator):
             'zh': 'zh-CN'
         }
 
-    def translate_text(self, source_text:str, source_language:str, target_language:str) -> str:
-        return self._call_papago_api(source_text, source_language, target_language)
-    
-    def _call_papago_api(self, text:str, source_language:str, target_language:str) -> str:
+    def translate_texts(self, source_texts:list, source_language:str, target_language:str) -> list:
+        return run_sync(self.atranslate_texts(source_texts, source_language, target_language))
+
+    async def atranslate_texts(self, source_texts:list, source_language:str, target_language:str) -> list:
+        return [await self._acall_papago_api(text, source_language, target_language) for text in source_texts]
+
+    def _papago_request(self, text:str, source_language:str, target_language:str) -> tuple:
         source_langid = self._get_papago_langid[source_language]
         target_langid = self._get_papago_langid[target_language]
         
@@ -85,8 +348,10 @@ class PapagoTranslator(Translator):
         'X-Naver-Client-Secret': self._secret
         }
         data = {'source': source_langid, 'target': target_langid, 'text': text}
-        response = requests.post(self._url, json.dumps(data), headers=headers).json()
-        
+        return headers, json.dumps(data)
+
+    @staticmethod
+    def _papago_result(response:dict) -> str:
         if not 'message' in response.keys():
             print(response)
             raise AssertionError()
@@ -95,8 +360,19 @@ class PapagoTranslator(Translator):
             
         return result
 
+    async def _acall_papago_api(self, text:str, source_language:str, target_language:str) -> str:
+        headers, body = self._papago_request(text, source_language, target_language)
+        response = (await self._apost(self._url, content=body, headers=headers)).json()
+        return self._papago_result(response)
+
 class DeepLTranslator(Translator):
-    def __init__(self):
+    name = "DEEPL"
+
+    # DeepL takes up to 50 'text' parameters per request, and request bodies up to 128 KiB.
+    max_batch_size = 50
+    max_batch_bytes = 120 * 1024
+
+    def __init__(self, url:str='https://api-free.deepl.com/v2/translate', **kwargs):
         '''
         You must prepare "AUTH_KEY" from your own DeepL account
         Follow 'https://www.deepl.com/docs-api/translating-text/request/'
@@ -104,10 +380,16 @@ class DeepLTranslator(Translator):
         
         DeepL API Reference:
             'https://www.deepl.com/docs-api/translating-text/request/'
+
+        Parameters:
+            url ('str'): Endpoint of the API, e.g. a local mock server.
+
+            **kwargs: Request settings of 'Translator'.
         '''
+        super().__init__(**kwargs)
         # DeepL API Auth Key
         self._auth_key = env['DEEPL']['AUTH_KEY']
-        self._url = 'https://api-free.deepl.com/v2/translate'
+        self._url = url
         self._get_deepl_langid = {
             "ko": 'KO',
             'en': 'EN',
@@ -115,10 +397,13 @@ class DeepLTranslator(Translator):
             'zh': 'ZH'
         }
 
-    def translate_text(self, source_text:str, source_language:str, target_language:str) -> str:
-        return self._call_deepl_api(source_text, source_language, target_language)
-    
-    def _call_deepl_api(self, text:str, source_language:str, target_language:str) -> str:
+    def translate_texts(self, source_texts:list, source_language:str, target_language:str) -> list:
+        return run_sync(self.atranslate_texts(source_texts, source_language, target_language))
+
+    async def atranslate_texts(self, source_texts:list, source_language:str, target_language:str) -> list:
+        return await self._acall_deepl_api(source_texts, source_language, target_language)
+
+    def _deepl_request(self, texts:list, source_language:str, target_language:str) -> tuple:
         source_langid = self._get_deepl_langid[source_language]
         target_langid = self._get_deepl_langid[target_language]
         
@@ -127,20 +412,38 @@ class DeepLTranslator(Translator):
         }
         data = {
             'auth_key': self._auth_key,
-            'text': text,
+            'text': texts,
             'source_lang': source_langid,
             'target_lang': target_langid,
         }
-        response = requests.post(self._url, data=data, headers=headers).json()
-        
+        return headers, data
+
+    @staticmethod
+    def _deepl_result(response:dict) -> list:
         if not 'translations' in response.keys():
             print(response)
             raise AssertionError()
         else:
-            result = response['translations'][0]['text']
+            result = [translation['text'] for translation in response['translations']]
             
         return result    
     
+    async def _acall_deepl_api(self, texts:list, source_language:str, target_language:str) -> list:
+        headers, data = self._deepl_request(texts, source_language, target_language)
+        response = (await self._apost(self._url, data=data, headers=headers)).json()
+        return self._deepl_result(response)
+
+_translation_memory = None
+
+def load_translation_memory() -> TranslationMemory:
+    '''
+    Return the translation memory of the process, opening it on first use.
+    '''
+    global _translation_memory
+    if _translation_memory is None:
+        _translation_memory = TranslationMemory()
+    return _translation_memory
+
 def load_translator(name:'str') -> Translator:
     '''
     Instansiate one of 'Translator' classes
@@ -1,12 +1,18 @@
 import os
 import glob
+import shutil
 import numpy as np
 import pandas as pd
+import torchaudio
 from tqdm import tqdm
 from scipy.io.wavfile import write as write_wav
-from .VALL_E_X.utils.prompt_making import make_prompt
-from .VALL_E_X.utils.generation import SAMPLE_RATE, generate_audio
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import squareform
+from .VALL_E_X.utils.prompt_making import make_prompts, embed_segments
+from .VALL_E_X.utils import generation
+from .VALL_E_X.utils.generation import SAMPLE_RATE, generate_audio_batch
 from .script import MultilingualScript
+from .cache import StageCache
 
 
 def enhance_speech(audio_clip_dir:str|os.PathLike):
@@ -16,48 +22,300 @@ def enhance_speech(audio_clip_dir:str|os.PathLike):
     '''
     raise NotImplementedError()
 
-def prepare_prompts(script:MultilingualScript, enhance:bool=False):
+def prepare_prompts(script:MultilingualScript,
+                    indices:list|None=None,
+                    cache:StageCache|None=None,
+                    source:tuple|None=None,
+                    enhance:bool=False):
     '''
     Generate and save prompt files.
+
+    The prompts are sliced by the timestamps of the lines from the source waveform, decoded once,
+    and tokenized together in padded batches.
     
     Parameters:
-        script ('autodub.script.MultilingualScript'): To get audioClip_dir and transcripts.
+        script ('autodub.script.MultilingualScript'): To get the source audio, timestamps and transcripts.
+
+        indices ('list'): Lines to make prompts for. Defaults to every line.
+
+        cache ('autodub.cache.StageCache'): If given, a prompt is only made when its audio or transcript changed.
+
+        source ('tuple'): '(wav, sr)' of the source audio, if it is already loaded.
 
         enhance ('bool'): Whether or not to use speech enhancement
     '''
     audio_clip_dir = script.output_dir + "/audio/source/"
     prompt_dir = script.output_dir + "/prompt/"
     os.makedirs(prompt_dir, exist_ok=True)
-    
-    for idx, row in tqdm(script.data.iterrows(), total=len(script), desc="Generating prompts.."):
-        audio_clip_path = audio_clip_dir + f"/segment_{str(idx).zfill(6)}.wav"
+    if enhance:
+        enhance_speech(audio_clip_dir)
+    if indices is None:
+        indices = script.data.index
+
+    keys = {}
+    todo = []
+    for idx in indices:
+        prompt_path = prompt_dir + f"/prompt_{str(idx).zfill(6)}.npz"
+        if cache is not None:
+            row = script.data.loc[idx]
+            keys[idx] = cache.key('prompt', cache.file_digest(script.audio_path),
+                                  start=row['start'], end=row['end'], transcript=row['source'])
+            if cache.restore('prompt', keys[idx], {'prompt.npz': prompt_path}):
+                continue
+        todo.append(idx)
+    if not todo:
+        return
+
+    if source is None:
+        source = torchaudio.load(script.audio_path)
+    prompts = make_prompts(name=script.title,
+                           wav=source[0],
+                           sr=source[1],
+                           segments=[(script.data.loc[idx, 'start'] / 1000, script.data.loc[idx, 'end'] / 1000) for idx in todo],
+                           transcripts=[script.data.loc[idx, 'source'] for idx in todo])
+    for idx, prompt in zip(todo, prompts):
         prompt_path = prompt_dir + f"/prompt_{str(idx).zfill(6)}.npz"
-        if enhance:
-            enhance_speech(audio_clip_dir)
-            
-        print(f'row is {row}. tts.py line 39')
-        prompt = make_prompt(
-                    name=script.title,
-                    audio_path=audio_clip_path,
-                    transcript=row['source']
-                    )
+        # The previous file may be linked to a cache entry; never write through it.
+        if os.path.exists(prompt_path):
+            os.remove(prompt_path)
         np.savez(prompt_path, **prompt)
+        if cache is not None:
+            cache.store('prompt', keys[idx], {'prompt.npz': prompt_path})
 
+def cluster_speakers(embeddings:np.ndarray, threshold:float=0.8, num_speakers:int|None=None) -> np.ndarray:
+    '''
+    Group segment embeddings by speaker with average-linkage agglomerative clustering on cosine similarity.
 
-def generate_translated_speech(script:MultilingualScript, target_language:str):
-    assert script.is_available(target_language)
-    
+    Parameters:
+        embeddings ('np.ndarray'): Embedding of each segment, of shape (n_segments, dim).
+
+        threshold ('float'): Clusters are merged while their average similarity is above it.
+
+        num_speakers ('int'): If given, merge until exactly this many clusters remain instead.
+
+    Returns:
+        'np.ndarray': Speaker label of each segment, numbered by first appearance.
+    '''
+    n = len(embeddings)
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    # Center the embeddings so that what every segment shares (e.g. the recording) does not dominate.
+    embeddings = embeddings - embeddings.mean(0, keepdims=True)
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=-1, keepdims=True), 1e-8)
+    distance = np.clip(1 - embeddings @ embeddings.T, 0, 2)
+    np.fill_diagonal(distance, 0)
+    if n == 1:
+        labels = np.zeros(1, dtype=int)
+    else:
+        # Average linkage on cosine distance: clusters merge while their average similarity is above 'threshold'.
+        tree = linkage(squareform(distance, checks=False), method='average')
+        if num_speakers is not None:
+            labels = fcluster(tree, t=num_speakers, criterion='maxclust')
+        else:
+            labels = fcluster(tree, t=1 - threshold, criterion='distance')
+
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    order = np.argsort(np.argsort(first))
+    return order[inverse]
+
+def prepare_speaker_prompts(script:MultilingualScript,
+                            cache:StageCache|None=None,
+                            source:tuple|None=None,
+                            threshold:float=0.8,
+                            num_speakers:int|None=None,
+                            min_seconds:float=3.,
+                            max_seconds:float=10.):
+    '''
+    Generate one prompt per speaker, and use it for every line of the speaker.
+
+    Lines are clustered by speaker ('cluster_speakers') from embeddings of their EnCodec codes. The reference of
+    a speaker is its line closest to the speaker's average among those lasting 'min_seconds' to 'max_seconds'
+    (or the closest in length if there is none). Only the references are tokenized, into 'prompt/speaker_*.npz',
+    which is linked to the 'prompt_*.npz' of each line, so that the TTS stages are unchanged.
+    The speaker of each line is written to the 'speaker' column of the script.
+
+    Parameters:
+        script ('autodub.script.MultilingualScript'): To get the source audio, timestamps and transcripts.
+
+        cache ('autodub.cache.StageCache'): If given, clustering and prompts are reused when the lines did not change.
+
+        source ('tuple'): '(wav, sr)' of the source audio, if it is already loaded.
+
+        threshold ('float'): Similarity above which lines are assigned to the same speaker.
+
+        num_speakers ('int'): Number of speakers, if known.
+    '''
     prompt_dir = script.output_dir + "/prompt/"
-    output_dir = script.output_dir + f"/audio/{target_language}/"
-    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(prompt_dir, exist_ok=True)
+    indices = list(script.data.index)
+    segments = [(script.data.loc[idx, 'start'] / 1000, script.data.loc[idx, 'end'] / 1000) for idx in indices]
 
-    for idx, row in tqdm(script.data.iterrows(), total=len(script), desc="Generating translated speech.."):
+    value = None
+    if cache is not None:
+        speakers_key = cache.key('speakers', cache.file_digest(script.audio_path),
+                                 cache.data_digest(script.data, ['start', 'end']),
+                                 threshold=threshold, num_speakers=num_speakers,
+                                 min_seconds=min_seconds, max_seconds=max_seconds)
+        value = cache.load('speakers', speakers_key)
+    if value is None:
+        if source is None:
+            source = torchaudio.load(script.audio_path)
+        embeddings = embed_segments(source[0], source[1], segments)
+        labels = cluster_speakers(embeddings, threshold, num_speakers)
+        references = []
+        for speaker in range(labels.max() + 1):
+            members = np.flatnonzero(labels == speaker)
+            centroid = embeddings[members].mean(0)
+            def score(k):
+                duration = segments[k][1] - segments[k][0]
+                gap = max(min_seconds - duration, duration - max_seconds, 0.)
+                similarity = embeddings[k] @ centroid / max(np.linalg.norm(embeddings[k]) * np.linalg.norm(centroid), 1e-8)
+                return (-gap, similarity)
+            references.append(int(max(members, key=score)))
+        value = {'labels': labels.tolist(), 'references': references}
+        if cache is not None:
+            cache.store('speakers', speakers_key, {}, value)
+
+    script.data['speaker'] = value['labels']
+    speaker_paths = [prompt_dir + f"/speaker_{str(speaker).zfill(3)}.npz" for speaker in range(len(value['references']))]
+    keys = {}
+    todo = []
+    for speaker, k in enumerate(value['references']):
+        if cache is not None:
+            row = script.data.loc[indices[k]]
+            keys[speaker] = cache.key('prompt', cache.file_digest(script.audio_path),
+                                      start=row['start'], end=row['end'], transcript=row['source'])
+            if cache.restore('prompt', keys[speaker], {'prompt.npz': speaker_paths[speaker]}):
+                continue
+        todo.append(speaker)
+
+    if todo:
+        if source is None:
+            source = torchaudio.load(script.audio_path)
+        references = [value['references'][speaker] for speaker in todo]
+        prompts = make_prompts(name=script.title,
+                               wav=source[0],
+                               sr=source[1],
+                               segments=[segments[k] for k in references],
+                               transcripts=[script.data.loc[indices[k], 'source'] for k in references])
+        for speaker, prompt in zip(todo, prompts):
+            # The previous file may be linked to a cache entry; never write through it.
+            if os.path.exists(speaker_paths[speaker]):
+                os.remove(speaker_paths[speaker])
+            np.savez(speaker_paths[speaker], **prompt)
+            if cache is not None:
+                cache.store('prompt', keys[speaker], {'prompt.npz': speaker_paths[speaker]})
+
+    for idx, speaker in zip(indices, value['labels']):
         prompt_path = prompt_dir + f"/prompt_{str(idx).zfill(6)}.npz"
-        output_path = output_dir + f"/segment_{str(idx).zfill(6)}.wav"
-        
-        text = row[target_language]
+        if os.path.exists(prompt_path):
+            if os.path.samefile(prompt_path, speaker_paths[speaker]):
+                continue
+            os.remove(prompt_path)
+        try:
+            os.link(speaker_paths[speaker], prompt_path)
+        except OSError:
+            shutil.copy2(speaker_paths[speaker], prompt_path)
+
+def line_durations(script:MultilingualScript, idx:int, video_duration:float|None=None) -> tuple:
+    '''
+    Return the '(target, max)' durations (sec) of the speech of line 'idx', for 'generate_audio'.
 
-        audio_array = generate_audio(text, prompt_path, language=target_language)
-        write_wav(output_path, SAMPLE_RATE, audio_array)
+    The speech aims at the length of the source line, and must end before the next line starts
+    (or the video ends) so that its video clip never has to be slowed down.
+    '''
+    pos = script.data.index.get_loc(idx)
+    start = script.data['start'].iloc[pos] / 1000
+    target = script.data['end'].iloc[pos] / 1000 - start
+    if pos + 1 < len(script):
+        limit = script.data['start'].iloc[pos + 1] / 1000 - start
+    elif video_duration is not None:
+        limit = video_duration - start
+    else:
+        limit = None
+    if limit is not None:
+        limit = max(limit, target)
+    return target, limit
 
-    
+def speech_key(cache:StageCache, prompt_path:str, text:str, language:str, durations:tuple|None=None) -> str:
+    '''
+    Cache key of a synthesized line: its prompt, text, language, durations and the VALL-E checkpoint.
+    '''
+    return cache.key('tts',
+                     cache.file_digest(prompt_path),
+                     text=text,
+                     language=language,
+                     durations=durations,
+                     version=generation.model_version)
+
+def write_speech(script:MultilingualScript, target_language:str, idx:int, audio_array:np.ndarray,
+                 cache:StageCache|None=None, key:str|None=None) -> None:
+    '''
+    Save the speech of line 'idx', and store it under 'key' when a cache is given.
+    '''
+    output_path = script.output_dir + f"/audio/{target_language}/segment_{str(idx).zfill(6)}.wav"
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    # The previous file may be linked to a cache entry; never write through it.
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    write_wav(output_path, SAMPLE_RATE, audio_array)
+    if cache is not None:
+        cache.store('tts', key, {'segment.wav': output_path})
+
+
+def generate_translated_speech(script:MultilingualScript, target_language:str, batch_size:int=8,
+                               cache:StageCache|None=None, indices:list|None=None, fit_duration:bool=True):
+    '''
+    Generate speech of 'target_language' for each line in the script, from the prompts of 'prepare_prompts'.
+    'autodub.pipeline.dub_script' does the same while streaming the other stages of the dubbing.
+
+    Parameters:
+        script ('autodub.script.MultilingualScript'): Script with 'target_language' translations.
+
+        target_language ('str'): Language to synthesize.
+
+        batch_size ('int'): Number of lines synthesized together. Lines are grouped by length to reduce padding.
+
+        cache ('autodub.cache.StageCache'): If given, a line is only synthesized when its prompt, text,
+            language or VALL-E checkpoint changed since it was last generated.
+
+        indices ('list'): Lines to synthesize, e.g. 'autodub.utils.changed_segments'. Defaults to every line.
+
+        fit_duration ('bool'): Fit each line into its timestamps ('line_durations'). The last line is
+            only steered towards its length.
+    '''
+    assert script.is_available(target_language)
+
+    prompt_dir = script.output_dir + "/prompt/"
+    output_dir = script.output_dir + f"/audio/{target_language}/"
+
+    if indices is None:
+        indices = script.data.index
+    durations = {idx: line_durations(script, idx) if fit_duration else (None, None) for idx in indices}
+    with tqdm(total=len(indices), desc="Generating translated speech..") as pbar:
+        keys = {}
+        todo = []
+        for idx in indices:
+            if cache is not None:
+                keys[idx] = speech_key(cache,
+                                       prompt_dir + f"/prompt_{str(idx).zfill(6)}.npz",
+                                       script.data.loc[idx, target_language],
+                                       target_language,
+                                       durations[idx] if fit_duration else None)
+                if cache.restore('tts', keys[idx], {'segment.wav': output_dir + f"/segment_{str(idx).zfill(6)}.wav"}):
+                    pbar.update(1)
+                    continue
+            todo.append(idx)
+
+        # Sort lines by length so that each batch holds similar lengths.
+        todo.sort(key=lambda idx: len(script.data.loc[idx, target_language]))
+        for i in range(0, len(todo), batch_size):
+            batch = todo[i:i + batch_size]
+            audio_arrays = generate_audio_batch([script.data.loc[idx, target_language] for idx in batch],
+                                                [prompt_dir + f"/prompt_{str(idx).zfill(6)}.npz" for idx in batch],
+                                                language=target_language,
+                                                target_durations=[durations[idx][0] for idx in batch],
+                                                max_durations=[durations[idx][1] for idx in batch])
+            for idx, audio_array in zip(batch, audio_arrays):
+                write_speech(script, target_language, idx, audio_array, cache, keys.get(idx))
+            pbar.update(len(batch))
@@ -1,24 +1,46 @@
 import os
+import json
+import math
 import yaml
+import logging
+import shutil
+import tempfile
+import numpy as np
 import pandas as pd
+import soundfile as sf
 from tqdm import tqdm
 import subprocess
 from df.enhance import enhance, init_df, load_audio, save_audio, download_file
-from moviepy.editor import VideoFileClip,AudioClip, AudioFileClip, CompositeAudioClip, concatenate_videoclips, concatenate_audioclips, vfx
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+from moviepy.editor import VideoFileClip, AudioFileClip, CompositeAudioClip
 from .script import MultilingualScript
+from .separator import Separator, load_separator
 
 env_path =  './env.yaml'
 with open(env_path) as f:
     env = yaml.full_load(f)
 
-def sep_noise_speech(title):
-    command = ["python", "autodub/vocal_remover/inference.py", 
-               "--input", f"results/{title}/audio/init_source.wav", 
-               "--output_dir", f"results/{title}/audio",
-               "--pretrained_model", "autodub/vocal_remover/models/baseline.pth"]
-    result = subprocess.run(command, capture_output=True, text=True)
-    print(result.stdout)
-    print(result.stderr)
+def sep_noise_speech(title, separator:Separator|None=None):
+    '''
+    Separate 'init_source.wav' into vocals and instruments in-process,
+    and save them as 'init_source_Vocals.wav' and 'init_source_Instruments.wav'.
+    
+    Parameters:
+        separator ('autodub.separator.Separator'): Separator to use. The process-wide one by default.
+    '''
+    if separator is None:
+        separator = load_separator()
+    input_path = f"results/{title}/audio/init_source.wav"
+    vocals_path = f"results/{title}/audio/init_source_Vocals.wav"
+    instruments_path = f"results/{title}/audio/init_source_Instruments.wav"
+    if separator.tta or separator.postprocess:
+        vocals, instruments = separator.separate(input_path)
+        sf.write(instruments_path, instruments.T, separator.sr)
+        sf.write(vocals_path, vocals.T, separator.sr)
+    else:
+        # Memory stays bounded for long videos.
+        separator.separate_stream(input_path, vocals_path, instruments_path)
 
 def extract_audio_from_video(video_file_path, output_audio_path):
 
@@ -31,10 +53,103 @@ def enhance_audio(audio_file_path, output_audio_path):
     enhanced = enhance(model, df_state, audio)
     save_audio(output_audio_path, enhanced, df_state.sr())
 
+def _run_ffmpeg(args:list) -> None:
+    command = [get_setting("FFMPEG_BINARY"), "-y", "-hide_banner", "-loglevel", "error"] + args
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed ({result.returncode}): {result.stderr}")
+
+def _probe_keyframes(video_path:str) -> list|None:
+    '''
+    Return the timestamps (sec) of video keyframes, or None if 'ffprobe' is unavailable.
+    Reads packet flags only, so nothing is decoded.
+    '''
+    ffprobe = shutil.which("ffprobe")
+    if ffprobe is None:
+        return None
+    command = [ffprobe, "-v", "error", "-select_streams", "v:0",
+               "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", video_path]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
+
+def _on_keyframes(cut_points:list, keyframes:list|None, tolerance:float=0.02) -> bool:
+    if not keyframes:
+        return False
+    keyframes = np.asarray(keyframes)
+    return all(np.abs(keyframes - t).min() <= tolerance for t in cut_points)
+
+def split_video(video_path:str, cut_points:list, output_pattern:str) -> None:
+    '''
+    Split the video at 'cut_points' (sec) in a single ffmpeg pass.
+    Clip i covers [cut_points[i], cut_points[i+1]) and the last one runs to the end of the video.
+    
+    If every cut point lies on a keyframe, packets are stream-copied without re-encoding.
+    Otherwise, or if the keyframes cannot be read with 'ffprobe', the video is decoded once and encoded once,
+    with keyframes forced at the cut points so that the segment muxer can cut exactly there. A warning tells which.
+    
+    Parameters:
+        output_pattern ('str'): printf-style path of each clip, e.g. ".../segment_%06d.mp4"
+    '''
+    start = cut_points[0]
+    # Cut points relative to 'start', which becomes t=0 after input seeking.
+    segment_times = ",".join(f"{t - start:.3f}" for t in cut_points[1:])
+    args = ["-ss", f"{start:.3f}", "-i", video_path, "-map", "0:v:0", "-an"]
+    keyframes = _probe_keyframes(video_path)
+    if _on_keyframes(cut_points, keyframes):
+        args += ["-c:v", "copy"]
+    else:
+        if keyframes is None:
+            logging.warning(f"Could not read the keyframes of '{video_path}' with ffprobe; re-encoding it to split it.")
+        else:
+            logging.warning(f"Some cut points of '{video_path}' are not on keyframes; re-encoding it to split it.")
+        args += ["-c:v", "libx264", "-preset", "veryfast", "-crf", "18"]
+        if segment_times:
+            args += ["-force_key_frames", segment_times]
+    if segment_times:
+        args += ["-segment_times", segment_times]
+    args += ["-f", "segment", "-reset_timestamps", "1", "-segment_format", "mp4", output_pattern]
+    _run_ffmpeg(args)
+
+def split_audio(audio_path:str, ranges:list, output_paths:list) -> None:
+    '''
+    Cut sample-exact clips from 'audio_path' in a single ffmpeg pass.
+    The input is decoded once and fanned out with 'asplit', and each branch is trimmed by 'atrim'.
+    
+    Parameters:
+        ranges ('list'): (start, end) pairs in sec. 'end' may be None for the end of the file.
+    '''
+    assert len(ranges) == len(output_paths)
+    graph = [f"[0:a]asplit={len(ranges)}" + "".join(f"[s{i}]" for i in range(len(ranges)))]
+    for i, (start, end) in enumerate(ranges):
+        trim = f"start={start:.3f}" + (f":end={end:.3f}" if end is not None else "")
+        graph.append(f"[s{i}]atrim={trim},asetpts=PTS-STARTPTS[o{i}]")
+    
+    # The graph can be long for long videos, so pass it through a file.
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.write(";\n".join(graph))
+        graph_path = f.name
+    try:
+        args = ["-i", audio_path, "-filter_complex_script", graph_path]
+        for i, output_path in enumerate(output_paths):
+            args += ["-map", f"[o{i}]", "-c:a", "pcm_s16le", output_path]
+        _run_ffmpeg(args)
+    finally:
+        os.remove(graph_path)
+
 def prepare_clips(script:MultilingualScript) -> None:
     '''
     Split the video into short clips based on the script and save it
     
+    Video, speech and instrument clips are each extracted in one ffmpeg pass over the source,
+    instead of re-encoding every clip separately.
+    
     Parameters:
         script('MultilingualScript): 
             A 'MultilingualScript' containing timestamp data of each lines.
@@ -43,52 +158,179 @@ def prepare_clips(script:MultilingualScript) -> None:
     videoClip_dir = script.output_dir + "/video/source"
     audioClip_dir = script.output_dir + "/audio/source/"
     instrumentClip_dir = script.output_dir + "/audio/instrument/"
-    print(f'made directory for instrumentClip. utils.py line 46')
     os.makedirs(videoClip_dir, exist_ok=True)
     os.makedirs(audioClip_dir, exist_ok=True)
     os.makedirs(instrumentClip_dir, exist_ok=True)
 
-    video_source = VideoFileClip(script.video_path)
-    audio_source = AudioFileClip(script.audio_path)
-    instrument_source = AudioFileClip(f'./results/{script.title}/audio/init_source_Instruments.wav')
+    # 1. get timestamp
+    starts = (script.data['start'] / 1000).tolist()
+    ends = (script.data['end'] / 1000).tolist()
+    for idx in range(len(script)):
+        assert starts[idx] < ends[idx]
+        if idx + 1 < len(script):
+            assert ends[idx] <= starts[idx+1]
+    # Set 'next_start' to end of the video when it's last index.
+    next_starts = starts[1:] + [None]
 
-    for idx in tqdm(range(len(script)), desc="Extracting clips.."):
-        
-        # 1. get timestamp
-        start = script.data.iloc[idx]['start'] / 1000
-        end = script.data.iloc[idx]['end'] / 1000
-
-        assert start < end
-        if idx + 1 >= len(script): 
-            # Set 'next_start' to end of the video when it's last index.
-            next_start = None 
-        else:
-            next_start = script.data.iloc[idx+1]['start'] / 1000
-            assert end <= next_start
-            
-        audioClip_path = audioClip_dir + f'/segment_{str(idx).zfill(6)}.wav'
-        videoClip_path = videoClip_dir + f'/segment_{str(idx).zfill(6)}.mp4'
-        instrumentClip_path = instrumentClip_dir + f'/segment_{str(idx).zfill(6)}_instrument.wav'
-        
-        # 2. extact video clip
-        videoClip = video_source.subclip(start, next_start)
-        videoClip.write_videofile(videoClip_path, verbose=False, logger=None)
+    audioClip_paths = [audioClip_dir + f'/segment_{str(idx).zfill(6)}.wav' for idx in range(len(script))]
+    instrumentClip_paths = [instrumentClip_dir + f'/segment_{str(idx).zfill(6)}_instrument.wav' for idx in range(len(script))]
 
-        # 3. extract audio clip
-        audioClip = audio_source.subclip(start, end)
-        audioClip.write_audiofile(audioClip_path, verbose=False, logger=None)
-        
-        # 4. extact instrument clip
-        instrumentClip = instrument_source.subclip(start, next_start)
-        instrumentClip.write_audiofile(instrumentClip_path, verbose=False, logger=None)
+    with tqdm(total=3, desc="Extracting clips..") as pbar:
+        # 2. extact video clips
+        split_video(script.video_path, starts, videoClip_dir + '/segment_%06d.mp4')
+        pbar.update(1)
+
+        # 3. extract audio clips
+        split_audio(script.audio_path, list(zip(starts, ends)), audioClip_paths)
+        pbar.update(1)
 
-        prev_end = end
+        # 4. extact instrument clips
+        split_audio(f'./results/{script.title}/audio/init_source_Instruments.wav',
+                    list(zip(starts, next_starts)), instrumentClip_paths)
+        pbar.update(1)
     return 
 
-def merge_clips_to_video(script:MultilingualScript, language:str):
+def _atempo_chain(speed:float) -> str:
+    # 'atempo' only accepts factors in [0.5, 2.0], so chain it for stronger slow-downs.
+    factors = []
+    while speed < 0.5:
+        factors.append(0.5)
+        speed /= 0.5
+    factors.append(speed)
+    return ",".join(f"atempo={factor:.6f}" for factor in factors)
+
+def _stretch_audio(audio_path:str, speed:float, samplerate:int, channels:int) -> np.ndarray:
+    '''
+    Slow down the audio by 'speed' (< 1) with ffmpeg 'atempo', keeping the pitch.
+    Returns float32 samples of shape (n_samples, channels).
+    '''
+    command = [get_setting("FFMPEG_BINARY"), "-hide_banner", "-loglevel", "error",
+               "-i", audio_path, "-filter:a", _atempo_chain(speed),
+               "-f", "f32le", "-ac", str(channels), "-ar", str(samplerate), "-"]
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed ({result.returncode}): {result.stderr.decode()}")
+    return np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, channels)
+
+def _write_track(output_path:str, clip_paths:list, slots:list, speeds:list|None=None) -> None:
+    '''
+    Stream the clips into one continuous track, one clip in memory at a time.
+    Clip i starts at the sum of the previous 'slots' (sec); it is slowed down by 'speeds[i]' when given,
+    then cut or padded with silence to fill its slot.
+    '''
+    info = sf.info(clip_paths[0])
+    samplerate, channels = info.samplerate, info.channels
+    with sf.SoundFile(output_path, 'w', samplerate=samplerate, channels=channels, subtype='FLOAT') as track:
+        slot_end = 0.
+        for idx, clip_path in enumerate(clip_paths):
+            if speeds is not None and speeds[idx] < 1:
+                data = _stretch_audio(clip_path, speeds[idx], samplerate, channels)
+            else:
+                data, _ = sf.read(clip_path, dtype='float32', always_2d=True)
+            # Slot boundaries are rounded from the cumulative time so that they never drift.
+            slot_start = slot_end
+            slot_end += slots[idx]
+            n_samples = round(slot_end * samplerate) - round(slot_start * samplerate)
+            data = data[:n_samples]
+            track.write(data)
+            track.write(np.zeros((n_samples - len(data), channels), dtype=np.float32))
+
+def _render_manifest_path(script:MultilingualScript, language:str) -> str:
+    return script.output_dir + f"/video/{language}/render.json"
+
+def _render_records(script:MultilingualScript, language:str) -> list:
+    # Missing values become None, which survives the JSON round trip and compares equal, unlike NaN.
+    data = script.data[['start', 'end', 'source', language]].astype(object)
+    return data.where(data.notna(), None).to_dict('records')
+
+def _write_render_manifest(script:MultilingualScript, language:str) -> None:
+    manifest_path = _render_manifest_path(script, language)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump({'data': _render_records(script, language)}, f, indent=4, ensure_ascii=False)
+
+def has_rendered(script:MultilingualScript, language:str) -> bool:
+    '''
+    Whether the script was rendered in 'language' before, so that a new render can go through per-line parts.
+    '''
+    return os.path.exists(_render_manifest_path(script, language))
+
+def changed_segments(script:MultilingualScript, language:str) -> list:
+    '''
+    Return the indices of lines which differ from the last render in 'language'.
+    Every line is returned if the script has not been rendered yet.
+    '''
+    records = _render_records(script, language)
+    if not has_rendered(script, language):
+        return list(range(len(records)))
+    with open(_render_manifest_path(script, language)) as f:
+        rendered = json.load(f)['data']
+    return [idx for idx, record in enumerate(records) if idx >= len(rendered) or rendered[idx] != record]
+
+def render_segment(script:MultilingualScript, language:str, idx:int, speed:float, slot:float, fps:float) -> float:
+    '''
+    Encode the video part of line 'idx' for an incremental render, unless the part on disk is up to date.
+
+    The clip is slowed down by 'speed' and padded with its last frame to fill 'slot' (sec), rounded up to
+    whole frames so that every part is independent of the lines before it. All parts share the encoder
+    settings so that they can be concatenated without re-encoding.
+
+    Returns:
+        'float': The slot actually covered by the part (sec).
+    '''
+    clip_path = script.output_dir + f"/video/source/segment_{str(idx).zfill(6)}.mp4"
+    part_path = script.output_dir + f"/video/{language}/part_{str(idx).zfill(6)}.mp4"
+    record_path = part_path[:-len(".mp4")] + ".json"
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+
+    n_frames = math.ceil(slot * fps - 1e-6)
+    stat = os.stat(clip_path)
+    record = {'clip': [stat.st_size, stat.st_mtime_ns], 'speed': round(speed, 6), 'frames': n_frames}
+    if os.path.exists(part_path) and os.path.exists(record_path):
+        with open(record_path) as f:
+            if json.load(f) == record:
+                return n_frames / fps
+
+    _run_ffmpeg(["-i", clip_path, "-an",
+                 "-vf", f"setpts=(PTS-STARTPTS)/{record['speed']:.6f},fps={fps},"
+                        f"tpad=stop_mode=clone:stop_duration={n_frames / fps:.6f}",
+                 "-frames:v", str(n_frames),
+                 "-c:v", "libx264", "-preset", "veryfast", "-crf", "18", "-pix_fmt", "yuv420p",
+                 "-video_track_timescale", "90000", part_path])
+    with open(record_path, 'w') as f:
+        json.dump(record, f)
+    return n_frames / fps
+
+def segment_timing(script:MultilingualScript, language:str, idx:int, video_duration:float) -> tuple:
+    '''
+    Return the '(speed, slot)' of line 'idx' in the merged video.
+
+    Video clips cover [start, next_start) of the source, the last one runs to 'video_duration' (sec).
+    If the speech is longer than its video clip, the clip (and its instruments) is slowed down by 'speed'.
+    Speech generated with 'autodub.tts.line_durations' fits its clip, so its speed stays 1.
+    If the video clip is longer than the speech, the speech is followed by silence.
+    Either way the line fills a 'slot' (sec) as long as the longer of the two.
+    '''
+    start = script.data['start'].iloc[idx] / 1000
+    end = script.data['start'].iloc[idx + 1] / 1000 if idx + 1 < len(script) else video_duration
+    video_duration = end - start
+    audio_duration = sf.info(script.output_dir + f"/audio/{language}/segment_{str(idx).zfill(6)}.wav").duration
+    return min(1., video_duration / audio_duration), max(video_duration, audio_duration)
+
+def merge_clips_to_video(script:MultilingualScript, language:str, incremental:bool=False):
     '''
     Merge the clips into a complete video with audio of given language
     
+    The speech and instrument clips are streamed into two continuous tracks, and the video clips are
+    concatenated through the ffmpeg concat demuxer. One filtergraph retimes the video ('setpts') where the
+    speech is longer than its clip and mixes the tracks ('amix'), so the whole video is encoded once.
+
+    Every render saves a manifest of the rendered script in f"{script.output_dir}/video/{language}/".
+    With 'incremental', a script which was rendered before ('has_rendered') is instead merged from
+    per-line video parts kept there: only the parts whose timing changed are re-encoded, and the others
+    are copied into the output; the audio tracks are cheap and always rewritten. The first of these
+    renders encodes every part. A first render always goes through the single filtergraph.
+    
     Parameters:
         script ('autodub.script.MultilingualScript'):
             To get timestamp data.
@@ -96,6 +338,9 @@ def merge_clips_to_video(script:MultilingualScript, language:str):
         langauge ('str') :
             Target language of output video. One of ['KO', 'EN', 'JA', 'CN'].
             Audio-clip files in f"{script.output_dir}/audio/{language}/" will be merged.
+
+        incremental ('bool'):
+            Whether or not to render through per-line video parts, if the script was rendered before.
     '''
     output_path = script.output_dir + f"[{language}]_{script.title}.mp4"
     
@@ -103,41 +348,88 @@ def merge_clips_to_video(script:MultilingualScript, language:str):
     audioClip_dir = script.output_dir + f"/audio/{language}/"
     instrumentClip_dir = script.output_dir + f"/audio/instrument/"
 
-    output_video = []
-    for idx in tqdm(range(len(script)), desc="Merging clips.."):
-        videoClip_path = videoClip_dir + f"segment_{str(idx).zfill(6)}.mp4"
-        audioClip_path = audioClip_dir + f"segment_{str(idx).zfill(6)}.wav"
-        instrumetClip_path = instrumentClip_dir + f"segment_{str(idx).zfill(6)}_instrument.wav"
-        
-        videoClip = VideoFileClip(videoClip_path)
-        audioClip = AudioFileClip(audioClip_path)
-        instrumentClip = AudioFileClip(instrumetClip_path)
-        
-        # Match the length of audio and video
-        if videoClip.duration < audioClip.duration:
-            # If audioClip is longer than videoClip, slow down the videoClip
-            speed_multiplier = videoClip.duration / audioClip.duration
-            videoClip = videoClip.fx(vfx.speedx, speed_multiplier)
-            instrumentClip = instrumentClip.fx(vfx.speedx, speed_multiplier)
+    videoClip_paths = [videoClip_dir + f"segment_{str(idx).zfill(6)}.mp4" for idx in range(len(script))]
+    audioClip_paths = [audioClip_dir + f"segment_{str(idx).zfill(6)}.wav" for idx in range(len(script))]
+    instrumentClip_paths = [instrumentClip_dir + f"segment_{str(idx).zfill(6)}_instrument.wav" for idx in range(len(script))]
+
+    video_infos = ffmpeg_parse_infos(script.video_path)
+    starts = (script.data['start'] / 1000).tolist()
+    timings = [segment_timing(script, language, idx, video_infos['duration']) for idx in range(len(script))]
+    speeds = [speed for speed, _ in timings]
+    slots = [slot for _, slot in timings]
+
+    if incremental and has_rendered(script, language):
+        _merge_parts(script, language, output_path, audioClip_paths, instrumentClip_paths,
+                     speeds, slots, video_infos['video_fps'])
+        print(f' Successfully Saved - [ {output_path} ]')
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        speech_track = os.path.join(tmp_dir, "speech.wav")
+        instrument_track = os.path.join(tmp_dir, "instrument.wav")
+        concat_list = os.path.join(tmp_dir, "clips.txt")
+        graph_path = os.path.join(tmp_dir, "graph.txt")
         
-        elif videoClip.duration > audioClip.duration:
-            # If videoClip is longer that audioClip, add a short silence at the end of audioClip.
-            silent = AudioClip(
-                make_frame=lambda t: 0,
-                duration = videoClip.duration - audioClip.duration
-                )
-            audioClip = concatenate_audioclips([audioClip, silent])
-            
-        # Merge audio and Instrument
-        complete_audio = CompositeAudioClip([audioClip, instrumentClip])
-        output_video.append(videoClip.set_audio(complete_audio).copy())
-        # output_video.append(videoClip.set_audio(audioClip).copy())
-    output_video = concatenate_videoclips(output_video)
-    
-    print("Saving results..")
-    output_video.write_videofile(output_path, verbose=False, logger=None)
-    output_video.close()
+        print("Writing audio tracks..")
+        _write_track(speech_track, audioClip_paths, slots)
+        _write_track(instrument_track, instrumentClip_paths, slots, speeds)
+
+        with open(concat_list, 'w') as f:
+            for path in videoClip_paths:
+                f.write(f"file '{os.path.abspath(path)}'\n")
+
+        # Piecewise retiming: a frame at T in clip i moves to slot_start_i + (T - clip_start_i) / speed_i
+        clip_starts = [t - starts[0] for t in starts]
+        slot_starts = np.cumsum([0.] + slots[:-1]).tolist()
+        terms = []
+        for idx in range(len(script)):
+            window = f"gte(T,{clip_starts[idx]:.6f})"
+            if idx + 1 < len(script):
+                window += f"*lt(T,{clip_starts[idx+1]:.6f})"
+            terms.append(f"{window}*({slot_starts[idx]:.6f}+(T-{clip_starts[idx]:.6f})/{speeds[idx]:.6f})")
+        with open(graph_path, 'w') as f:
+            # Quoted, or the commas of the expression would separate filters.
+            f.write(f"[0:v]setpts='({'+'.join(terms)})/TB',fps={video_infos['video_fps']}[v];\n")
+            # amix scales each input by 1/2; restore the plain sum of speech and instruments.
+            f.write("[1:a][2:a]amix=inputs=2:duration=longest,volume=2[a]")
+
+        print("Saving results..")
+        _run_ffmpeg(["-f", "concat", "-safe", "0", "-i", concat_list,
+                     "-i", speech_track, "-i", instrument_track,
+                     "-filter_complex_script", graph_path, "-map", "[v]", "-map", "[a]",
+                     "-c:v", "libx264", "-preset", "veryfast", "-crf", "18",
+                     "-c:a", "aac", output_path])
+    _write_render_manifest(script, language)
     print(f' Successfully Saved - [ {output_path} ]')
+
+def _merge_parts(script:MultilingualScript, language:str, output_path:str,
+                 audioClip_paths:list, instrumentClip_paths:list,
+                 speeds:list, slots:list, fps:float) -> None:
+    slots = [render_segment(script, language, idx, speeds[idx], slots[idx], fps)
+             for idx in tqdm(range(len(script)), desc="Rendering video parts..")]
+    part_paths = [script.output_dir + f"/video/{language}/part_{str(idx).zfill(6)}.mp4" for idx in range(len(script))]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        speech_track = os.path.join(tmp_dir, "speech.wav")
+        instrument_track = os.path.join(tmp_dir, "instrument.wav")
+        concat_list = os.path.join(tmp_dir, "parts.txt")
+
+        print("Writing audio tracks..")
+        _write_track(speech_track, audioClip_paths, slots)
+        _write_track(instrument_track, instrumentClip_paths, slots, speeds)
+
+        with open(concat_list, 'w') as f:
+            for path in part_paths:
+                f.write(f"file '{os.path.abspath(path)}'\n")
+
+        print("Saving results..")
+        _run_ffmpeg(["-f", "concat", "-safe", "0", "-i", concat_list,
+                     "-i", speech_track, "-i", instrument_track,
+                     "-filter_complex", "[1:a][2:a]amix=inputs=2:duration=longest,volume=2[a]",
+                     "-map", "0:v", "-map", "[a]",
+                     "-c:v", "copy", "-c:a", "aac", output_path])
+
+    _write_render_manifest(script, language)
     
 
 def add_background_noise(video_path, noise_path, output_path):
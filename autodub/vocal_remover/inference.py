@@ -7,10 +7,17 @@ import soundfile as sf
 import torch
 from tqdm import tqdm
 
-from lib import dataset
-from lib import nets
-from lib import spec_utils
-from lib import utils
+if __package__:
+    # Imported as a module of 'autodub', e.g. by 'autodub.separator'.
+    from .lib import dataset
+    from .lib import nets
+    from .lib import spec_utils
+    from .lib import utils
+else:
+    from lib import dataset
+    from lib import nets
+    from lib import spec_utils
+    from lib import utils
 
 
 class Separator(object):
@@ -40,30 +47,37 @@ class Separator(object):
         return y_spec, v_spec
 
     def _separate(self, X_spec_pad, roi_size):
-        X_dataset = []
         patches = (X_spec_pad.shape[2] - 2 * self.offset) // roi_size
-        for i in range(patches):
-            start = i * roi_size
-            X_spec_crop = X_spec_pad[:, :, start:start + self.cropsize]
-            X_dataset.append(X_spec_crop)
 
-        X_dataset = np.asarray(X_dataset)
+        # Crops are strided views of the magnitude, no per-patch copy is made.
+        X_mag = torch.from_numpy(np.abs(X_spec_pad))
+        # (2, F, patches, cropsize) -> (patches, 2, F, cropsize)
+        X_dataset = X_mag.unfold(2, self.cropsize, roi_size)[:, :, :patches].permute(2, 0, 1, 3)
+        # Batches are gathered into one pinned buffer, so that their transfer to the GPU is asynchronous.
+        staging = None
+        if self.device is not None and torch.device(self.device).type == 'cuda':
+            staging = torch.empty((self.batchsize,) + X_dataset.shape[1:], dtype=X_mag.dtype).pin_memory()
 
         self.model.eval()
         with torch.no_grad():
-            mask_list = []
+            mask = None
             # To reduce the overhead, dataloader is not used.
             for i in tqdm(range(0, patches, self.batchsize)):
                 X_batch = X_dataset[i: i + self.batchsize]
-                X_batch = torch.from_numpy(X_batch).to(self.device)
-
-                mask = self.model.predict_mask(torch.abs(X_batch))
-
-                mask = mask.detach().cpu().numpy()
-                mask = np.concatenate(mask, axis=2)
-                mask_list.append(mask)
-
-            mask = np.concatenate(mask_list, axis=2)
+                if staging is not None:
+                    # The previous transfer is done: '.cpu()' below waited for its batch.
+                    X_batch = staging[:len(X_batch)].copy_(X_batch)
+                X_batch = X_batch.to(self.device, non_blocking=True)
+
+                mask_batch = self.model.predict_mask(X_batch)
+
+                # (B, 2, F, roi_size) -> (2, F, B * roi_size), written in place.
+                mask_batch = mask_batch.permute(1, 2, 0, 3).flatten(2).cpu().numpy()
+                if mask is None:
+                    mask = np.empty(
+                        mask_batch.shape[:2] + (patches * roi_size,), dtype=mask_batch.dtype
+                    )
+                mask[:, :, i * roi_size:i * roi_size + mask_batch.shape[2]] = mask_batch
 
         return mask
 
@@ -6,10 +6,13 @@ import torch
 import torch.utils.data
 from tqdm import tqdm
 
-try:
-    from lib import spec_utils
-except ModuleNotFoundError:
-    import spec_utils
+if __package__:
+    from . import spec_utils
+else:
+    try:
+        from lib import spec_utils
+    except ModuleNotFoundError:
+        import spec_utils
 
 
 class VocalRemoverTrainingSet(torch.utils.data.Dataset):
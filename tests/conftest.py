@@ -0,0 +1,51 @@
+import os
+import shutil
+import sys
+
+# autodub loads its assets (e.g. './assets/bpe_69.json') relative to the working directory.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+# autodub reads the API credentials of './env.yaml' on import. Without one, import it with the
+# placeholders of the example, and remove the copy so that it is never mistaken for real credentials.
+if not os.path.exists('env.yaml'):
+    shutil.copy('env_example.yaml', 'env.yaml')
+    try:
+        import autodub
+    finally:
+        os.remove('env.yaml')
+
+import pytest
+import torch
+
+from autodub.VALL_E_X.models.macros import NUM_AUDIO_TOKENS
+from autodub.VALL_E_X.models.vallex import VALLE
+
+
+def _make_valle(seed=0):
+    """A tiny random VALL-E with the architecture of the real one."""
+    torch.manual_seed(seed)
+    return VALLE(64, 4, 2, norm_first=True, add_prenet=False, prefix_mode=1,
+                 share_embedding=True, nar_scale_factor=1.0, prepend_bos=True, num_quantizers=8).eval()
+
+
+@pytest.fixture
+def make_valle():
+    """Builds more tiny random VALL-Es: 'make_valle(seed)'."""
+    return _make_valle
+
+
+@pytest.fixture
+def valle():
+    return _make_valle()
+
+
+@pytest.fixture
+def valle_inputs():
+    """Text and prompt of two lines of different lengths: (text (S,), enrolled text length, prompt (T, 8))."""
+    torch.manual_seed(1)
+    return [
+        (torch.randint(0, 100, (24,)), 8, torch.randint(0, NUM_AUDIO_TOKENS, (30, 8))),
+        (torch.randint(0, 100, (15,)), 5, torch.randint(0, NUM_AUDIO_TOKENS, (18, 8))),
+    ]
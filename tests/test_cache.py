@@ -0,0 +1,95 @@
+import os
+
+import pandas as pd
+
+from autodub.cache import StageCache
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_key_depends_on_upstream_and_params():
+    key = StageCache.key('tts', 'abc', text="hello", version="v1")
+    assert key == StageCache.key('tts', 'abc', version="v1", text="hello")
+    assert key != StageCache.key('tts', 'abd', text="hello", version="v1")
+    assert key != StageCache.key('tts', 'abc', text="hello", version="v2")
+    assert key != StageCache.key('stt', 'abc', text="hello", version="v1")
+
+
+def test_data_digest_only_covers_columns():
+    data = pd.DataFrame({'start': [0, 1000], 'source': ["a", "b"], 'ko': ["가", "나"]})
+    digest = StageCache.data_digest(data, ['start', 'source'])
+    changed = data.assign(ko=["다", "라"])
+    assert StageCache.data_digest(changed, ['start', 'source']) == digest
+    assert StageCache.data_digest(changed.assign(source=["a", "c"]), ['start', 'source']) != digest
+
+
+def test_file_digest_follows_contents(tmp_path):
+    cache = StageCache(str(tmp_path / "cache"))
+    a, b = str(tmp_path / "a.txt"), str(tmp_path / "b.txt")
+    _write(a, "same")
+    _write(b, "same")
+    assert cache.file_digest(a) == cache.file_digest(b)
+    _write(b, "other contents")
+    assert cache.file_digest(a) != cache.file_digest(b)
+
+
+def test_run_stores_then_restores(tmp_path):
+    cache = StageCache(str(tmp_path / "cache"))
+    out_file = str(tmp_path / "results" / "out.txt")
+    out_dir = str(tmp_path / "results" / "parts")
+    outputs = {'out': out_file, 'parts': out_dir}
+    calls = []
+
+    def produce():
+        calls.append(1)
+        _write(out_file, "output")
+        _write(os.path.join(out_dir, "part_0.txt"), "part")
+
+    key = cache.key('stage', 'input')
+    assert not cache.has('stage', key)
+    assert cache.run('stage', key, outputs, produce) is False
+    assert cache.has('stage', key)
+
+    os.remove(out_file)
+    os.remove(os.path.join(out_dir, "part_0.txt"))
+    assert cache.run('stage', key, outputs, produce) is True
+    assert len(calls) == 1
+    assert _read(out_file) == "output"
+    assert _read(os.path.join(out_dir, "part_0.txt")) == "part"
+
+
+def test_run_removes_stale_outputs_before_producing(tmp_path):
+    cache = StageCache(str(tmp_path / "cache"))
+    out_file = str(tmp_path / "out.txt")
+    _write(out_file, "stale")
+    seen = []
+    cache.run('stage', cache.key('stage'), {'out': out_file},
+              lambda: (seen.append(os.path.exists(out_file)), _write(out_file, "fresh")))
+    assert seen == [False]
+
+
+def test_restore_and_load_miss(tmp_path):
+    cache = StageCache(str(tmp_path / "cache"))
+    out_file = str(tmp_path / "out.txt")
+    assert cache.restore('stage', 'missing', {'out': out_file}) is False
+    assert not os.path.exists(out_file)
+    assert cache.load('stage', 'missing') is None
+
+
+def test_store_and_load_value(tmp_path):
+    cache = StageCache(str(tmp_path / "cache"))
+    out_file = str(tmp_path / "out.txt")
+    _write(out_file, "output")
+    cache.store('stage', 'key', {'out': out_file}, value={'lines': ["안녕", "hello"]})
+    assert cache.load('stage', 'key') == {'lines': ["안녕", "hello"]}
+    # Another key of the same stage is independent.
+    assert cache.load('stage', 'other') is None
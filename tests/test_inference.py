@@ -0,0 +1,122 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from autodub.VALL_E_X.models import vallex
+from autodub.VALL_E_X.models.macros import NUM_AUDIO_TOKENS
+from autodub.VALL_E_X.modules.activation import StaticKVCache
+
+
+def _inference(model, text, enrolled, prompt, **kwargs):
+    return model.inference(text.unsqueeze(0), torch.tensor([text.shape[0]]), prompt.unsqueeze(0), enrolled,
+                           top_k=1, prompt_language='en', text_language='en', **kwargs)
+
+
+def _batch_inference(model, inputs, **kwargs):
+    texts, enrolled, prompts = zip(*inputs)
+    return model.batch_inference(list(texts), list(prompts), list(enrolled), ['en'] * len(inputs),
+                                 ['en'] * len(inputs), top_k=1, **kwargs)
+
+
+def _reference_ar(model, text, enrolled, prompt, max_frames):
+    """Greedy AR codes recomputing the whole sequence at every step, without a KV cache."""
+    x = model.ar_text_embedding(text.unsqueeze(0))
+    x = x + model.ar_language_embedding(torch.tensor([model.language_ID['en']]))
+    x = model.ar_text_position(model.ar_text_prenet(x))
+    x_len = x.shape[1]
+    y = F.pad(prompt[:, 0].unsqueeze(0), (1, 0), value=NUM_AUDIO_TOKENS + 1)
+    for _ in range(max_frames):
+        y_pos = model.ar_audio_position(model.ar_audio_prenet(model.ar_audio_embedding(y)))
+        xy_pos = torch.concat([x, y_pos], dim=1)
+        mask = torch.triu(torch.ones(xy_pos.shape[1], xy_pos.shape[1], dtype=torch.bool), diagonal=1)
+        mask[:x_len, :x_len] = False
+        xy_dec, _ = model.ar_decoder((xy_pos, None), mask=mask)
+        token = model.ar_predict_layer(xy_dec[:, -1]).argmax(-1, keepdim=True)
+        if token.item() == NUM_AUDIO_TOKENS:
+            break
+        y = torch.concat([y, token], dim=1)
+    return y[0, 1 + prompt.shape[0]:]
+
+
+@torch.no_grad()
+def test_greedy_inference_matches_full_recompute(valle, valle_inputs):
+    for text, enrolled, prompt in valle_inputs:
+        codes = _inference(valle, text, enrolled, prompt, max_frames=40, stop_on_runaway=False)
+        assert torch.equal(codes[0, :, 0], _reference_ar(valle, text, enrolled, prompt, 40))
+
+
+@torch.no_grad()
+def test_batch_inference_matches_inference(valle, valle_inputs):
+    # The second line has a shorter text and prompt: its text is right-padded, and its prompt left-padded.
+    # It also ends earlier, while the first line goes on.
+    expected = [_inference(valle, *inputs, max_frames=max_frames)
+                for inputs, max_frames in zip(valle_inputs, [30, 20])]
+    actual = _batch_inference(valle, valle_inputs, max_frames=[30, 20])
+    assert [codes.shape for codes in actual] == [codes.shape for codes in expected]
+    assert all(torch.equal(e, a) for e, a in zip(expected, actual))
+
+
+@torch.no_grad()
+def test_best_of_greedy_matches_single_beam(valle, valle_inputs):
+    text, enrolled, prompt = valle_inputs[0]
+    expected = _inference(valle, text, enrolled, prompt, max_frames=30)
+    for interval in (1, 3, 8):
+        actual = _inference(valle, text, enrolled, prompt, max_frames=30, best_of=4,
+                            termination_check_interval=interval)
+        assert torch.equal(actual, expected)
+
+
+@torch.no_grad()
+def test_best_of_compaction(valle, valle_inputs, monkeypatch):
+    # Greedy beams never diverge. This sampler sends each beam on its own path at the first frame, and then
+    # ends a beam on a token which depends on its history only, so the beams end at different frames
+    # and are dropped from the batch, at times which depend on 'termination_check_interval'.
+    steps = []
+    def sampling(logits, top_k, top_p, temperature):
+        tokens = logits.argmax(-1, keepdim=True)
+        if not steps:
+            tokens = (tokens + torch.arange(logits.shape[0]).unsqueeze(-1)) % NUM_AUDIO_TOKENS
+        elif len(steps) > 4:
+            tokens = tokens.masked_fill(tokens % 8 == 0, NUM_AUDIO_TOKENS)
+        steps.append(tokens.squeeze(-1))
+        return tokens, logits.log_softmax(-1).gather(-1, tokens).squeeze(-1)
+    monkeypatch.setattr(vallex, "topk_sampling", sampling)
+    select_rows = StaticKVCache.select_rows
+    compactions = []
+    def spy(self, rows):
+        compactions.append(rows.numel())
+        return select_rows(self, rows)
+    monkeypatch.setattr(StaticKVCache, "select_rows", spy)
+
+    text, enrolled, prompt = valle_inputs[0]
+    outputs = []
+    for interval in (1, 3, 8, 1000):
+        steps.clear()
+        outputs.append(_inference(valle, text, enrolled, prompt, max_frames=60, best_of=4,
+                                  termination_check_interval=interval))
+        # With checks this rare, the budget runs out before any check drops a beam.
+        assert (len(compactions) > 0) == (interval != 1000)
+        compactions.clear()
+    assert all(torch.equal(output, outputs[0]) for output in outputs)
+
+
+
+@torch.no_grad()
+def test_best_of_ranks_without_discarded_frames(valle, valle_inputs, monkeypatch):
+    # Beam 0 samples likely frames, then unlikely ones which the runaway check discards. Beam 1 samples
+    # moderately likely frames until the budget. Only without the discarded frames is beam 0 the best.
+    steps = []
+    def sampling(logits, top_k, top_p, temperature):
+        tokens = torch.tensor([[1], [2]])
+        logprobs = torch.tensor([-0.1 if len(steps) < 4 else -10.0, -1.0])
+        steps.append(tokens)
+        return tokens, logprobs
+    def runaway(tokens):
+        return torch.tensor([True, False]), torch.tensor([4, 0])
+    monkeypatch.setattr(vallex, "topk_sampling", sampling)
+    monkeypatch.setattr(vallex, "detect_runaway", runaway)
+
+    text, enrolled, prompt = valle_inputs[0]
+    codes = _inference(valle, text, enrolled, prompt, max_frames=16, best_of=2,
+                       runaway_check_interval=8, termination_check_interval=1000)
+    assert codes[0, :, 0].tolist() == [1] * 4
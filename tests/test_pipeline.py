@@ -0,0 +1,72 @@
+import random
+import threading
+import time
+
+import pytest
+
+from autodub.pipeline import Stage, run_pipeline
+
+
+def _jitter(fn):
+    def wrapped(item):
+        time.sleep(random.uniform(0, 0.005))
+        return fn(item)
+    return wrapped
+
+
+def test_outputs_keep_the_order_of_items():
+    random.seed(0)
+    items = list(range(50))
+    stages = [
+        Stage("double", _jitter(lambda x: 2 * x), workers=4),
+        Stage("increment", _jitter(lambda x: x + 1), workers=3),
+    ]
+    assert run_pipeline(items, stages, maxsize=2) == [2 * x + 1 for x in items]
+
+
+def test_batched_stage():
+    batches = []
+
+    def square(batch):
+        batches.append(list(batch))
+        return [x * x for x in batch]
+
+    items = list(range(23))
+    stages = [Stage("square", square, batch_size=5), Stage("negate", lambda x: -x, workers=2)]
+    assert run_pipeline(items, stages) == [-x * x for x in items]
+    assert all(1 <= len(batch) <= 5 for batch in batches)
+    assert sorted(x for batch in batches for x in batch) == items
+
+
+def test_empty_items():
+    assert run_pipeline([], [Stage("identity", lambda x: x)]) == []
+
+
+def test_error_names_the_stage_and_stops():
+    processed = []
+    lock = threading.Lock()
+
+    def fail_on_three(x):
+        if x == 3:
+            raise ValueError("bad line")
+        return x
+
+    def record(x):
+        with lock:
+            processed.append(x)
+        return x
+
+    stages = [Stage("check", fail_on_three, workers=2), Stage("record", record)]
+    with pytest.raises(RuntimeError, match="Stage 'check' failed") as excinfo:
+        run_pipeline(list(range(1000)), stages, maxsize=2)
+    assert isinstance(excinfo.value.__cause__, ValueError)
+    # The bounded queues stop the other items shortly after the failure.
+    assert len(processed) < 1000
+
+
+def test_error_in_batched_stage():
+    def fail(batch):
+        raise KeyError("missing")
+
+    with pytest.raises(RuntimeError, match="Stage 'translate' failed"):
+        run_pipeline(list(range(10)), [Stage("identity", lambda x: x), Stage("translate", fail, batch_size=4)])
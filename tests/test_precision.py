@@ -0,0 +1,60 @@
+import copy
+
+import pytest
+import torch
+
+from autodub.VALL_E_X.models.macros import NUM_AUDIO_TOKENS
+from autodub.VALL_E_X.modules.activation import MultiheadAttention
+from autodub.VALL_E_X.utils.generation import quantize_model
+
+
+def _batch(inputs):
+    texts, enrolled, prompts = zip(*inputs)
+    return list(texts), list(prompts), list(enrolled), ['en'] * len(inputs), ['en'] * len(inputs)
+
+
+@torch.no_grad()
+def test_bf16_batch_inference(valle, valle_inputs):
+    # Padded rows go through boolean padding masks, which torch turns into float masks under autocast.
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        outputs = valle.batch_inference(*_batch(valle_inputs), top_k=1, max_frames=[20, 20])
+    assert len(outputs) == 2
+    for codes in outputs:
+        assert codes.shape[0] == 1 and codes.shape[2] == 8
+        assert 0 < codes.shape[1] <= 20
+        assert ((codes >= 0) & (codes < NUM_AUDIO_TOKENS)).all()
+
+
+@torch.no_grad()
+def test_int8_checkpoint_round_trip(valle, valle_inputs, make_valle, tmp_path):
+    quantized = quantize_model(copy.deepcopy(valle))
+    path = tmp_path / "model.int8.pt"
+    torch.save(quantized.state_dict(), path)
+
+    loaded = quantize_model(make_valle(seed=1), from_float=False)
+    missing_keys, unexpected_keys = loaded.load_state_dict(torch.load(path), strict=True)
+    assert not missing_keys and not unexpected_keys
+    loaded.eval()
+
+    text, enrolled, prompt = valle_inputs[0]
+    def greedy(model):
+        return model.inference(text.unsqueeze(0), torch.tensor([text.shape[0]]), prompt.unsqueeze(0), enrolled,
+                               top_k=1, prompt_language='en', text_language='en')
+    assert torch.equal(greedy(quantized), greedy(loaded))
+
+
+def test_int8_attention_outside_inference():
+    attention = MultiheadAttention(16, 2, batch_first=True).eval()
+    attention.quantize_dynamic_()
+    x = torch.randn(1, 5, 16)
+    with torch.no_grad():
+        assert attention(x, x, x, need_weights=False)[0].shape == x.shape
+        # Attention weights need the float projections.
+        with pytest.raises(ValueError, match="quantized"):
+            attention(x, x, x, need_weights=True)
+
+
+def test_int8_attention_needs_packed_in_proj():
+    attention = MultiheadAttention(16, 2, kdim=8, vdim=8, batch_first=True)
+    with pytest.raises(ValueError, match="packed in_proj"):
+        attention.quantize_dynamic_()
@@ -0,0 +1,64 @@
+import functools
+
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+from encodec import EncodecModel
+
+from autodub.VALL_E_X.data.tokenizer import AudioTokenizer, tokenize_audio
+from autodub.VALL_E_X.utils import prompt_making
+from autodub.VALL_E_X.utils.prompt_making import make_prompt, make_prompts
+
+
+@pytest.fixture
+def codec(monkeypatch):
+    """EnCodec with random weights, since the pretrained ones are downloaded on first use."""
+    monkeypatch.setattr(EncodecModel, "encodec_model_24khz",
+                        functools.partial(EncodecModel.encodec_model_24khz, pretrained=False))
+    torch.manual_seed(0)
+    codec = AudioTokenizer(torch.device("cpu"))
+    # Without pretrained weights, the codebooks wait for a k-means init on zeros and every code is 0.
+    with torch.no_grad():
+        for layer in codec.codec.quantizer.vq.layers:
+            layer._codebook.embed.normal_()
+            layer._codebook.inited.fill_(True)
+    monkeypatch.setattr(prompt_making, "codec", codec)
+    return codec
+
+
+def _wav(seconds, sr, channels=1, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return 0.1 * torch.randn(channels, int(seconds * sr), generator=generator)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("max_batch_seconds", [2.5, 120.])
+def test_encode_batch_matches_encode(codec, max_batch_seconds):
+    # Mixed lengths, sample rates and channels, over several batches of at most 2.5s, or in one batch where
+    # clips of different lengths share a sample rate.
+    wavs = [_wav(1.3, 24000), _wav(0.7, 16000, seed=1), _wav(2.05, 44100, seed=2),
+            _wav(0.4, 24000, channels=2, seed=3), _wav(1.1, 16000, seed=4)]
+    sample_rates = [24000, 16000, 44100, 24000, 16000]
+    codes = codec.encode_batch(wavs, sample_rates, max_batch_seconds=max_batch_seconds)
+    for wav, sr, batch_codes in zip(wavs, sample_rates, codes):
+        expected = tokenize_audio(codec, (wav, sr))[0][0][0]
+        assert len(expected.unique()) > 1
+        assert torch.equal(batch_codes, expected)
+
+
+@torch.no_grad()
+def test_make_prompts_matches_make_prompt(codec, tmp_path):
+    sr = 44100
+    wav = _wav(6, sr)
+    segments = [(0.5, 2.), (2.25, 2.75), (3., 5.9)]
+    transcripts = ["Hello there.", "Yes.", "See you tomorrow, then."]
+    prompts = make_prompts("title", wav, sr, segments, transcripts)
+    for k, ((start, end), transcript, prompt) in enumerate(zip(segments, transcripts, prompts)):
+        path = str(tmp_path / f"segment_{k}.wav")
+        sf.write(path, wav[0, round(start * sr):round(end * sr)].numpy(), sr, subtype='FLOAT')
+        expected = make_prompt("title", path, transcript)
+        assert len(np.unique(expected['audio_tokens'])) > 1
+        assert expected.keys() == prompt.keys()
+        for key in expected:
+            assert np.array_equal(expected[key], prompt[key]), key
@@ -0,0 +1,91 @@
+import threading
+import time
+
+from autodub.registry import ModelRegistry
+
+
+class Loader:
+    """Counts the models it loads."""
+    def __init__(self, delay=0.):
+        self.loads = 0
+        self.delay = delay
+
+    def __call__(self):
+        time.sleep(self.delay)
+        self.loads += 1
+        return object()
+
+
+def test_loads_once_per_key():
+    registry = ModelRegistry(idle_timeout=None)
+    loader = Loader()
+    with registry.use("a", loader) as first:
+        pass
+    with registry.use("a", loader) as second:
+        pass
+    with registry.use("b", loader) as other:
+        pass
+    assert first is second
+    assert other is not first
+    assert loader.loads == 2
+
+
+def test_concurrent_first_use_loads_once():
+    registry = ModelRegistry(idle_timeout=None)
+    loader = Loader(delay=0.05)
+    models = []
+    def use():
+        with registry.use("a", loader) as model:
+            models.append(model)
+    threads = [threading.Thread(target=use) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loader.loads == 1
+    assert len(models) == 4 and all(model is models[0] for model in models)
+
+
+def test_evicts_idle_models():
+    # The watcher would only check after an hour; 'evict_idle' is called by hand.
+    registry = ModelRegistry(idle_timeout=0.2, check_interval=3600.)
+    loader = Loader()
+    with registry.use("a", loader) as first:
+        time.sleep(0.3)
+        # In use, so never idle.
+        registry.evict_idle()
+        with registry.use("a", loader) as model:
+            assert model is first
+    registry.evict_idle()
+    assert loader.loads == 1
+    time.sleep(0.3)
+    registry.evict_idle()
+    with registry.use("a", loader) as second:
+        pass
+    assert second is not first
+    assert loader.loads == 2
+
+
+def test_without_idle_timeout_models_stay():
+    registry = ModelRegistry(idle_timeout=None)
+    loader = Loader()
+    with registry.use("a", loader):
+        pass
+    registry.evict_idle()
+    with registry.use("a", loader):
+        pass
+    assert loader.loads == 1
+
+
+def test_clear_keeps_models_in_use():
+    registry = ModelRegistry(idle_timeout=None)
+    loader = Loader()
+    with registry.use("a", loader) as used:
+        with registry.use("b", loader):
+            pass
+        registry.clear()
+        with registry.use("a", loader) as model:
+            assert model is used
+    with registry.use("b", loader):
+        pass
+    assert loader.loads == 3
@@ -0,0 +1,161 @@
+import librosa
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+
+from autodub import separator as separator_module
+from autodub.separator import Separator, _OverlapAdd, load_separator
+from autodub.vocal_remover.inference import Separator as MaskSeparator
+from autodub.vocal_remover.lib import dataset
+from autodub.vocal_remover.lib import nets
+from autodub.vocal_remover.lib import spec_utils
+
+SR = 44100
+# A small STFT keeps the random 'CascadedNet' tiny: 3.3 s are ~570 frames, i.e. 5 crops of 128 frames.
+N_FFT = 512
+HOP_LENGTH = 256
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return nets.CascadedNet(N_FFT, HOP_LENGTH, 32, 128).eval()
+
+
+@pytest.fixture
+def model_path(model, tmp_path):
+    path = tmp_path / "model.pth"
+    torch.save(model.state_dict(), path)
+    return path
+
+
+@pytest.fixture
+def separator(model_path):
+    return Separator(str(model_path), device='cpu', sr=SR, n_fft=N_FFT, hop_length=HOP_LENGTH,
+                     batchsize=4, cropsize=256)
+
+
+@pytest.fixture
+def audio_path(tmp_path):
+    # Stereo, with a length that is not a multiple of the hop length.
+    rng = np.random.default_rng(0)
+    t = np.arange(int(3.3 * SR) + 17) / SR
+    wave = np.stack([np.sin(2 * np.pi * 220 * t), np.sin(2 * np.pi * 330 * t)])
+    wave = 0.5 * wave + 0.1 * rng.standard_normal(wave.shape)
+    path = tmp_path / "audio.wav"
+    sf.write(path, wave.T.astype(np.float32), SR, subtype='FLOAT')
+    return path
+
+
+def test_load_separator_is_resident(model_path, audio_path, monkeypatch):
+    monkeypatch.setattr(separator_module, '_separator', None)
+    separator = load_separator(pretrained_model=str(model_path), device='cpu', sr=SR, n_fft=N_FFT,
+                               hop_length=HOP_LENGTH)
+    # Later calls return the same instance and ignore their arguments.
+    assert load_separator() is separator
+    assert load_separator(sr=16000) is separator
+
+    wave, _ = sf.read(audio_path, dtype='float32')
+    vocals, instruments = separator.separate(str(audio_path))
+    # The inverse STFT ends at the last full hop.
+    assert vocals.shape == instruments.shape == (2, len(wave) // HOP_LENGTH * HOP_LENGTH)
+    # The mask splits every bin between the two.
+    np.testing.assert_allclose(vocals + instruments, wave.T[:, :vocals.shape[1]], atol=1e-4)
+    # A '(wave, sr)' tuple gives the same waves as the file.
+    from_tuple = separator.separate((wave.T, SR))
+    np.testing.assert_allclose(from_tuple[0], vocals, atol=1e-6)
+
+
+@pytest.mark.parametrize("n_frames", [1, 2, 7, 40])
+def test_overlap_add_matches_istft(n_frames):
+    rng = np.random.default_rng(n_frames)
+    spec = (rng.standard_normal((2, N_FFT // 2 + 1, n_frames))
+            + 1j * rng.standard_normal((2, N_FFT // 2 + 1, n_frames))).astype(np.complex64)
+    expected = librosa.istft(spec, hop_length=HOP_LENGTH)
+
+    ola = _OverlapAdd(N_FFT, HOP_LENGTH, 2)
+    # Pushed in uneven blocks
+    blocks = [ola.push(spec[:, :, start:start + 3]) for start in range(0, n_frames, 3)]
+    actual = np.concatenate(blocks + [ola.flush()], axis=1)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, atol=1e-5)
+
+
+def test_stream_spectrogram_matches_stft(separator, audio_path):
+    expected = spec_utils.wave_to_spectrogram(sf.read(audio_path, dtype='float32')[0].T, HOP_LENGTH, N_FFT)
+    actual = np.concatenate(list(separator._stream_spectrogram(audio_path, 100)), axis=2)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, atol=1e-4)
+
+
+@pytest.mark.parametrize("chunk_seconds", [0.5, 30.])
+def test_separate_stream_matches_separate(separator, audio_path, tmp_path, chunk_seconds):
+    # 0.5 s chunks end in the middle of crops, 30 s chunks hold the whole file and only the flush emits.
+    vocals, instruments = separator.separate(str(audio_path))
+    vocals_path, instruments_path = tmp_path / "vocals.wav", tmp_path / "instruments.wav"
+    separator.separate_stream(audio_path, vocals_path, instruments_path, chunk_seconds=chunk_seconds)
+
+    for path, expected in [(vocals_path, vocals), (instruments_path, instruments)]:
+        actual, sr = sf.read(path, dtype='float32')
+        assert sr == SR
+        assert actual.T.shape == expected.shape
+        # Wav files hold 16-bit PCM.
+        np.testing.assert_allclose(actual.T, expected, atol=2e-4)
+
+
+def test_separate_stream_rejects_whole_file_options(model_path, audio_path, tmp_path):
+    separator = Separator(str(model_path), device='cpu', sr=SR, n_fft=N_FFT, hop_length=HOP_LENGTH, tta=True)
+    with pytest.raises(ValueError):
+        separator.separate_stream(audio_path, tmp_path / "vocals.wav", tmp_path / "instruments.wav")
+
+
+def _reference_separate(separator, X_spec_pad, roi_size):
+    """'vocal_remover.inference.Separator._separate' before the crops became strided views."""
+    X_dataset = []
+    patches = (X_spec_pad.shape[2] - 2 * separator.offset) // roi_size
+    for i in range(patches):
+        start = i * roi_size
+        X_spec_crop = X_spec_pad[:, :, start:start + separator.cropsize]
+        X_dataset.append(X_spec_crop)
+
+    X_dataset = np.asarray(X_dataset)
+
+    with torch.no_grad():
+        mask_list = []
+        for i in range(0, patches, separator.batchsize):
+            X_batch = X_dataset[i: i + separator.batchsize]
+            X_batch = torch.from_numpy(X_batch).to(separator.device)
+
+            mask = separator.model.predict_mask(torch.abs(X_batch))
+
+            mask = mask.detach().cpu().numpy()
+            mask = np.concatenate(mask, axis=2)
+            mask_list.append(mask)
+
+        mask = np.concatenate(mask_list, axis=2)
+
+    return mask
+
+
+@pytest.mark.parametrize("cropsize, n_frames", [(256, 600), (192, 290)])
+def test_separate_matches_per_crop_copies(model, cropsize, n_frames):
+    # 5 crops of 128 frames and 5 crops of 64 frames: with batches of 2, the last batch is partial.
+    rng = np.random.default_rng(0)
+    X_spec = (rng.standard_normal((2, N_FFT // 2 + 1, n_frames))
+              + 1j * rng.standard_normal((2, N_FFT // 2 + 1, n_frames))).astype(np.complex64)
+    separator = MaskSeparator(model, device='cpu', batchsize=2, cropsize=cropsize)
+
+    pad_l, pad_r, roi_size = dataset.make_padding(n_frames, cropsize, separator.offset)
+    X_spec_pad = np.pad(X_spec, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
+    X_spec_pad /= np.abs(X_spec).max()
+    expected = _reference_separate(separator, X_spec_pad, roi_size)
+    actual = separator._separate(X_spec_pad, roi_size)
+    assert actual.shape == expected.shape
+    # Convolutions over strided views may round differently in the last bit.
+    np.testing.assert_allclose(actual, expected, atol=1e-6)
+
+    y_spec, v_spec = separator.separate(X_spec)
+    expected_y, expected_v = separator._postprocess(X_spec, expected[:, :, :n_frames])
+    np.testing.assert_allclose(y_spec, expected_y, atol=1e-5)
+    np.testing.assert_allclose(v_spec, expected_v, atol=1e-5)
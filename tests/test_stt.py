@@ -0,0 +1,162 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import requests
+
+from autodub import stt
+from autodub.stt import ClovaSTT, split_on_silence
+
+SR = 16000
+FRAME = int(SR * 0.03)
+
+
+def _signal(*parts):
+    """Concatenate (seconds, voiced) parts: a 440 Hz tone where voiced, faint noise elsewhere."""
+    rng = np.random.default_rng(0)
+    audio = []
+    for seconds, voiced in parts:
+        t = np.arange(int(seconds * SR)) / SR
+        audio.append(0.5 * np.sin(2 * np.pi * 440 * t) if voiced else 1e-4 * rng.normal(size=len(t)))
+    return np.concatenate(audio).astype(np.float32)
+
+
+def test_split_on_silence_cuts_in_silences():
+    audio = _signal((2, True), (1, False), (2, True), (1, False), (2, True))
+    chunks = split_on_silence(audio, sr=SR, chunk_seconds=4.)
+    # Each chunk ends in the middle of the last silence it can reach.
+    expected = [(0, 2.5 * SR), (2.5 * SR, 5.5 * SR), (5.5 * SR, len(audio))]
+    assert len(chunks) == len(expected)
+    for (start, end), (expected_start, expected_end) in zip(chunks, expected):
+        assert start == pytest.approx(expected_start, abs=FRAME)
+        assert end == pytest.approx(expected_end, abs=FRAME)
+    # The chunks cover the audio without gaps.
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(audio)
+    assert all(end == next_start for (_, end), (next_start, _) in zip(chunks, chunks[1:]))
+
+
+def test_split_on_silence_without_silence():
+    audio = _signal((10, True))
+    chunks = split_on_silence(audio, sr=SR, chunk_seconds=4.)
+    assert chunks == [(0, 4 * SR), (4 * SR, 8 * SR), (8 * SR, 10 * SR)]
+
+
+def test_split_on_silence_drops_silent_chunks():
+    audio = _signal((2, True), (7, False), (2, True))
+    chunks = split_on_silence(audio, sr=SR, chunk_seconds=3.)
+    # (3s, 5.5s) and (5.5s, 8.5s) are silent.
+    assert len(chunks) == 2
+    assert chunks[0] == (0, 3 * SR)
+    assert chunks[1][0] == pytest.approx(8.5 * SR, abs=FRAME)
+    assert chunks[1][1] == len(audio)
+
+
+def test_split_on_silence_short_audio():
+    assert split_on_silence(np.zeros(0, dtype=np.float32), sr=SR) == []
+    assert split_on_silence(np.ones(FRAME // 2, dtype=np.float32), sr=SR) == [(0, FRAME // 2)]
+    audio = _signal((1, True))
+    assert split_on_silence(audio, sr=SR) == [(0, len(audio))]
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code}")
+
+
+class FakeClova:
+    """Session answering with the queued responses of each method, and recording the requests."""
+    def __init__(self, **responses):
+        self.responses = responses
+        self.requests = []
+
+    def request(self, method, url, data=None, timeout=None, headers=None):
+        # Drain the body like a real upload does.
+        body = b"".join(data) if data is not None else None
+        self.requests.append((method, url, body, headers))
+        response = self.responses[method].pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+MEDIA = os.urandom(3000)
+
+
+@pytest.fixture
+def clova(monkeypatch):
+    monkeypatch.setitem(stt.env, 'CLOVA', {'INVOKE_URL': "https://clova.test", 'SECRET': "secret"})
+    def extract_audio(video_path, audio_path):
+        with open(audio_path, 'wb') as f:
+            f.write(MEDIA)
+    monkeypatch.setattr(ClovaSTT, "_extract_audio", staticmethod(extract_audio))
+    return ClovaSTT(backoff=0., poll_interval=0.)
+
+
+def _segments(*texts):
+    return [{'start': 1000 * i, 'end': 1000 * i + 800, 'text': text} for i, text in enumerate(texts)]
+
+
+def test_clova_uploads_audio_and_polls(clova, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clova._session = FakeClova(
+        POST=[FakeResponse(503), FakeResponse(200, {'token': "job"})],
+        GET=[FakeResponse(200, {'result': "PROCESSING"}), FakeResponse(500),
+             FakeResponse(200, {'result': "COMPLETED", 'segments': _segments("hello", "world")})])
+    script = clova.make_script_from_video("video.mp4", "en", "title")
+    assert script.data.to_dict('list') == {'start': [0, 1000], 'end': [800, 1800], 'source': ["hello", "world"]}
+
+    uploads = [request for request in clova._session.requests if request[0] == 'POST']
+    polls = [request for request in clova._session.requests if request[0] == 'GET']
+    assert [url for _, url, _, _ in uploads] == ["https://clova.test/recognizer/upload"] * 2
+    assert [url for _, url, _, _ in polls] == ["https://clova.test/recognizer/job"] * 3
+    # The retried upload streams the whole body again.
+    _, _, body, headers = uploads[1]
+    assert body == uploads[0][2]
+    boundary = headers['Content-Type'].split("boundary=")[1]
+    params_part, media_part = body.split(f"--{boundary}".encode())[1:3]
+    params = json.loads(params_part.split(b"\r\n\r\n", 1)[1].rstrip(b"\r\n"))
+    assert params['completion'] == 'async' and params['language'] == 'en-US'
+    assert media_part.split(b"\r\n\r\n", 1)[1] == MEDIA + b"\r\n"
+    assert body.endswith(f"--{boundary}--\r\n".encode())
+
+
+def test_clova_multipart_streams_in_chunks(tmp_path):
+    path = tmp_path / "media.m4a"
+    path.write_bytes(MEDIA)
+    blocks = list(ClovaSTT._multipart({'language': "en-US"}, str(path), "boundary", chunk_size=1024))
+    media_blocks = [block for block in blocks if block in (MEDIA[:1024], MEDIA[1024:2048], MEDIA[2048:])]
+    assert len(media_blocks) == 3
+
+
+def test_clova_failed_job(clova):
+    clova._session = FakeClova(POST=[FakeResponse(200, {'token': "job"})],
+                               GET=[FakeResponse(200, {'result': "FAILED", 'message': "bad audio"})])
+    with pytest.raises(RuntimeError, match="bad audio"):
+        clova._call_clova_api("video.mp4", "en")
+
+
+def test_clova_job_timeout(clova):
+    clova.job_timeout = 0.
+    clova._session = FakeClova(POST=[FakeResponse(200, {'token': "job"})],
+                               GET=[FakeResponse(200, {'result': "PROCESSING"})])
+    with pytest.raises(TimeoutError):
+        clova._call_clova_api("video.mp4", "en")
+
+
+def test_clova_gives_up_after_max_retries(clova):
+    clova.max_retries = 1
+    clova._session = FakeClova(POST=[requests.ConnectionError(), requests.ConnectionError()])
+    with pytest.raises(requests.ConnectionError):
+        clova._call_clova_api("video.mp4", "en")
+    clova._session = FakeClova(POST=[FakeResponse(503), FakeResponse(503)])
+    with pytest.raises(requests.HTTPError):
+        clova._call_clova_api("video.mp4", "en")
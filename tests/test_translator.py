@@ -0,0 +1,172 @@
+import asyncio
+import functools
+import json
+from urllib.parse import parse_qs
+
+import httpx
+import pytest
+
+from autodub import translator as translator_module
+from autodub.translator import DeepLTranslator, PapagoTranslator, TranslationMemory, Translator
+
+
+@pytest.fixture
+def memory(tmp_path):
+    return TranslationMemory(str(tmp_path / "memory.sqlite3"))
+
+
+class EchoTranslator(Translator):
+    name = "ECHO"
+    max_batch_size = 2
+
+    def __init__(self, memory):
+        super().__init__(memory=memory)
+        self.requests = []
+
+    def translate_texts(self, source_texts, source_language, target_language):
+        self.requests.append(list(source_texts))
+        return [f"{target_language}:{text}" for text in source_texts]
+
+
+def test_get_missing(memory):
+    assert memory.get("PAPAGO", "en", "ko", ["hello", "bye"]) == [None, None]
+    assert memory.stats() == {'hits': 0, 'misses': 2, 'entries': 0}
+
+
+def test_put_then_get_normalized(memory):
+    memory.put("PAPAGO", "en", "ko", ["hello  world", "bye"], ["안녕 세상", "잘 가"])
+    assert memory.get("PAPAGO", "en", "ko", [" hello\nworld ", "bye", "other"]) == ["안녕 세상", "잘 가", None]
+    assert memory.stats() == {'hits': 2, 'misses': 1, 'entries': 2}
+
+
+def test_entries_are_per_provider_and_language(memory):
+    memory.put("PAPAGO", "en", "ko", ["hello"], ["안녕"])
+    assert memory.get("DEEPL", "en", "ko", ["hello"]) == [None]
+    assert memory.get("PAPAGO", "en", "ja", ["hello"]) == [None]
+    assert memory.get("PAPAGO", "ja", "ko", ["hello"]) == [None]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    memory = TranslationMemory(str(tmp_path / "memory.sqlite3"), max_entries=2)
+    memory.put("PAPAGO", "en", "ko", ["a"], ["A"])
+    memory.put("PAPAGO", "en", "ko", ["b"], ["B"])
+    memory.get("PAPAGO", "en", "ko", ["a"])
+    memory.put("PAPAGO", "en", "ko", ["c"], ["C"])
+    assert memory.get("PAPAGO", "en", "ko", ["a", "b", "c"]) == ["A", None, "C"]
+
+
+def test_persists_across_connections(tmp_path):
+    path = str(tmp_path / "memory.sqlite3")
+    TranslationMemory(path).put("PAPAGO", "en", "ko", ["hello"], ["안녕"])
+    assert TranslationMemory(path).get("PAPAGO", "en", "ko", ["hello"]) == ["안녕"]
+
+
+def test_translate_lines_requests_each_missing_line_once(memory):
+    memory.put("ECHO", "en", "ko", ["known"], ["알려진"])
+    translator = EchoTranslator(memory)
+    lines = ["known", "a", "b", "a", "c"]
+    assert translator.translate_lines(lines, "en", "ko") == ["알려진", "ko:a", "ko:b", "ko:a", "ko:c"]
+    assert sorted(text for batch in translator.requests for text in batch) == ["a", "b", "c"]
+    assert all(len(batch) <= translator.max_batch_size for batch in translator.requests)
+
+    translator.requests.clear()
+    assert translator.translate_lines(lines, "en", "ko") == ["알려진", "ko:a", "ko:b", "ko:a", "ko:c"]
+    assert translator.requests == []
+
+
+def test_translate_text_goes_through_memory(memory):
+    translator = EchoTranslator(memory)
+    assert translator.translate_text("hello", "en", "ko") == "ko:hello"
+    assert translator.translate_text("hello", "en", "ko") == "ko:hello"
+    assert translator.requests == [["hello"]]
+    assert memory.get("ECHO", "en", "ko", ["hello"]) == ["ko:hello"]
+
+
+class Server:
+    """Records the requests, and answers them with 'respond'."""
+    def __init__(self):
+        self.requests = []
+        self.respond = None
+
+    def __call__(self, request):
+        self.requests.append(request)
+        return self.respond(request)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Route the translators' requests to a mock server instead of the network."""
+    server = Server()
+    transport = httpx.MockTransport(server)
+    monkeypatch.setattr(httpx, "AsyncClient", functools.partial(httpx.AsyncClient, transport=transport))
+    monkeypatch.setitem(translator_module.env, 'DEEPL', {'AUTH_KEY': "key"})
+    monkeypatch.setitem(translator_module.env, 'PAPAGO', {'ID': "id", 'SECRET': "secret"})
+    return server
+
+
+def _deepl_texts(request):
+    return parse_qs(request.content.decode())['text']
+
+
+def _deepl_echo(request):
+    return httpx.Response(200, json={'translations': [{'text': f"KO:{text}"} for text in _deepl_texts(request)]})
+
+
+def test_deepl_splits_batches(server, memory):
+    server.respond = _deepl_echo
+    translator = DeepLTranslator(memory=memory)
+    translator.max_batch_size = 2
+    lines = ["a", "b", "c", "d", "e"]
+    assert translator.translate_lines(lines, "en", "ko") == ["KO:a", "KO:b", "KO:c", "KO:d", "KO:e"]
+    assert sorted(map(_deepl_texts, server.requests)) == [["a", "b"], ["c", "d"], ["e"]]
+
+
+def test_pack_limits_bytes(memory):
+    translator = EchoTranslator(memory)
+    translator.max_batch_size = 10
+    translator.max_batch_bytes = 6
+    # A text longer than the limit still gets a batch of its own.
+    assert translator._pack(["ab", "cd", "efg", "hijklmn", "o"]) == [["ab", "cd"], ["efg"], ["hijklmn"], ["o"]]
+
+
+def test_retries_rate_limits_and_server_errors(server, memory):
+    responses = iter([httpx.Response(429, headers={'Retry-After': "0"}), httpx.Response(503)])
+    server.respond = lambda request: next(responses, None) or _deepl_echo(request)
+    translator = DeepLTranslator(memory=memory, backoff=0.)
+    assert translator.translate_lines(["hello"], "en", "ko") == ["KO:hello"]
+    assert len(server.requests) == 3
+
+
+def test_retries_transport_errors(server, memory):
+    def respond(request):
+        if len(server.requests) == 1:
+            raise httpx.ConnectError("refused", request=request)
+        return _deepl_echo(request)
+    server.respond = respond
+    translator = DeepLTranslator(memory=memory, backoff=0.)
+    assert translator.translate_lines(["hello"], "en", "ko") == ["KO:hello"]
+    assert len(server.requests) == 2
+
+
+def test_gives_up_after_max_retries(server, memory):
+    server.respond = lambda request: httpx.Response(503, json={})
+    translator = DeepLTranslator(memory=memory, max_retries=2, backoff=0.)
+    with pytest.raises(AssertionError):
+        translator.translate_lines(["hello"], "en", "ko")
+    assert len(server.requests) == 3
+    # Nothing was remembered.
+    assert memory.get("DEEPL", "en", "ko", ["hello"]) == [None]
+
+
+def test_sync_api_inside_running_event_loop(server, memory):
+    def respond(request):
+        text = json.loads(request.content)['text']
+        return httpx.Response(200, json={'message': {'result': {'translatedText': f"ko:{text}"}}})
+    server.respond = respond
+    translator = PapagoTranslator(memory=memory)
+
+    async def handler_of_the_app():
+        # e.g. a Gradio handler calling the synchronous API from its event loop.
+        return translator.translate_lines(["a", "b"], "en", "ko"), translator.translate_texts(["c"], "en", "ko")
+    assert asyncio.run(handler_of_the_app()) == (["ko:a", "ko:b"], ["ko:c"])
+    assert len(server.requests) == 3
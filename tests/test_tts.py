@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import soundfile as sf
+import torch
+
+from autodub import tts
+from autodub.cache import StageCache
+from autodub.script import MultilingualScript
+from autodub.tts import cluster_speakers, prepare_speaker_prompts
+
+
+def _embeddings(speakers, dim=32, noise=0.1, seed=0):
+    """Embeddings of segments by 'speakers', sharing the offset of one recording."""
+    rng = np.random.default_rng(seed)
+    voices = rng.normal(size=(max(speakers) + 1, dim))
+    recording = 5 * rng.normal(size=dim)
+    return np.stack([recording + voices[speaker] + noise * rng.normal(size=dim) for speaker in speakers])
+
+
+def test_cluster_speakers_by_threshold():
+    # Labels are numbered by first appearance, whatever the speakers were called.
+    assert cluster_speakers(_embeddings([2, 0, 2, 2, 0, 1])).tolist() == [0, 1, 0, 0, 1, 2]
+
+
+def test_cluster_speakers_num_speakers():
+    embeddings = _embeddings([0, 1, 0, 1], noise=0.5)
+    # Every segment stands alone above this similarity, unless the number of speakers is given.
+    assert len(set(cluster_speakers(embeddings, threshold=0.999).tolist())) == 4
+    assert cluster_speakers(embeddings, threshold=0.999, num_speakers=2).tolist() == [0, 1, 0, 1]
+
+
+def test_cluster_speakers_few_segments():
+    assert cluster_speakers(np.zeros((0, 8))).tolist() == []
+    assert cluster_speakers(_embeddings([0])).tolist() == [0]
+
+
+@pytest.fixture
+def script(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sf.write(tmp_path / "source.wav", np.zeros(24000, dtype=np.float32), 24000)
+    # Speaker A says lines 0, 2 and 3; only line 2 lasts between 3 and 10 seconds. Speaker B says line 1.
+    return MultilingualScript("title", "video.mp4", str(tmp_path / "source.wav"), "en", pd.DataFrame({
+        'start': [0, 2000, 5000, 12000],
+        'end': [1000, 4000, 9000, 23000],
+        'source': ["zero", "one", "two", "three"],
+    }))
+
+
+@pytest.fixture
+def fake_codec(monkeypatch):
+    """Replace EnCodec: each segment embeds as the voice of its speaker, and a prompt records its segment."""
+    calls = {'embed': 0, 'prompt': []}
+
+    def embed_segments(wav, sr, segments):
+        calls['embed'] += 1
+        return _embeddings([0, 1, 0, 0])
+
+    def make_prompts(name, wav, sr, segments, transcripts):
+        calls['prompt'].append(transcripts)
+        return [{'audio_tokens': np.array(segment), 'text_tokens': np.zeros(1), 'lang_code': 0}
+                for segment in segments]
+
+    monkeypatch.setattr(tts, "embed_segments", embed_segments)
+    monkeypatch.setattr(tts, "make_prompts", make_prompts)
+    return calls
+
+
+def _prompt_path(script, idx):
+    return script.output_dir + f"/prompt/prompt_{str(idx).zfill(6)}.npz"
+
+
+def test_prepare_speaker_prompts(script, fake_codec):
+    prepare_speaker_prompts(script, source=(torch.zeros(1, 24000), 24000))
+    assert script.data['speaker'].tolist() == [0, 1, 0, 0]
+    # One prompt per speaker, from the line of speaker A within 3 to 10 seconds.
+    assert fake_codec['prompt'] == [["two", "one"]]
+    for idx, segment in enumerate([(5, 9), (2, 4), (5, 9), (5, 9)]):
+        assert np.load(_prompt_path(script, idx))['audio_tokens'].tolist() == list(segment)
+    assert os.path.samefile(_prompt_path(script, 0), _prompt_path(script, 3))
+
+
+def test_prepare_speaker_prompts_cached(script, fake_codec, tmp_path):
+    cache = StageCache(str(tmp_path / "cache"))
+    prepare_speaker_prompts(script, cache, source=(torch.zeros(1, 24000), 24000))
+    for idx in script.data.index:
+        os.remove(_prompt_path(script, idx))
+    prepare_speaker_prompts(script, cache, source=(torch.zeros(1, 24000), 24000))
+    assert fake_codec['embed'] == 1
+    assert len(fake_codec['prompt']) == 1
+    assert np.load(_prompt_path(script, 3))['audio_tokens'].tolist() == [5, 9]
+
+
+def test_generate_translated_speech(script, tmp_path, monkeypatch):
+    script.data['ko'] = ["영", "일일", "이", "삼삼삼"]
+    os.makedirs(script.output_dir + "/prompt")
+    for idx in script.data.index:
+        np.savez(_prompt_path(script, idx), audio_tokens=np.array([idx]))
+    batches = []
+    def generate_audio_batch(texts, prompt_paths, language, target_durations, max_durations):
+        batches.append(texts)
+        return [np.zeros(len(text) * 100, dtype=np.float32) for text in texts]
+    monkeypatch.setattr(tts, "generate_audio_batch", generate_audio_batch)
+
+    cache = StageCache(str(tmp_path / "cache"))
+    tts.generate_translated_speech(script, 'ko', batch_size=3, cache=cache)
+    # Batched by length
+    assert batches == [["영", "이", "일일"], ["삼삼삼"]]
+    for idx, text in enumerate(script.data['ko']):
+        wave, _ = sf.read(script.output_dir + f"/audio/ko/segment_{str(idx).zfill(6)}.wav")
+        assert len(wave) == len(text) * 100
+
+    # Only the edited line is synthesized again.
+    script.data.loc[1, 'ko'] = "하나"
+    tts.generate_translated_speech(script, 'ko', batch_size=3, cache=cache)
+    assert batches[2:] == [["하나"]]
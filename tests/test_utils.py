@@ -0,0 +1,194 @@
+import logging
+import os
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pytest
+import soundfile as sf
+
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+from autodub import utils
+from autodub.script import MultilingualScript
+from autodub.utils import (
+    _write_render_manifest,
+    changed_segments,
+    has_rendered,
+    merge_clips_to_video,
+    prepare_clips,
+    segment_timing,
+    split_video,
+)
+
+
+def _script(data):
+    return MultilingualScript("title", "video.mp4", "audio.wav", "en", pd.DataFrame(data))
+
+
+@pytest.fixture
+def script(tmp_path, monkeypatch):
+    # Scripts write under './results/{title}/'.
+    monkeypatch.chdir(tmp_path)
+    return _script({
+        'start': [0, 1000, 2500],
+        'end': [900, 2300, 4000],
+        'source': ["one", "two", "three"],
+        'ko': ["하나", np.nan, "셋"],
+    })
+
+
+def test_changed_segments_before_first_render(script):
+    assert not has_rendered(script, 'ko')
+    assert changed_segments(script, 'ko') == [0, 1, 2]
+
+
+def test_changed_segments_after_render(script):
+    _write_render_manifest(script, 'ko')
+    assert has_rendered(script, 'ko')
+    # A missing translation (NaN) compares equal to itself after the JSON round trip.
+    assert changed_segments(script, 'ko') == []
+
+
+def test_changed_segments_finds_edits(script):
+    _write_render_manifest(script, 'ko')
+    script.data.loc[1, 'ko'] = "둘"
+    script.data.loc[2, 'start'] = 2600
+    assert changed_segments(script, 'ko') == [1, 2]
+
+
+def test_changed_segments_new_lines(script):
+    _write_render_manifest(script, 'ko')
+    script.data = pd.concat([script.data, pd.DataFrame(
+        {'start': [4500], 'end': [5000], 'source': ["four"], 'ko': ["넷"]})], ignore_index=True)
+    assert changed_segments(script, 'ko') == [3]
+
+
+def _write_speech(script, language, idx, duration, sample_rate=24000):
+    path = script.output_dir + f"/audio/{language}/segment_{str(idx).zfill(6)}.wav"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sf.write(path, np.zeros(int(duration * sample_rate), dtype=np.float32), sample_rate)
+
+
+def test_segment_timing(script):
+    # Video clips cover [start, next start): 1.0s, 1.5s, and up to the end of the video for the last one.
+    _write_speech(script, 'ko', 0, 0.5)
+    _write_speech(script, 'ko', 1, 3.0)
+    _write_speech(script, 'ko', 2, 1.0)
+
+    speed, slot = segment_timing(script, 'ko', 0, video_duration=5.0)
+    assert speed == 1.
+    assert slot == pytest.approx(1.0)
+
+    speed, slot = segment_timing(script, 'ko', 1, video_duration=5.0)
+    assert speed == pytest.approx(0.5)
+    assert slot == pytest.approx(3.0)
+
+    speed, slot = segment_timing(script, 'ko', 2, video_duration=5.0)
+    assert speed == 1.
+    assert slot == pytest.approx(2.5)
+
+
+def _ffmpeg(*args):
+    subprocess.run([get_setting("FFMPEG_BINARY"), "-y", "-hide_banner", "-loglevel", "error", *args], check=True)
+
+
+@pytest.fixture
+def clips(tmp_path, monkeypatch):
+    """A 3s synthetic video with a single keyframe, split into the clips of a 3-line script."""
+    monkeypatch.chdir(tmp_path)
+    _ffmpeg("-f", "lavfi", "-i", "testsrc=size=160x120:rate=25:duration=3",
+            "-c:v", "libx264", "-g", "250", "-pix_fmt", "yuv420p", "source.mp4")
+    _ffmpeg("-f", "lavfi", "-i", "sine=frequency=440:duration=3", "-ar", "24000", "source.wav")
+    script = MultilingualScript("title", str(tmp_path / "source.mp4"), str(tmp_path / "source.wav"), "en",
+                                pd.DataFrame({'start': [0, 1000, 2000], 'end': [800, 1800, 2600],
+                                              'source': ["one", "two", "three"], 'ko': ["하나", "둘", "셋"]}))
+    os.makedirs(script.output_dir + "/audio", exist_ok=True)
+    _ffmpeg("-i", "source.wav", script.output_dir + "/audio/init_source_Instruments.wav")
+    prepare_clips(script)
+    return script
+
+
+def test_prepare_clips(clips):
+    # Video clips run to the next line; speech clips cover the line only.
+    for idx, speech_duration in enumerate([0.8, 0.8, 0.6]):
+        info = ffmpeg_parse_infos(clips.output_dir + f"/video/source/segment_{str(idx).zfill(6)}.mp4")
+        assert info['duration'] == pytest.approx(1.0, abs=0.05)
+        speech = sf.info(clips.output_dir + f"/audio/source/segment_{str(idx).zfill(6)}.wav")
+        assert speech.duration == pytest.approx(speech_duration, abs=0.01)
+
+
+@pytest.fixture
+def video(tmp_path):
+    """A 3s synthetic video with a keyframe every second."""
+    path = str(tmp_path / "source.mp4")
+    _ffmpeg("-f", "lavfi", "-i", "testsrc=size=160x120:rate=25:duration=3",
+            "-c:v", "libx264", "-g", "25", "-pix_fmt", "yuv420p", path)
+    return path
+
+
+@pytest.fixture
+def ffmpeg_args(monkeypatch):
+    """Arguments of every ffmpeg call of autodub.utils."""
+    calls = []
+    run_ffmpeg = utils._run_ffmpeg
+    def spy(args):
+        calls.append(args)
+        run_ffmpeg(args)
+    monkeypatch.setattr(utils, "_run_ffmpeg", spy)
+    return calls
+
+
+def _split(video, tmp_path):
+    split_video(video, [0., 1., 2.], str(tmp_path / "segment_%06d.mp4"))
+    return [ffmpeg_parse_infos(str(tmp_path / f"segment_{idx:06d}.mp4"))['duration'] for idx in range(3)]
+
+
+def test_split_video_on_keyframes(video, tmp_path, monkeypatch, ffmpeg_args, caplog):
+    monkeypatch.setattr(utils, "_probe_keyframes", lambda path: [0., 1., 2.])
+    with caplog.at_level(logging.WARNING):
+        durations = _split(video, tmp_path)
+    assert durations == [pytest.approx(1.0, abs=0.05)] * 3
+    assert "copy" in ffmpeg_args[0]
+    assert caplog.records == []
+
+
+@pytest.mark.parametrize("keyframes, reason", [([0.], "not on keyframes"), (None, "ffprobe")])
+def test_split_video_falls_back_to_encoding(video, tmp_path, monkeypatch, ffmpeg_args, caplog, keyframes, reason):
+    monkeypatch.setattr(utils, "_probe_keyframes", lambda path: keyframes)
+    with caplog.at_level(logging.WARNING):
+        durations = _split(video, tmp_path)
+    assert durations == [pytest.approx(1.0, abs=0.05)] * 3
+    assert "libx264" in ffmpeg_args[0]
+    assert len(caplog.records) == 1 and reason in caplog.records[0].getMessage()
+
+
+def test_merge_clips_to_video_first_render(clips):
+    # The second line is longer than its clip, so its video is slowed down.
+    _write_speech(clips, 'ko', 0, 0.5)
+    _write_speech(clips, 'ko', 1, 1.5)
+    _write_speech(clips, 'ko', 2, 0.8)
+    merge_clips_to_video(clips, 'ko', incremental=True)
+
+    info = ffmpeg_parse_infos(clips.output_dir + "[ko]_title.mp4")
+    assert info['duration'] == pytest.approx(1.0 + 1.5 + 1.0, abs=0.1)
+    assert has_rendered(clips, 'ko')
+    assert changed_segments(clips, 'ko') == []
+
+
+def test_merge_clips_to_video_second_render(clips):
+    _write_speech(clips, 'ko', 0, 0.5)
+    _write_speech(clips, 'ko', 1, 1.5)
+    _write_speech(clips, 'ko', 2, 0.8)
+    merge_clips_to_video(clips, 'ko', incremental=True)
+
+    clips.data.loc[1, 'ko'] = "두울"
+    _write_speech(clips, 'ko', 1, 0.9)
+    assert changed_segments(clips, 'ko') == [1]
+    merge_clips_to_video(clips, 'ko', incremental=True)
+
+    info = ffmpeg_parse_infos(clips.output_dir + "[ko]_title.mp4")
+    assert info['duration'] == pytest.approx(3.0, abs=0.1)
+    assert os.path.exists(clips.output_dir + "/video/ko/part_000001.mp4")
+    assert changed_segments(clips, 'ko') == []
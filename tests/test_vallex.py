@@ -0,0 +1,91 @@
+import torch
+
+from autodub.VALL_E_X.models.vallex import (
+    DEFAULT_FRAMES_PER_TOKEN,
+    MIN_EXTRA_FRAMES,
+    detect_runaway,
+    eos_steering_bias,
+    frame_budget,
+)
+from autodub.VALL_E_X.modules.embedding import SinePositionalEmbedding
+
+
+def test_frame_budget_follows_prompt_rate():
+    # 5 frames per text token in the prompt.
+    assert frame_budget(20, 10, 50, duration_slack=2.0) == 5 * 20 * 2 + MIN_EXTRA_FRAMES
+    assert frame_budget(20, 10, 50, duration_slack=1.0) == 5 * 20 + MIN_EXTRA_FRAMES
+
+
+def test_frame_budget_without_prompt():
+    assert frame_budget(20, 0, 0) == min(int(DEFAULT_FRAMES_PER_TOKEN * 20 * 2) + MIN_EXTRA_FRAMES, 20 * 16)
+
+
+def test_frame_budget_capped():
+    # A slow prompt (30 frames per token) is capped at 16 frames per token, prompt included.
+    assert frame_budget(20, 10, 300) == (10 + 20) * 16
+
+
+def test_eos_steering_bias_saturates_before_the_limit():
+    target, limit = torch.tensor(100.), torch.tensor(150.)
+    bias = [float(eos_steering_bias(n, target, limit, 8.)) for n in (0, 90, 105, 120, 150)]
+    assert bias[:2] == [0., 0.]
+    assert 0. < bias[2] < 8.
+    assert bias[3:] == [8., 8.]
+
+
+def test_eos_steering_bias_limit_below_target():
+    bias = eos_steering_bias(80, torch.tensor(100.), torch.tensor(80.), 8.)
+    assert float(bias) == 8.
+
+
+def _tokens(*rows):
+    return torch.tensor(rows, dtype=torch.long)
+
+
+def test_detect_runaway_silence():
+    speech = list(range(100, 140))
+    tokens = _tokens(speech + [7] * 60, speech + [7] * 59 + [8])
+    runaway, drop = detect_runaway(tokens)
+    assert runaway.tolist() == [True, False]
+    assert drop.tolist() == [59, 0]
+
+
+def test_detect_runaway_pause():
+    # Pauses shorter than 'max_repeat' frames are not loops of any period.
+    speech = list(range(100, 140))
+    for n in (8, 12, 30, 59):
+        runaway, drop = detect_runaway(_tokens(speech + [7] * n))
+        assert not runaway.any() and not drop.any(), n
+
+
+def test_detect_runaway_loop():
+    speech = list(range(100, 140))
+    loop = [1, 2, 3]
+    tokens = _tokens(speech + loop * 14, speech + loop * 13 + [1, 2, 4])
+    runaway, drop = detect_runaway(tokens)
+    assert runaway.tolist() == [True, False]
+    # The first occurrence of the loop within the checked span is kept.
+    assert drop.tolist() == [37, 0]
+
+
+def test_detect_runaway_short_loop():
+    # Four repetitions of a short pattern are not enough under 'min_span' frames.
+    speech = list(range(100, 140))
+    runaway, drop = detect_runaway(_tokens(speech + [1, 2, 3] * 4))
+    assert not runaway.any() and not drop.any()
+
+
+def test_detect_runaway_short():
+    runaway, drop = detect_runaway(_tokens([5, 5, 5]))
+    assert not runaway.any()
+    assert not drop.any()
+
+
+def test_positional_offset_past_the_table():
+    position = SinePositionalEmbedding(16)
+    x = torch.randn(1, 3, 16)
+    expected = position(torch.cat([torch.zeros(1, 4100, 16), x], dim=1))[:, 4100:]
+    position = SinePositionalEmbedding(16)
+    assert position.pe.size(1) == 4000
+    torch.testing.assert_close(position(x, offset=4100), expected)
+    assert position.pe.size(1) == 4103